@@ -0,0 +1,195 @@
+"""
+A per-user cache of Asana resources (the user, workspaces, projects and tasks), kept fresh by Asana's Events API
+rather than by refetching.
+
+Projects and tasks that are in the cache are watched. A background poller asks the Events API what's changed on
+each watched resource since its stored sync token, and evicts only the resources that changed. A change to
+something that isn't cached itself, like a story or attachment, evicts the resource it belongs to.
+Everything else stays cached for its kind's TTL, which only matters for changes the events can't report, like
+a workspace rename. Warm requests therefore make no Asana calls at all.
+
+A resource's sync token is taken on the first poll after it's cached, so a change made between the fetch and
+that poll can be missed. The TTL bounds how long such a miss goes unnoticed. When Asana says a sync token is too
+old (412), that resource is evicted, since events may have been missed.
+"""
+
+import logging
+import threading
+import time
+from storage_service.cache import TTLCache
+from metrics_service import metrics
+
+LOG = logging.getLogger('root')
+
+# Seconds a resource of each kind is kept. Watched kinds are evicted as soon as they change, so they can be
+# kept a while; the rest are only refreshed by expiring.
+RESOURCE_TTLS = {
+        "user": 3600,
+        "workspace": 24 * 3600,
+        "project": 3600,
+        "task": 3600,
+        }
+# Kinds the Events API can report changes to.
+WATCHED_TYPES = ("project", "task")
+# Fields fetched for each kind, so every cached copy has the same shape.
+RESOURCE_FIELDS = {
+        "user": ["name", "email", "workspaces.name"],
+        "workspace": ["name"],
+        "project": ["name", "permalink_url", "workspace.name"],
+        "task": ["name", "permalink_url", "completed", "projects.name", "parent.name"],
+        }
+POLL_INTERVAL_SECONDS = 30
+# Resources watched per user. Beyond this, the rest are left to their TTLs, to keep polling cheap.
+MAX_WATCHED_PER_USER = 100
+CACHE_SIZE = 5000
+
+
+class _Watch:
+
+    def __init__(self, resource_type, gid):
+        self.resource_type = resource_type
+        self.gid = gid
+        self.sync = None
+
+
+class AsanaResourceCache:
+
+    def __init__(self, client_for_user=None, maxsize=CACHE_SIZE, clock=time.monotonic):
+        # Called with a user ID to get the client to poll events with; None skips the user until next time.
+        self._client_for_user = client_for_user
+        self._cache = TTLCache(maxsize=maxsize, clock=clock)
+        self._lock = threading.Lock()
+        # user ID -> {resource gid: _Watch}
+        self._watches = {}
+        self._poller = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, resource_type, gid, fetch):
+        '''
+        The cached resource, or fetch() (which makes the Asana call) if it's not cached.
+        '''
+        key = (user_id, resource_type, gid)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            metrics.REGISTRY.increment('asana_cache_requests_total', result="hit", type=resource_type)
+            return cached
+        self.misses += 1
+        metrics.REGISTRY.increment('asana_cache_requests_total', result="miss", type=resource_type)
+        with metrics.span(f"asana.get_{resource_type}"):
+            resource = fetch()
+        self._cache.set(key, resource, RESOURCE_TTLS[resource_type])
+        if resource_type in WATCHED_TYPES:
+            self._watch(user_id, resource_type, gid)
+        return resource
+
+    def me(self, user_id, client):
+        return self.get(user_id, "user", user_id, lambda: client.users.me(fields=RESOURCE_FIELDS["user"]))
+
+    def workspace(self, user_id, client, gid):
+        return self.get(user_id, "workspace", gid, lambda: client.workspaces.get_workspace(gid, fields=RESOURCE_FIELDS["workspace"]))
+
+    def project(self, user_id, client, gid):
+        return self.get(user_id, "project", gid, lambda: client.projects.get_project(gid, fields=RESOURCE_FIELDS["project"]))
+
+    def task(self, user_id, client, gid, fetch=None):
+        return self.get(user_id, "task", gid, fetch or (lambda: client.tasks.get_task(gid, fields=RESOURCE_FIELDS["task"])))
+
+    def invalidate(self, user_id, resource_type, gid):
+        self._cache.invalidate((user_id, resource_type, gid))
+
+    def _watch(self, user_id, resource_type, gid):
+        with self._lock:
+            watches = self._watches.setdefault(user_id, {})
+            if gid not in watches and len(watches) < MAX_WATCHED_PER_USER:
+                watches[gid] = _Watch(resource_type, gid)
+        self._ensure_poller()
+
+    def watched(self, user_id):
+        with self._lock:
+            return sorted(self._watches.get(user_id, {}))
+
+    def poll(self, user_id, client):
+        '''
+        Bring one user's watched resources up to date with the Events API. Returns how many were evicted.
+        '''
+        import asana
+        with self._lock:
+            watches = list(self._watches.get(user_id, {}).values())
+        evicted = 0
+        for watch in watches:
+            if (user_id, watch.resource_type, watch.gid) not in self._cache:
+                # Expired or evicted, and not fetched again since: nothing left to keep fresh.
+                with self._lock:
+                    self._watches.get(user_id, {}).pop(watch.gid, None)
+                continue
+            try:
+                with metrics.span("asana.get_events"):
+                    response = client.events.get({'resource': watch.gid, 'sync': watch.sync} if watch.sync else {'resource': watch.gid})
+            except asana.error.InvalidTokenError as e:
+                if watch.sync is not None:
+                    # The token was too old to say what changed, so nothing under this resource can be trusted.
+                    LOG.info("Sync token for %s %s expired; evicting it", watch.resource_type, watch.gid)
+                    self.invalidate(user_id, watch.resource_type, watch.gid)
+                    evicted += 1
+                watch.sync = e.sync
+                continue
+            except asana.error.NotFoundError:
+                self.invalidate(user_id, watch.resource_type, watch.gid)
+                with self._lock:
+                    self._watches.get(user_id, {}).pop(watch.gid, None)
+                evicted += 1
+                continue
+            watch.sync = response.get('sync', watch.sync)
+            for event in response.get('data', []):
+                evicted += self._apply(user_id, event)
+        return evicted
+
+    def _apply(self, user_id, event):
+        resource = event.get('resource') or {}
+        if resource.get('resource_type') not in RESOURCE_TTLS:
+            # A story, attachment or the like: what it changed is its parent, e.g. the task it was added to.
+            resource = event.get('parent') or {}
+        key = (user_id, resource.get('resource_type'), resource.get('gid'))
+        if key in self._cache:
+            self._cache.invalidate(key)
+            return 1
+        return 0
+
+    def poll_all(self):
+        with self._lock:
+            user_ids = [user_id for user_id, watches in self._watches.items() if watches]
+        for user_id in user_ids:
+            try:
+                client = self._client_for_user(user_id) if self._client_for_user else None
+                if client is not None:
+                    self.poll(user_id, client)
+            except Exception:
+                # Leave it to the next pass; entries still expire on their own meanwhile.
+                LOG.exception("Polling Asana events for user %s failed", user_id)
+
+    def _ensure_poller(self):
+        if self._poller is not None or self._client_for_user is None:
+            return
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._run_poller, name="asana-events-poller", daemon=True)
+                self._poller.start()
+
+    def _run_poller(self):
+        while not self._stop.wait(POLL_INTERVAL_SECONDS):
+            self.poll_all()
+
+    def stop(self):
+        self._stop.set()
+
+
+def _pooled_client(user_id):
+    # Polling isn't a use of the client: it mustn't keep idle users' clients pooled or refresh their tokens.
+    from auth_credentials_store import client_pool
+    return client_pool.pool.peek(user_id)
+
+
+cache = AsanaResourceCache(client_for_user=_pooled_client)
@@ -0,0 +1,75 @@
+import pytest
+from asana_service.resource_cache import AsanaResourceCache
+from benchmarks.fake_clock import FakeClock
+
+
+class Fetches:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, value):
+        def fetch():
+            self.count += 1
+            return value
+        return fetch
+
+
+def test_warm_reads_make_no_calls():
+    cache = AsanaResourceCache()
+    fetches = Fetches()
+    for _ in range(10):
+        assert cache.get("user", "task", "1", fetches({'gid': "1"})) == {'gid': "1"}
+    assert fetches.count == 1
+    assert (cache.hits, cache.misses) == (9, 1)
+
+
+def test_entries_are_per_user():
+    cache = AsanaResourceCache()
+    fetches = Fetches()
+    cache.get("alice", "task", "1", fetches("alice's view"))
+    assert cache.get("bob", "task", "1", fetches("bob's view")) == "bob's view"
+    assert fetches.count == 2
+
+
+def test_entries_expire_after_their_kind_ttl():
+    clock = FakeClock()
+    cache = AsanaResourceCache(clock=clock)
+    fetches = Fetches()
+    cache.get("user", "task", "1", fetches("task"))
+    cache.get("user", "workspace", "2", fetches("workspace"))
+    clock.now = 7200
+    cache.get("user", "task", "1", fetches("task"))
+    cache.get("user", "workspace", "2", fetches("workspace"))
+    assert fetches.count == 3
+
+
+def test_only_projects_and_tasks_are_watched():
+    cache = AsanaResourceCache()
+    cache.get("user", "task", "1", lambda: {})
+    cache.get("user", "project", "2", lambda: {})
+    cache.get("user", "workspace", "3", lambda: {})
+    assert cache.watched("user") == ["1", "2"]
+
+
+def test_events_evict_only_what_changed():
+    asana = pytest.importorskip("asana")
+    from benchmarks.fake_asana import FakeAsanaServer
+    server = FakeAsanaServer().start()
+    base_url = asana.Client.DEFAULT_OPTIONS['base_url']
+    try:
+        server.use_for_asana_clients()
+        client = asana.Client.access_token("token")
+        cache = AsanaResourceCache()
+        fetches = Fetches()
+        for gid in ("11", "12"):
+            cache.get("user", "task", gid, fetches({'gid': gid}))
+        # The first poll only takes sync tokens.
+        assert cache.poll("user", client) == 0
+        server.change("story", "99", parent=("task", "11"))
+        assert cache.poll("user", client) == 1
+        cache.get("user", "task", "11", fetches({'gid': "11"}))
+        cache.get("user", "task", "12", fetches({'gid': "12"}))
+        assert fetches.count == 3
+    finally:
+        asana.Client.DEFAULT_OPTIONS['base_url'] = base_url
+        server.stop()
@@ -1,10 +1,10 @@
 from flask import Blueprint,render_template,request,make_response,redirect
 from flask import current_app as app
 from storage_service import store
-from environment_service.environment import Environment,get_environment
-from environment_service.utilities import utc_from_epoch_ms,utc_now
-from datetime import datetime
-import asana
+from environment_service.utilities import utc_from_epoch_ms
+from auth_credentials_store import client_pool
+from asana_service import resource_cache
+from metrics_service import metrics
 
 all_credentials = Blueprint('all_credentials', __name__, template_folder='templates')
 
@@ -20,7 +20,7 @@ def show_credentials_summary():
     if type(client) == str:
         return redirect(client)
     else:
-        return client.users.me()
+        return resource_cache.cache.me(user_id, client)
 
 @all_credentials.route("/asana_oauth_redirect", methods=['GET'])
 def exchange_authorization_code():
@@ -36,76 +36,27 @@ def exchange_authorization_code():
     resp.set_cookie("asana_user_id", user_id)
     return resp
 
-def exchange_refresh_token(client):
-    app.logger.debug("Exchanging refresh token")
-    user_id = request.cookies.get('asana_user_id')
-    # TODO: this feels like we're calling an internal method. Hm.
-    token = client.session.refresh_token(client.session.token_url, refresh_token=client.session.token['refresh_token'], client_id=client.session.client_id, client_secret = client.session.client_secret)
-    store.store_user_refresh_token(user_id, token['refresh_token'])
-    store.store_user_access_token(user_id, token['access_token'], utc_from_epoch_ms(token['expires_at']))
-    
-
 # NOT a flask route.
 # Helper method to get and store credentials from Asana
 def get_asana_client_for_code(authorization_code):
     app.logger.info("Exchanging authorization code for a token")
-    application_credentials = store.get_app_credentials()
-    environment = get_environment()
-    if environment == Environment.PRODUCTION:
-        redirect_uri = application_credentials['redirect_urls'][1]
-    if environment == Environment.DEVELOPMENT:
-        redirect_uri = application_credentials['redirect_urls'][0]
-    client = asana.Client.oauth(client_id = application_credentials['client_id'], client_secret = application_credentials['client_secret'], redirect_uri=redirect_uri)
-    token = client.session.fetch_token(code=authorization_code)
+    client = client_pool.pool.new_client()
+    with metrics.span("asana.fetch_token"):
+        token = client.session.fetch_token(code=authorization_code)
     user_id = client.session.token['data']['gid']
+    expire_time = utc_from_epoch_ms(token['expires_at'])
     store.store_user_refresh_token(user_id, token['refresh_token'])
-    store.store_user_access_token(user_id, token['access_token'], utc_from_epoch_ms(token['expires_at']))
+    store.store_user_access_token(user_id, token['access_token'], expire_time)
+    client_pool.pool.add(user_id, client, expire_time)
     return client
 
+@metrics.timed("asana.get_client_for_user")
 def get_asana_client_for_user(user_id):
-    # TODO: this is reauthing every time. Store this per user.
-    application_credentials = store.get_app_credentials()
-    environment = get_environment()
-    redirect_uri = None
-    client = None
-    if environment == Environment.PRODUCTION:
-        redirect_uri = application_credentials['redirect_urls'][1]
-    if environment == Environment.DEVELOPMENT:
-        redirect_uri = application_credentials['redirect_urls'][0]
-    # TODO: brittle. Don't make this dependent on the ordering.
-    # We could match on the base url in the redirect list, which might be better, but we need to have the env service anyway...
-    user_credentials = store.get_or_construct_user_credentials(user_id)
-    if 'access_token' in user_credentials:
-        if 'expire_time' in user_credentials and user_credentials['expire_time'] > utc_from_epoch_ms(utc_now().timestamp() + 3 * 60):
-            app.logger.debug(f"Valid access token found--logged in. Credentials expire: {user_credentials['expire_time']}")
-            # Access token is present and will be valid for some time
-            client = asana.Client.oauth(client_id = application_credentials['client_id'],
-                    client_secret = application_credentials['client_secret'],
-                    redirect_uri=redirect_uri,
-                    token = {
-                        "access_token": user_credentials['access_token'],
-                        "refresh_token": user_credentials['refresh_token'],
-                        "type": "bearer"
-                        }
-                    )
-        else:
-            # Exchange the refresh token again, then return
-            app.logger.debug("Access token expired")
-            client = asana.Client.oauth(client_id = application_credentials['client_id'],
-                    client_secret = application_credentials['client_secret'],
-                    redirect_uri=redirect_uri,
-                    token = {
-                        "refresh_token": user_credentials['refresh_token'],
-                        "type": "bearer"
-                        }
-                    )
-            exchange_refresh_token(client)
-    else:
+    client = client_pool.pool.get(user_id)
+    if client is None:
         app.logger.info("Full refresh of credentials from code: initial auth or previous auth token deleted")
         # This will start a second request that we want to be able to get the global variable for.
-        client = asana.Client.oauth(client_id = application_credentials['client_id'], client_secret = application_credentials['client_secret'], redirect_uri=redirect_uri)
-        (url, state) = client.session.authorization_url()
+        (url, state) = client_pool.pool.new_client().session.authorization_url()
         # TODO: this works, but isn't complete.
         return url
     return client
-
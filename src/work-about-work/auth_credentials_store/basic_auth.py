@@ -0,0 +1,54 @@
+"""
+HTTP basic auth for the app's own routes.
+
+Checking a password means a datastore read for the user's salted hash and then a deliberately slow key
+derivation, so credentials that have verified recently are remembered for a short while. They're remembered
+by a keyed digest rather than in plaintext, and forgotten as soon as this process writes a new hash.
+"""
+
+import hashlib
+import hmac
+import os
+from werkzeug.security import check_password_hash
+from storage_service import store
+from storage_service.cache import TTLCache
+from metrics_service import metrics
+
+# 1 salt for the app. Yes, I understand this is a bad salting scheme and it should be per user :)
+APP_RANDOM_SALT="16bea2eea75b1dcaf49f2760d526646b9f9b89f9"
+
+# How long, in seconds, a verified username / password pair is trusted without checking the hash again.
+VERIFIED_CREDENTIALS_TTL = 60
+VERIFIED_CREDENTIALS_CACHE_SIZE = 1024
+
+# Never leaves the process, so a digest in the cache can't be checked against guesses anywhere else.
+_digest_key = os.urandom(32)
+_verified_credentials = TTLCache(maxsize=VERIFIED_CREDENTIALS_CACHE_SIZE, default_ttl=VERIFIED_CREDENTIALS_TTL)
+
+def _credentials_digest(username, password):
+    message = username.encode('utf-8') + b"\0" + password.encode('utf-8')
+    return hmac.new(_digest_key, message, hashlib.sha256).digest()
+
+def _forget_on_hash_change(data_kind, key):
+    # Hash changes are rare, so dropping every verified pair is simpler than tracking which belong to whom.
+    if data_kind == "BasicAuthCredentials":
+        _verified_credentials.clear()
+
+store.add_write_listener(_forget_on_hash_change)
+
+@metrics.timed("basic_auth.verify_password")
+def verify_password(username, password, use_cache=True):
+    if not username:
+        return False
+    digest = _credentials_digest(username, password)
+    if use_cache and digest in _verified_credentials:
+        return True
+    salted_hash = store.get_basic_auth_hash(username)
+    with metrics.span("basic_auth.check_password_hash"):
+        verified = check_password_hash(salted_hash, password + APP_RANDOM_SALT)
+    if verified and use_cache:
+        _verified_credentials.set(digest, True)
+    return verified
+
+def clear_verified_credentials():
+    _verified_credentials.clear()
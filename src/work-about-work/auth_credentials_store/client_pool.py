@@ -0,0 +1,205 @@
+"""
+Live, authorized Asana clients kept per user for the life of the process.
+
+Building a client means reading credentials from the datastore and, near expiry, a token exchange with Asana.
+The pool does that once per user and keeps the client (and its HTTP session) around. A background thread
+refreshes tokens well before they expire so requests don't wait on a token exchange, and a refresh for a
+user is only ever in flight once: concurrent callers wait for it and share the result.
+"""
+
+import logging
+import threading
+from datetime import timedelta
+from storage_service import store
+from environment_service.environment import Environment,get_environment
+from environment_service.utilities import utc_from_epoch_ms,utc_now
+from metrics_service import metrics
+
+LOG = logging.getLogger('root')
+
+# The background refresher renews any token that expires within this window.
+BACKGROUND_REFRESH_MARGIN = timedelta(minutes=10)
+# A request only refreshes inline if the background refresher hasn't got to the token yet.
+REQUEST_REFRESH_MARGIN = timedelta(minutes=3)
+REFRESH_INTERVAL_SECONDS = 60
+# Clients nobody has asked for in this long are dropped rather than refreshed forever.
+IDLE_EVICTION = timedelta(hours=2)
+
+
+class _PooledClient:
+
+    def __init__(self, user_id, client, expire_time):
+        self.user_id = user_id
+        self.client = client
+        self.expire_time = expire_time
+        self.last_used = utc_now()
+        # Held for the duration of a refresh, so only one goes out per user.
+        self.refresh_lock = threading.Lock()
+
+    def expires_within(self, margin):
+        return self.expire_time is None or self.expire_time <= utc_now() + margin
+
+
+class AsanaClientPool:
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._user_locks = {}
+        self._application_credentials = None
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def application_credentials(self):
+        if self._application_credentials is None:
+            self._application_credentials = store.get_app_credentials()
+        return self._application_credentials
+
+    def _redirect_uri(self, application_credentials):
+        # TODO: brittle. Don't make this dependent on the ordering.
+        # We could match on the base url in the redirect list, which might be better, but we need to have the env service anyway...
+        environment = get_environment()
+        if environment == Environment.PRODUCTION:
+            return application_credentials['redirect_urls'][1]
+        if environment == Environment.DEVELOPMENT:
+            return application_credentials['redirect_urls'][0]
+        return None
+
+    def new_client(self, token=None, application_credentials=None):
+        '''
+        An unpooled client for the app, authorized with the given token if there is one.
+        '''
+        if application_credentials is None:
+            application_credentials = self.application_credentials()
+        kwargs = {}
+        if token is not None:
+            kwargs['token'] = token
+        # Imported here rather than at the top so a cold start that never talks to Asana doesn't pay for it.
+        import asana
+        return asana.Client.oauth(client_id = application_credentials['client_id'],
+                client_secret = application_credentials['client_secret'],
+                redirect_uri = self._redirect_uri(application_credentials),
+                **kwargs)
+
+    def _lock_for(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    def get(self, user_id):
+        '''
+        The authorized client for a user, or None if the user has never authorized the app
+        (or their access token has been deleted) and needs to go through the OAuth flow.
+        '''
+        entry = self._clients.get(user_id)
+        if entry is None:
+            # Concurrent first requests for the same user build one client between them.
+            with self._lock_for(user_id):
+                entry = self._clients.get(user_id)
+                if entry is None:
+                    entry = self._load(user_id)
+                    if entry is None:
+                        # Nothing to pool, so nothing to keep a lock for.
+                        with self._lock:
+                            self._user_locks.pop(user_id, None)
+                        return None
+                    self._clients[user_id] = entry
+        entry.last_used = utc_now()
+        self._ensure_refresher()
+        if entry.expires_within(REQUEST_REFRESH_MARGIN):
+            LOG.debug("Access token expired")
+            self._refresh(entry, REQUEST_REFRESH_MARGIN)
+        return entry.client
+
+    def peek(self, user_id):
+        '''
+        The user's pooled client if there is one with a usable token, else None. Unlike get(), this doesn't count
+        as a use, so it doesn't keep an idle client in the pool, and it never loads or refreshes a client.
+        '''
+        entry = self._clients.get(user_id)
+        if entry is None or entry.expires_within(REQUEST_REFRESH_MARGIN):
+            return None
+        return entry.client
+
+    def _load(self, user_id):
+        application_credentials, user_credentials = store.get_app_and_user_credentials(user_id)
+        self._application_credentials = application_credentials
+        if 'access_token' not in user_credentials:
+            return None
+        client = self.new_client(token = {
+                "access_token": user_credentials['access_token'],
+                "refresh_token": user_credentials['refresh_token'],
+                "type": "bearer"
+                }, application_credentials=application_credentials)
+        return _PooledClient(user_id, client, user_credentials.get('expire_time'))
+
+    def add(self, user_id, client, expire_time):
+        '''
+        Pool a client that was just authorized some other way, e.g. by exchanging an authorization code.
+        '''
+        self._clients[user_id] = _PooledClient(user_id, client, expire_time)
+        self._ensure_refresher()
+
+    def warm_up(self):
+        '''
+        Do the one-off work of building clients ahead of the first request that needs one: import the
+        Asana library, read the app credentials and build a client's HTTP session.
+        '''
+        self.new_client()
+
+    def evict(self, user_id):
+        with self._lock:
+            self._clients.pop(user_id, None)
+            # A get() that's loading the user's client with the old lock still finishes; at worst a concurrent
+            # one loads it again under a new lock.
+            self._user_locks.pop(user_id, None)
+
+    def _refresh(self, entry, margin):
+        with entry.refresh_lock:
+            # Whoever held the lock before us may have already done the work.
+            if not entry.expires_within(margin):
+                return
+            LOG.debug("Exchanging refresh token for user %s", entry.user_id)
+            session = entry.client.session
+            # TODO: this feels like we're calling an internal method. Hm.
+            with metrics.span("asana.refresh_token"):
+                token = session.refresh_token(session.token_url, refresh_token=session.token['refresh_token'], client_id=session.client_id, client_secret=session.client_secret)
+            expire_time = utc_from_epoch_ms(token['expires_at'])
+            store.store_user_refresh_token(entry.user_id, token['refresh_token'])
+            store.store_user_access_token(entry.user_id, token['access_token'], expire_time)
+            entry.expire_time = expire_time
+
+    def refresh_expiring(self, margin=BACKGROUND_REFRESH_MARGIN):
+        '''
+        One pass of the background refresher: renew every token expiring within the margin
+        and drop clients that have gone idle.
+        '''
+        idle_cutoff = utc_now() - IDLE_EVICTION
+        for entry in list(self._clients.values()):
+            if entry.last_used < idle_cutoff:
+                LOG.debug("Dropping idle Asana client for user %s", entry.user_id)
+                self.evict(entry.user_id)
+                continue
+            if entry.expires_within(margin):
+                try:
+                    self._refresh(entry, margin)
+                except Exception:
+                    # Leave it to the next pass (or the next request) to try again.
+                    LOG.exception("Background token refresh failed for user %s", entry.user_id)
+
+    def _ensure_refresher(self):
+        if self._refresher is not None:
+            return
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._run_refresher, name="asana-token-refresher", daemon=True)
+                self._refresher.start()
+
+    def _run_refresher(self):
+        while not self._stop.wait(REFRESH_INTERVAL_SECONDS):
+            self.refresh_expiring()
+
+    def stop(self):
+        self._stop.set()
+
+
+pool = AsanaClientPool()
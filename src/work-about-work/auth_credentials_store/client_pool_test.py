@@ -0,0 +1,105 @@
+import threading
+from datetime import timedelta
+import pytest
+
+asana = pytest.importorskip("asana")
+datastore = pytest.importorskip("google.cloud.datastore")
+
+from storage_service import store
+from auth_credentials_store import client_pool
+from environment_service.utilities import utc_now
+from benchmarks.fake_asana import FakeAsanaServer
+from benchmarks.fake_datastore import FakeDatastoreClient
+
+USER_ID = "1000000000000001"
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    client = FakeDatastoreClient()
+    app_credentials = datastore.Entity(key=client.key("OauthCredentials", store._app_credentials_key()))
+    app_credentials.update({'client_secret': "secret", 'redirect_urls': ["http://localhost:8080/asana_oauth_redirect", "https://example.com/asana_oauth_redirect"]})
+    user_credentials = datastore.Entity(key=client.key("OauthCredentials", store._user_credentials_key_for_id(USER_ID)))
+    user_credentials.update({'refresh_token': "refresh", 'access_token': "access", 'expire_time': utc_now() - timedelta(minutes=1)})
+    client._load(app_credentials)
+    client._load(user_credentials)
+    # Everything the fakes change is put back afterwards by monkeypatch.
+    monkeypatch.setattr(store, "_client", store._client)
+    monkeypatch.setattr(asana.session.AsanaOAuth2Session, "token_url", asana.session.AsanaOAuth2Session.token_url)
+    monkeypatch.setitem(asana.Client.DEFAULT_OPTIONS, 'base_url', asana.Client.DEFAULT_OPTIONS['base_url'])
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    store.set_datastore_client(client)
+    server = FakeAsanaServer().start()
+    server.use_for_asana_clients()
+    pool = client_pool.AsanaClientPool()
+    # Refresh by hand rather than from the background thread.
+    pool._ensure_refresher = lambda: None
+    yield pool, server, client
+    server.stop()
+    # Entities cached from the fake client mustn't outlive it.
+    store.clear_entity_cache()
+
+
+def _stored_access_token(client):
+    return client._stored(client.key("OauthCredentials", store._user_credentials_key_for_id(USER_ID)))['access_token']
+
+
+def test_concurrent_gets_share_one_refresh(fakes):
+    pool, server, client = fakes
+    clients = []
+    def get():
+        clients.append(pool.get(USER_ID))
+    threads = [threading.Thread(target=get) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.requests == 1
+    assert len(set(map(id, clients))) == 1
+    assert _stored_access_token(client) == "fake_access_1"
+
+
+def test_tokens_are_renewed_before_they_expire(fakes):
+    pool, server, client = fakes
+    pool.get(USER_ID)
+    entry = pool._clients[USER_ID]
+    # Inside the background margin, outside the one requests refresh at.
+    entry.expire_time = utc_now() + timedelta(minutes=5)
+    pool.get(USER_ID)
+    assert server.requests == 1
+    pool.refresh_expiring()
+    assert server.requests == 2
+    assert entry.expire_time > utc_now() + client_pool.BACKGROUND_REFRESH_MARGIN
+    assert _stored_access_token(client) == "fake_access_2"
+
+
+def test_idle_clients_are_evicted_not_refreshed(fakes):
+    pool, server, client = fakes
+    pool.get(USER_ID)
+    entry = pool._clients[USER_ID]
+    entry.expire_time = utc_now()
+    entry.last_used = utc_now() - client_pool.IDLE_EVICTION - timedelta(minutes=1)
+    pool.refresh_expiring()
+    assert USER_ID not in pool._clients
+    assert server.requests == 1
+
+
+def test_peeking_doesnt_count_as_use(fakes):
+    pool, server, client = fakes
+    assert pool.peek(USER_ID) is None
+    pool.get(USER_ID)
+    entry = pool._clients[USER_ID]
+    last_used = entry.last_used = utc_now() - timedelta(hours=1)
+    assert pool.peek(USER_ID) is entry.client
+    assert entry.last_used == last_used
+    entry.expire_time = utc_now()
+    assert pool.peek(USER_ID) is None
+    assert server.requests == 1
+
+
+def test_evicted_users_dont_keep_a_lock(fakes):
+    pool, server, client = fakes
+    pool.get(USER_ID)
+    assert USER_ID in pool._user_locks
+    pool.evict(USER_ID)
+    assert USER_ID not in pool._user_locks
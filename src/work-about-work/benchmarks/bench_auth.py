@@ -0,0 +1,48 @@
+"""
+Latency of verifying HTTP basic auth credentials with the verified-credential cache on and off.
+
+Run from src/work-about-work:
+
+    python -m benchmarks.bench_auth [--iterations N] [--latency-ms MS] [--output results.jsonl]
+
+The user's salted hash lives in the in-memory datastore stand-in, with a simulated per-round-trip latency.
+The report is printed as JSON and, with --output, appended as one line to the given file.
+"""
+
+import argparse
+from werkzeug.security import generate_password_hash
+from storage_service import store
+from auth_credentials_store import basic_auth
+from benchmarks import report
+from benchmarks.fake_datastore import FakeDatastoreClient
+
+USERNAME = "benchmark_user"
+PASSWORD = "correct horse battery staple"
+
+
+def run(name, iterations, use_cache):
+    basic_auth.clear_verified_credentials()
+    store.clear_entity_cache()
+    def verify():
+        assert basic_auth.verify_password(USERNAME, PASSWORD, use_cache=use_cache)
+    return report.measure(name, verify, iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Simulated datastore round-trip latency")
+    parser.add_argument("--output", help="Append the report to this file as a JSON line")
+    args = parser.parse_args()
+
+    store.set_datastore_client(FakeDatastoreClient(latency_seconds=args.latency_ms / 1000))
+    store.set_basic_auth_hash(USERNAME, generate_password_hash(PASSWORD + basic_auth.APP_RANDOM_SALT))
+    results = [
+            run("uncached", args.iterations, use_cache=False),
+            run("cached", args.iterations, use_cache=True),
+            ]
+    report.report("auth", results, output=args.output, latency_ms=args.latency_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Cold-start time of the app: importing main in a fresh interpreter under python -X importtime, then serving
+/ping, the way an App Engine instance starts up before its first request.
+
+Run from src/work-about-work:
+
+    python -m benchmarks.bench_startup [--runs N] [--top N] [--max-import-ms MS]
+
+Each run is a new process, so nothing is already imported or cached. The report has the median total import
+time, wall time to the first /ping response, and the slowest imports of the median run by cumulative time.
+With --max-import-ms the exit status is non-zero if the median import time is over budget, so it can gate a
+CI-style run.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Prints the wall time, in ms, from before `import main` to the first /ping response.
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+import main
+main.app.test_client().get('/ping')
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def _parse_importtime(stderr):
+    """
+    [(module, depth, self_us, cumulative_us)] from -X importtime output, in the order the imports finished.
+    Depth 0 is an import made directly by the script; each level of nesting is indented two more spaces.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((module.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def run_once():
+    # Measured as a development instance, so nothing tries to set up Cloud Logging.
+    environment = dict(os.environ)
+    environment.pop('GAE_INSTANCE', None)
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+            cwd=APP_DIR, env=environment, capture_output=True, text=True, check=True)
+    imports = _parse_importtime(completed.stderr)
+    # The cumulative times of the top-level imports add up to the whole.
+    return {
+            'import_ms': sum(cumulative for _, depth, _, cumulative in imports if depth == 0) / 1000,
+            'first_response_ms': float(completed.stdout.strip().splitlines()[-1]),
+            'imports': imports,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="How many of the slowest imports to list")
+    parser.add_argument("--max-import-ms", type=float, default=None, help="Fail if the median import time is over this")
+    args = parser.parse_args()
+
+    runs = sorted((run_once() for _ in range(args.runs)), key=lambda run: run['import_ms'])
+    median_run = runs[len(runs) // 2]
+    slowest = sorted(median_run['imports'], key=lambda entry: entry[3], reverse=True)[:args.top]
+    result = {
+            'runs': args.runs,
+            'median_import_ms': statistics.median(run['import_ms'] for run in runs),
+            'median_first_response_ms': statistics.median(run['first_response_ms'] for run in runs),
+            'slowest_imports': [{'module': module, 'cumulative_ms': cumulative / 1000, 'self_ms': self_us / 1000} for module, _, self_us, cumulative in slowest],
+            }
+    print(json.dumps(result, indent=2))
+    if args.max_import_ms is not None and result['median_import_ms'] > args.max_import_ms:
+        print(f"Median import time {result['median_import_ms']:.1f}ms is over the {args.max_import_ms:.1f}ms budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
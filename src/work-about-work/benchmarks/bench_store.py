@@ -0,0 +1,114 @@
+"""
+Compare credential lookups done the old way (one key-filter query per entity) against the store's direct
+gets, which resolve the app and user credentials together in one get_multi.
+
+Run from src/work-about-work:
+
+    python -m benchmarks.bench_store [--iterations N] [--latency-ms MS] [--output results.jsonl]
+
+If DATASTORE_EMULATOR_HOST is set the benchmark runs against the emulator; otherwise it uses the in-memory
+stand-in with a simulated per-round-trip latency. The report is printed as JSON and, with --output, appended
+as one line to the given file.
+"""
+
+import argparse
+import os
+from google.cloud import datastore
+from storage_service import store
+from benchmarks import report
+from benchmarks.fake_datastore import FakeDatastoreClient
+
+USER_ID = "benchmark_user"
+
+
+class CountingClient:
+    """Wraps a real (emulator) client so round trips can be counted the same way as the stand-in's."""
+
+    def __init__(self, client):
+        self._client = client
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get(self, key):
+        self.round_trips += 1
+        return self._client.get(key)
+
+    def get_multi(self, keys):
+        self.round_trips += 1
+        return self._client.get_multi(keys)
+
+    def query(self, kind):
+        query = self._client.query(kind=kind)
+        fetch = query.fetch
+        def counted_fetch(*args, **kwargs):
+            self.round_trips += 1
+            return fetch(*args, **kwargs)
+        query.fetch = counted_fetch
+        return query
+
+
+def _client(latency_seconds):
+    if 'DATASTORE_EMULATOR_HOST' in os.environ:
+        return CountingClient(datastore.Client(namespace="credentials"))
+    return FakeDatastoreClient(latency_seconds=latency_seconds)
+
+
+def _seed(client):
+    app_credentials = datastore.Entity(key=client.key("OauthCredentials", store._app_credentials_key()))
+    app_credentials.update({'client_secret': "benchmark_secret", 'redirect_urls': ["http://localhost:8080/asana_oauth_redirect", "https://example.com/asana_oauth_redirect"]})
+    user_credentials = datastore.Entity(key=client.key("OauthCredentials", store._user_credentials_key_for_id(USER_ID)))
+    user_credentials.update({'refresh_token': "refresh", 'access_token': "access"})
+    if isinstance(client, FakeDatastoreClient):
+        client._load(app_credentials)
+        client._load(user_credentials)
+    else:
+        client.put_multi([app_credentials, user_credentials])
+
+
+def _query_by_key(client, data_kind, key):
+    # The lookup as it was before direct gets: a key-filtered query, materialized to a list.
+    query = client.query(kind=data_kind)
+    query.key_filter(client.key(data_kind, key), '=')
+    return list(query.fetch())
+
+
+def legacy_lookup(client):
+    _query_by_key(client, "OauthCredentials", store._app_credentials_key())
+    _query_by_key(client, "OauthCredentials", store._user_credentials_key_for_id(USER_ID))
+
+
+def batched_lookup(client):
+    # Cold cache every time so this measures datastore round trips, not the in-process cache.
+    store.clear_entity_cache()
+    store.get_app_and_user_credentials(USER_ID)
+
+
+def run(name, lookup, client, iterations):
+    client.round_trips = 0
+    result = report.measure(name, lambda: lookup(client), iterations, warmup=0)
+    result['round_trips_per_lookup'] = client.round_trips / iterations
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Simulated round-trip latency for the in-memory stand-in")
+    parser.add_argument("--output", help="Append the report to this file as a JSON line")
+    args = parser.parse_args()
+
+    client = _client(args.latency_ms / 1000)
+    _seed(client)
+    store.set_datastore_client(client)
+    results = [
+            run("query_per_key", legacy_lookup, client, args.iterations),
+            run("get_multi", batched_lookup, client, args.iterations),
+            ]
+    report.report("store", results, output=args.output,
+            latency_ms=args.latency_ms, datastore="emulator" if 'DATASTORE_EMULATOR_HOST' in os.environ else "in-memory")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+A local stand-in for Asana's OAuth token endpoint and the task calls the app makes, so token exchanges, refreshes
+and follow-up creation can be benchmarked and tested offline.
+
+The server answers POST /-/oauth_token for the authorization_code and refresh_token grants the way Asana does,
+with a fresh bearer token good for an hour. It also answers GET /api/1.0/tasks/<gid>, POST /api/1.0/tasks and
+GET /api/1.0/events, which reports whatever change() has recorded since the caller's sync token.
+Every answer comes after an optional simulated latency. With rate_limit_every=N, every Nth API call is turned
+away with a 429 and a Retry-After, the way Asana enforces its rate limits. use_for_asana_clients() points Asana
+clients in this process at it instead of app.asana.com.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN_PATH = "/-/oauth_token"
+API_PATH = "/api/1.0"
+
+
+class FakeAsanaServer:
+
+    def __init__(self, latency_seconds=0.0, user_gid="1000000000000001", rate_limit_every=None, retry_after_seconds=1):
+        self.latency_seconds = latency_seconds
+        self.user_gid = user_gid
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_seconds = retry_after_seconds
+        self.requests = 0
+        self.api_requests = 0
+        self.rate_limited = 0
+        # Tasks created through the API, in order.
+        self.created_tasks = []
+        self._tokens = itertools.count(1)
+        self._task_gids = itertools.count(2000000000000001)
+        # Events recorded by change(), in order; a sync token is an index into this list.
+        self.events = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def token_url(self):
+        return self.base_url + TOKEN_PATH
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                path = url.path
+                if path == API_PATH + "/events":
+                    if fake._admit(self):
+                        self._send(*fake._events(parse_qs(url.query)))
+                    return
+                if not path.startswith(API_PATH + "/tasks/"):
+                    self.send_error(404)
+                    return
+                if not fake._admit(self):
+                    return
+                self._send(200, {'data': fake._task(path.rsplit("/", 1)[-1])})
+
+            def do_POST(self):
+                if self.path.startswith(API_PATH + "/tasks"):
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+                    if not fake._admit(self):
+                        return
+                    self._send(201, {'data': fake._create_task(body.get('data', {}))})
+                    return
+                if self.path != TOKEN_PATH:
+                    self.send_error(404)
+                    return
+                form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                grant_type = form.get('grant_type', [None])[0]
+                if grant_type not in ('authorization_code', 'refresh_token'):
+                    self._send(400, {'error': 'unsupported_grant_type'})
+                    return
+                self._send(200, fake._token())
+
+            def _send(self, status, body, headers=None):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _admit(self, handler):
+        """
+        Count an API call and answer it with a 429 if it's one to turn away. False if it was turned away.
+        """
+        with self._lock:
+            self.api_requests += 1
+            limited = self.rate_limit_every and self.api_requests % self.rate_limit_every == 0
+            if limited:
+                self.rate_limited += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if limited:
+            handler._send(429, {'errors': [{'message': "Rate limit enforced"}]}, {'Retry-After': str(self.retry_after_seconds)})
+            return False
+        return True
+
+    def _task(self, gid):
+        return {'gid': gid, 'name': f"Task {gid}", 'permalink_url': f"https://app.asana.com/0/0/{gid}/f"}
+
+    def _create_task(self, params):
+        with self._lock:
+            task = dict(params, gid=str(next(self._task_gids)))
+            self.created_tasks.append(task)
+        return dict(task, permalink_url=f"https://app.asana.com/0/0/{task['gid']}/f")
+
+    def change(self, resource_type, gid, parent=None, action="changed"):
+        """
+        Record a change for the Events API to report, with parent as (resource_type, gid) if given.
+        """
+        event = {'action': action, 'resource': {'gid': gid, 'resource_type': resource_type}, 'parent': None}
+        if parent is not None:
+            event['parent'] = {'gid': parent[1], 'resource_type': parent[0]}
+        with self._lock:
+            self.events.append(event)
+
+    def _events(self, query):
+        resource = query.get('resource', [None])[0]
+        sync = query.get('sync', [None])[0]
+        with self._lock:
+            now = len(self.events)
+            if sync is None:
+                # Like Asana: no token means a 412 carrying one to start from.
+                return 412, {'errors': [{'message': "Sync token invalid or too old"}], 'sync': str(now)}
+            events = [event for event in self.events[int(sync):]
+                    if resource in (event['resource']['gid'], (event['parent'] or {}).get('gid'))]
+        return 200, {'data': events, 'sync': str(now), 'has_more': False}
+
+    def _token(self):
+        with self._lock:
+            self.requests += 1
+            number = next(self._tokens)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return {
+                'access_token': f"fake_access_{number}",
+                'refresh_token': f"fake_refresh_{number}",
+                'token_type': "bearer",
+                'expires_in': 3600,
+                'data': {'gid': self.user_gid, 'name': "Benchmark User", 'email': "benchmark@example.com"},
+                }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-asana", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def use_for_asana_clients(self):
+        """
+        Send token requests and API calls from every Asana client in this process here. The server speaks
+        plain HTTP, which oauthlib refuses unless told otherwise.
+        """
+        import asana
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        asana.session.AsanaOAuth2Session.token_url = self.token_url
+        asana.Client.DEFAULT_OPTIONS['base_url'] = self.base_url + API_PATH
@@ -0,0 +1,12 @@
+"""
+A clock that only moves when it's told to, for testing code that takes a clock as an argument.
+"""
+
+
+class FakeClock:
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,82 @@
+"""
+An in-memory stand-in for the Datastore emulator that speaks the parts of the google.cloud.datastore client API
+the store module uses. Every call that would be an RPC against the real service counts as a round trip and
+optionally sleeps for a simulated network latency, so benchmarks can compare access patterns without a network.
+"""
+
+import threading
+import time
+from google.cloud import datastore
+
+
+class FakeDatastoreClient:
+
+    def __init__(self, namespace="credentials", latency_seconds=0.0, project="benchmark"):
+        self.namespace = namespace
+        self.project = project
+        self.latency_seconds = latency_seconds
+        self.round_trips = 0
+        self._entities = {}
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def _stored(self, key):
+        entity = self._entities.get(key.flat_path)
+        if entity is None:
+            return None
+        copy = datastore.Entity(key=entity.key)
+        copy.update(entity)
+        return copy
+
+    def key(self, *path):
+        return datastore.Key(*path, project=self.project, namespace=self.namespace)
+
+    def get(self, key):
+        self._round_trip()
+        return self._stored(key)
+
+    def get_multi(self, keys):
+        self._round_trip()
+        return [entity for entity in map(self._stored, keys) if entity is not None]
+
+    def put(self, entity):
+        self._round_trip()
+        self._load(entity)
+
+    def put_multi(self, entities):
+        self._round_trip()
+        for entity in entities:
+            self._load(entity)
+
+    def query(self, kind):
+        return FakeQuery(self, kind)
+
+    def _load(self, entity):
+        """Store an entity without counting a round trip; used to seed fixtures."""
+        copy = datastore.Entity(key=entity.key)
+        copy.update(entity)
+        self._entities[entity.key.flat_path] = copy
+
+
+class FakeQuery:
+
+    def __init__(self, client, kind):
+        self._client = client
+        self._kind = kind
+        self._key = None
+
+    def key_filter(self, key, operator='='):
+        assert operator == '=', "Only equality key filters are supported"
+        self._key = key
+
+    def fetch(self):
+        self._client._round_trip()
+        if self._key is not None:
+            entity = self._client._stored(self._key)
+            return iter([entity] if entity is not None else [])
+        return iter([self._client._stored(entity.key) for entity in list(self._client._entities.values()) if entity.key.kind == self._kind])
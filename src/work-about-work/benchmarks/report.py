@@ -0,0 +1,62 @@
+"""
+Timing and reporting shared by the benchmark suite, so every run reports the same machine-readable shape:
+
+    {"suite": ..., "started": ..., "python": ..., "results": [{"name", "iterations", "throughput_per_second",
+     "mean_ms", "p50_ms", "p99_ms", "max_ms"}, ...]}
+
+With an output path the report is also appended to it as one JSON line, so runs can be compared over time.
+"""
+
+import datetime
+import json
+import platform
+import statistics
+import time
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def measure(name, operation, iterations, warmup=3, setup=None):
+    """
+    Run operation() iterations times after warmup untimed runs and summarize the latencies.
+    setup(), if given, runs untimed before every call.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        operation()
+    latencies = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+            'name': name,
+            'iterations': iterations,
+            'throughput_per_second': iterations / total if total > 0 else None,
+            'mean_ms': statistics.mean(latencies) * 1000,
+            'p50_ms': _percentile(latencies, 0.5) * 1000,
+            'p99_ms': _percentile(latencies, 0.99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            }
+
+
+def report(suite, results, output=None, **details):
+    document = {
+            'suite': suite,
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            **details,
+            'results': results,
+            }
+    print(json.dumps(document, indent=2))
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(document) + '\n')
+    return document
@@ -0,0 +1,119 @@
+"""
+The offline benchmark suite for work-about-work: the basic auth path, credential lookups, Asana token refreshes and
+whole requests through the app, with throughput and p50 / p99 latency for each.
+
+Run from src/work-about-work:
+
+    python -m benchmarks.suite [--iterations N] [--latency-ms MS] [--output results.jsonl]
+
+Nothing leaves the machine. The datastore is the in-memory stand-in (or the emulator, if DATASTORE_EMULATOR_HOST
+is set) and Asana's token endpoint is a local fake server, each with the same simulated round-trip latency.
+The report is printed as JSON and, with --output, appended as one line to the given file.
+"""
+
+import argparse
+import base64
+import logging
+import os
+import sys
+from google.cloud import datastore
+from werkzeug.security import generate_password_hash
+from logging_service import pipeline
+from benchmarks import report
+from benchmarks.fake_asana import FakeAsanaServer
+from benchmarks.fake_datastore import FakeDatastoreClient
+
+USERNAME = "benchmark_user"
+PASSWORD = "correct horse battery staple"
+USER_ID = "1000000000000001"
+
+
+def _seed(client):
+    from storage_service import store
+    from auth_credentials_store import basic_auth
+    app_credentials = datastore.Entity(key=client.key("OauthCredentials", store._app_credentials_key()))
+    app_credentials.update({'client_secret': "benchmark_secret", 'redirect_urls': ["http://localhost:8080/asana_oauth_redirect", "https://example.com/asana_oauth_redirect"]})
+    user_credentials = datastore.Entity(key=client.key("OauthCredentials", store._user_credentials_key_for_id(USER_ID)))
+    user_credentials.update({'refresh_token': "refresh", 'access_token': "access"})
+    password_hash = datastore.Entity(key=client.key("BasicAuthCredentials", USERNAME))
+    password_hash.update({'salted_hash': generate_password_hash(PASSWORD + basic_auth.APP_RANDOM_SALT)})
+    client.put_multi([app_credentials, user_credentials, password_hash])
+
+
+def auth_benchmarks(iterations):
+    from auth_credentials_store import basic_auth
+    from storage_service import store
+    def cold():
+        basic_auth.clear_verified_credentials()
+        store.clear_entity_cache()
+    return [
+            report.measure("auth.verify_password.uncached", lambda: basic_auth.verify_password(USERNAME, PASSWORD), iterations, setup=cold),
+            report.measure("auth.verify_password.cached", lambda: basic_auth.verify_password(USERNAME, PASSWORD), iterations),
+            ]
+
+
+def credential_benchmarks(iterations):
+    from storage_service import store
+    return [
+            report.measure("store.get_app_and_user_credentials.cold", lambda: store.get_app_and_user_credentials(USER_ID), iterations, setup=store.clear_entity_cache),
+            report.measure("store.get_app_and_user_credentials.cached", lambda: store.get_app_and_user_credentials(USER_ID), iterations),
+            ]
+
+
+def asana_benchmarks(iterations, fake_asana):
+    from auth_credentials_store import client_pool
+    fake_asana.use_for_asana_clients()
+    pool = client_pool.AsanaClientPool()
+    client = pool.new_client(token={'access_token': "access", 'refresh_token': "refresh", 'type': "bearer"})
+    entry = client_pool._PooledClient(USER_ID, client, None)
+    def expire():
+        entry.expire_time = None
+    return [
+            report.measure("asana.refresh_token", lambda: pool._refresh(entry, client_pool.REQUEST_REFRESH_MARGIN), iterations, setup=expire),
+            ]
+
+
+def request_benchmarks(iterations):
+    import main
+    from auth_credentials_store import basic_auth
+    main.app.testing = True
+    http = main.app.test_client()
+    authorization = {'Authorization': "Basic " + base64.b64encode(f"{USERNAME}:{PASSWORD}".encode('utf-8')).decode('ascii')}
+    def get(path, **kwargs):
+        response = http.get(path, **kwargs)
+        assert response.status_code == 200, f"{path}: {response.status_code}"
+    return [
+            report.measure("http.ping", lambda: get('/ping'), iterations),
+            report.measure("http.index.uncached_auth", lambda: get('/', headers=authorization), iterations, setup=basic_auth.clear_verified_credentials),
+            report.measure("http.index.cached_auth", lambda: get('/', headers=authorization), iterations),
+            ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Simulated round-trip latency for the datastore and Asana stand-ins")
+    parser.add_argument("--output", help="Append the report to this file as a JSON line")
+    args = parser.parse_args()
+
+    # Before anything imports main: keep the app's logs out of the report on stdout.
+    pipeline.install(level=logging.WARNING, stream=sys.stderr)
+    from storage_service import store
+    latency_seconds = args.latency_ms / 1000
+    if 'DATASTORE_EMULATOR_HOST' in os.environ:
+        client = datastore.Client(namespace="credentials")
+    else:
+        client = FakeDatastoreClient(latency_seconds=latency_seconds)
+    _seed(client)
+    store.set_datastore_client(client)
+    fake_asana = FakeAsanaServer(latency_seconds=latency_seconds).start()
+    try:
+        results = auth_benchmarks(args.iterations) + credential_benchmarks(args.iterations) + asana_benchmarks(args.iterations, fake_asana) + request_benchmarks(args.iterations)
+    finally:
+        fake_asana.stop()
+    report.report("work-about-work", results, output=args.output,
+            latency_ms=args.latency_ms, datastore="emulator" if 'DATASTORE_EMULATOR_HOST' in os.environ else "in-memory")
+
+
+if __name__ == '__main__':
+    main()
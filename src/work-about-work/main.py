@@ -14,37 +14,17 @@
 
 # [START gae_python37_app]
 from flask import Flask
-import google.cloud.logging
-import logging, logging.config
+import logging
 from flask_httpauth import HTTPBasicAuth
-from werkzeug.security import generate_password_hash, check_password_hash
-from storage_service import store
+from auth_credentials_store import basic_auth
 from environment_service.environment import Environment,get_environment
+from logging_service import pipeline
+from metrics_service import metrics
 import os
 
-if get_environment() == Environment.PRODUCTION:
-    client = google.cloud.logging.Client()
-    client.setup_logging()
-
-logging.config.dictConfig({
-    'version': 1,
-    'formatters': {
-        'default': {
-            'format': '[%(asctime)s] %(levelname)s %(filename)s:%(lineno)d|| %(message)s',
-            }
-        },
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'level': 'DEBUG',
-            'stream': 'ext://sys.stdout',
-            }
-        },
-    'root': {
-        'level': 'DEBUG',
-        'handlers': ['console'],
-        }
-    })
+# Logs go through a queue to a background exporter so requests never wait on log output. In production
+# they're written as JSON lines, which App Engine turns into structured Cloud Logging entries.
+pipeline.install(level=logging.DEBUG, structured=get_environment() == Environment.PRODUCTION)
 
 logging.getLogger('root').info("Logging init!")
 
@@ -52,6 +32,8 @@ logging.getLogger('root').info("Logging init!")
 # called `app` in `main.py`.
 app = Flask(__name__)
 auth = HTTPBasicAuth()
+# Request latency histograms, and /metrics to read them from.
+metrics.install(app)
 
 
 from auth_credentials_store.all_credentials import all_credentials
@@ -62,11 +44,7 @@ app.register_blueprint(follow_up, url_prefix="/follow_up")
 
 @auth.verify_password
 def verify_password(username, password):
-    # 1 salt for the app. Yes, I understand this is a bad salting scheme and it should be per user :)
-    app_random_salt="16bea2eea75b1dcaf49f2760d526646b9f9b89f9"
-    if not username:
-        return False
-    return check_password_hash(store.get_basic_auth_hash(username), password + app_random_salt)
+    return basic_auth.verify_password(username, password)
 
 @app.route('/')
 @auth.login_required
@@ -78,6 +56,17 @@ def index():
 def info():
     return str(get_environment())
 
+@app.route('/_ah/warmup')
+def warmup():
+    # App Engine sends this to a new instance before routing traffic to it (see inbound_services in
+    # app.yaml). The datastore and Asana libraries are imported lazily, so this is where they get imported
+    # and their clients built, rather than in the first user's request.
+    from storage_service import store
+    from auth_credentials_store import client_pool
+    store.warm_up()
+    client_pool.pool.warm_up()
+    return '', 200
+
 if __name__ == '__main__':
     # This is used when running locally only. When deploying to Google App
     # Engine, a webserver process such as Gunicorn will serve the app. This
@@ -0,0 +1,183 @@
+"""
+In-process latency histograms and counters, served in the Prometheus text format at /metrics.
+
+install(app) times every request by route, method and status. span() and timed() time the pieces of a request
+worth knowing about (datastore round trips, Asana token exchanges, password hashing) into one histogram
+labelled by span name:
+
+    with metrics.span("datastore.get"):
+        ...
+
+    @metrics.timed("basic_auth.verify_password")
+    def verify_password(...):
+
+Recording a value is a couple of clock reads, a bisect and a short locked update, so this stays on in production.
+Everything is per process; Prometheus (or anything else that reads its format) adds instances up.
+"""
+
+import bisect
+import functools
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets: counts[i] is how many values were <= bounds[i] (and above the
+    bound before it); the last count is everything above the last bound. Not locked; the registry locks it.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def cumulative_counts(self):
+        running = 0
+        for count in self.counts:
+            running += count
+            yield running
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> {sorted label pairs -> Histogram or count}
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def render(self):
+        """
+        Everything recorded so far, in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.bounds + ('+Inf',), histogram.cumulative_counts()):
+                        lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.total}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+REGISTRY = Registry()
+REGISTRY.describe('http_request_duration_seconds', "Time to handle a request, by route, method and status")
+REGISTRY.describe('http_requests_total', "Requests handled, by route, method and status")
+REGISTRY.describe('span_duration_seconds', "Time spent in a named part of a request")
+REGISTRY.describe('span_errors_total', "Named parts of a request that raised")
+
+
+class span:
+    """
+    Times a block into span_duration_seconds{span=name}. Blocks that raise are also counted in span_errors_total.
+    """
+
+    __slots__ = ('name', '_started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        REGISTRY.observe('span_duration_seconds', time.perf_counter() - self._started, span=self.name)
+        if exc_type is not None:
+            REGISTRY.increment('span_errors_total', span=self.name)
+        return False
+
+
+def timed(name):
+    """
+    Decorator form of span().
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def install(app):
+    """
+    Time every request the app handles and serve everything recorded at /metrics.
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = getattr(g, '_metrics_started', None)
+        if started is not None:
+            # The route's pattern rather than the path, so e.g. every user's URL lands in the same series.
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            labels = dict(route=route, method=request.method, status=str(response.status_code))
+            REGISTRY.observe('http_request_duration_seconds', time.perf_counter() - started, **labels)
+            REGISTRY.increment('http_requests_total', **labels)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
@@ -0,0 +1,28 @@
+from metrics_service.metrics import Histogram, Registry
+
+
+def test_histogram_counts_values_into_upper_bounded_buckets():
+    histogram = Histogram((1, 2))
+    for value in (0, 1, 1.5, 3):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert list(histogram.cumulative_counts()) == [2, 3, 4]
+
+
+def test_render_is_prometheus_text():
+    registry = Registry()
+    registry.increment('http_requests_total', route="/ping", status=200)
+    registry.increment('http_requests_total', route="/ping", status=200)
+    registry.observe('span_duration_seconds', 0.002, span="datastore.get")
+    text = registry.render()
+    assert '# TYPE http_requests_total counter' in text
+    assert 'http_requests_total{route="/ping",status="200"} 2' in text
+    assert 'span_duration_seconds_bucket{span="datastore.get",le="0.0025"} 1' in text
+    assert 'span_duration_seconds_bucket{span="datastore.get",le="+Inf"} 1' in text
+    assert 'span_duration_seconds_count{span="datastore.get"} 1' in text
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.increment('errors_total', message='say "hi"\n')
+    assert 'errors_total{message="say \\"hi\\"\\n"} 1' in registry.render()
@@ -0,0 +1,345 @@
+"""
+Creating follow-up tasks for many Asana tasks at once, in the background.
+
+A bulk request is parsed into a de-duplicated list of task GIDs and handed to the job queue, which answers at once
+with a job to poll. Each follow-up takes two Asana calls, one to read the source task and one to create the
+follow-up. Calls wait in a queue per user and are handed to a small pool of workers as the user's rate limiter
+allows, so no worker is ever held up waiting for a user's next slot and one user's backlog doesn't delay anyone
+else's. When Asana answers 429, the limiter holds back that user's calls for as long as Retry-After says, and
+then the call is retried.
+
+Calls for different tasks go out concurrently, at most max_workers at a time, so a job finishes about as soon as
+the rate limit allows rather than after the sum of its round trips to Asana.
+"""
+
+import collections
+import functools
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from metrics_service import metrics
+from asana_service import resource_cache
+
+LOG = logging.getLogger('root')
+
+# The project follow-ups are created in. Without one, they're assigned to the user instead.
+FOLLOW_UP_PROJECT_GID = os.environ.get('FOLLOW_UP_PROJECT_GID')
+# Asana allows 150 requests a minute on free workspaces; paid ones get more.
+REQUESTS_PER_MINUTE = int(os.environ.get('ASANA_REQUESTS_PER_MINUTE', 150))
+MAX_TASKS_PER_JOB = 200
+# Finished jobs are kept this long for polling, then forgotten.
+FINISHED_JOB_SECONDS = 3600
+
+# https://app.asana.com/0/<project>/<task>[/f], https://app.asana.com/0/<project>/<task>/<subtask>[/f] and
+# https://app.asana.com/1/<workspace>/project/<project>/task/<task>; the task is the last GID in the path.
+_TASK_URL = re.compile(r"^https?://app\.asana\.com/(?:0/\d+(?:/\d+)+|1/\d+/.*/task/\d+)(?:/f)?/?(?:[?#].*)?$")
+_GID = re.compile(r"\d+")
+
+
+def parse_task_gids(urls, limit=None):
+    '''
+    ([task GIDs], [entries that aren't Asana task URLs or GIDs]) from Asana task URLs or bare GIDs,
+    each GID once, in the order first given. With a limit, parsing stops once there are more than limit GIDs.
+    '''
+    gids, seen, invalid = [], set(), []
+    for entry in urls:
+        entry = entry.strip()
+        if not entry:
+            continue
+        if _GID.fullmatch(entry):
+            gid = entry
+        elif _TASK_URL.match(entry):
+            path = re.split(r"[?#]", entry)[0]
+            gid = _GID.findall(path)[-1]
+        else:
+            invalid.append(entry)
+            continue
+        if gid not in seen:
+            seen.add(gid)
+            gids.append(gid)
+            if limit is not None and len(gids) > limit:
+                break
+    return gids, invalid
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited for {retry_after}s")
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    '''
+    Spaces out one user's requests to Asana and pauses them after a 429. It never waits itself: callers are told
+    how long until the next slot and come back then.
+    '''
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, clock=time.monotonic):
+        self.interval = 60.0 / requests_per_minute
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def try_acquire(self):
+        '''
+        Take this user's next request slot if it's due and return 0, or else return the seconds until it is.
+        '''
+        with self._lock:
+            now = self._clock()
+            if self._next_slot > now:
+                return self._next_slot - now
+            self._next_slot = now + self.interval
+            return 0
+
+    def pause(self, seconds):
+        '''
+        Hold back every request for this user for seconds, e.g. as Asana's Retry-After says.
+        '''
+        with self._lock:
+            self._next_slot = max(self._next_slot, self._clock() + seconds)
+
+
+class AsanaFollowUps:
+    '''
+    Creates follow-ups with an authorized Asana client, reporting 429s as RateLimited rather than having the
+    client sleep through them, so the limiter can hold back the user's other workers too. Source tasks are
+    read through the user's resource cache, so a task that's followed up again costs no read.
+    '''
+
+    def __init__(self, client, project_gid=None, user_id=None, cache=None):
+        self.client = client
+        self.project_gid = project_gid or FOLLOW_UP_PROJECT_GID
+        self.user_id = user_id
+        self.cache = cache or resource_cache.cache
+
+    def _call(self, method, *args, **kwargs):
+        import asana
+        try:
+            return method(*args, max_retries=0, **kwargs)
+        except asana.error.RateLimitEnforcedError as e:
+            # retry_after is False when the 429 came without a response to read it from.
+            raise RateLimited(1.0 if e.retry_after is False else e.retry_after)
+
+    def read_task(self, gid):
+        fetch = lambda: self._call(self.client.tasks.get_task, gid, fields=resource_cache.RESOURCE_FIELDS["task"])
+        if self.user_id is None:
+            return fetch()
+        return self.cache.task(self.user_id, self.client, gid, fetch)
+
+    def create_follow_up(self, task):
+        params = {'name': f"Follow up: {task['name']}", 'notes': task.get('permalink_url', "")}
+        if self.project_gid:
+            params['projects'] = [self.project_gid]
+        else:
+            params['assignee'] = "me"
+        with metrics.span("asana.create_task"):
+            return self._call(self.client.tasks.create_task, params, fields=["name", "permalink_url"])
+
+
+class FollowUpJob:
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+
+    def __init__(self, user_id, gids):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.gids = list(gids)
+        self.state = FollowUpJob.QUEUED
+        # source task GID -> {'state': 'created', 'follow_up': {...}} or {'state': 'failed', 'error': ...}
+        self.results = {}
+        self.rate_limited = 0
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def record(self, gid, result):
+        with self._lock:
+            self.results[gid] = result
+
+    def note_rate_limited(self):
+        with self._lock:
+            self.rate_limited += 1
+
+    def to_dict(self):
+        with self._lock:
+            results = dict(self.results)
+            rate_limited = self.rate_limited
+        return {
+                'job': self.id,
+                'state': self.state,
+                'total': len(self.gids),
+                'created': sum(1 for result in results.values() if result['state'] == "created"),
+                'failed': sum(1 for result in results.values() if result['state'] == "failed"),
+                'rate_limited': rate_limited,
+                'results': results,
+                }
+
+
+class JobQueue:
+    '''
+    Runs follow-up jobs in the background. Each Asana call waits in its user's queue until the user's limiter has a
+    slot for it, and then goes to a worker pool shared by every job, so the number of calls in flight is bounded
+    however many jobs are queued. One timer thread wakes each user's queue when its next slot is due.
+    '''
+
+    def __init__(self, max_workers=8, max_retries=5, requests_per_minute=REQUESTS_PER_MINUTE, clock=time.monotonic):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.requests_per_minute = requests_per_minute
+        self._clock = clock
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._limiters = {}
+        # user id -> calls waiting for a slot. A user with calls waiting is in _scheduled and has one wake up on its way.
+        self._waiting = {}
+        self._scheduled = set()
+        # (due time, sequence, user id) for the timer thread.
+        self._timers = []
+        self._timer_ready = threading.Condition(threading.Lock())
+        self._sequence = itertools.count()
+        self._timer_thread = None
+
+    def _pool(self):
+        # Started on first use rather than at import, so a forking server starts it in each worker.
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="follow-up")
+        return self._executor
+
+    def limiter(self, user_id):
+        with self._lock:
+            if user_id not in self._limiters:
+                self._limiters[user_id] = RateLimiter(self.requests_per_minute, clock=self._clock)
+            return self._limiters[user_id]
+
+    def submit(self, user_id, gids, follow_ups):
+        '''
+        Queue follow-ups for each task GID, created with follow_ups (an AsanaFollowUps). Returns the job to poll.
+        '''
+        job = FollowUpJob(user_id, gids)
+        with self._lock:
+            self._forget_finished()
+            self._jobs[job.id] = job
+        remaining = [len(job.gids)]
+        remaining_lock = threading.Lock()
+        def finish():
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    job.state = FollowUpJob.DONE
+                    job.finished_at = time.monotonic()
+                    summary = job.to_dict()
+                    LOG.info("Follow-up job %s finished: %d created, %d failed", job.id, summary['created'], summary['failed'])
+        if not job.gids:
+            job.state = FollowUpJob.DONE
+            job.finished_at = time.monotonic()
+        for gid in job.gids:
+            self._enqueue(user_id, functools.partial(self._call, job, gid, follow_ups, finish, 0, None))
+        return job
+
+    def _enqueue(self, user_id, call, first=False):
+        '''
+        Queue a call for the user's next free slot; first puts it ahead of the calls already waiting.
+        '''
+        with self._lock:
+            calls = self._waiting.setdefault(user_id, collections.deque())
+            if first:
+                calls.appendleft(call)
+            else:
+                calls.append(call)
+            if user_id in self._scheduled:
+                return
+            self._scheduled.add(user_id)
+        self._wake(user_id)
+
+    def _wake(self, user_id):
+        '''
+        Hand the user's next call to the pool if their slot is due, and set a timer for when the one after can go.
+        '''
+        wait = self.limiter(user_id).try_acquire()
+        if wait == 0:
+            with self._lock:
+                calls = self._waiting[user_id]
+                call = calls.popleft()
+                more = bool(calls)
+                if not more:
+                    del self._waiting[user_id]
+                    self._scheduled.discard(user_id)
+            self._pool().submit(call)
+            if not more:
+                return
+            wait = self.limiter(user_id).interval
+        self._later(wait, user_id)
+
+    def _later(self, seconds, user_id):
+        with self._timer_ready:
+            heapq.heappush(self._timers, (self._clock() + seconds, next(self._sequence), user_id))
+            self._timer_ready.notify()
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._run_timers, name="follow-up-timers", daemon=True)
+                self._timer_thread.start()
+
+    def _run_timers(self):
+        while True:
+            with self._timer_ready:
+                while not self._timers:
+                    self._timer_ready.wait()
+                wait = self._timers[0][0] - self._clock()
+                if wait > 0:
+                    self._timer_ready.wait(wait)
+                    continue
+                _, _, user_id = heapq.heappop(self._timers)
+            try:
+                self._wake(user_id)
+            except Exception:
+                LOG.exception("Couldn't hand on follow-up calls for user %s", user_id)
+
+    def _call(self, job, gid, follow_ups, finish, attempt, task):
+        '''
+        Make one of a task's calls: read the source task, or, once it's been read, create the follow-up.
+        Whatever comes next goes back in the user's queue rather than being waited for here.
+        '''
+        job.state = FollowUpJob.RUNNING
+        try:
+            if task is None:
+                task = follow_ups.read_task(gid)
+                # Ahead of the user's other waiting calls, so tasks that have been started finish first.
+                self._enqueue(job.user_id, functools.partial(self._call, job, gid, follow_ups, finish, attempt, task), first=True)
+                return
+            follow_up = follow_ups.create_follow_up(task)
+            job.record(gid, {'state': "created", 'follow_up': follow_up})
+        except RateLimited as e:
+            job.note_rate_limited()
+            self.limiter(job.user_id).pause(e.retry_after)
+            LOG.info("Asana rate limited user %s for %ss", job.user_id, e.retry_after)
+            if attempt < self.max_retries:
+                self._enqueue(job.user_id, functools.partial(self._call, job, gid, follow_ups, finish, attempt + 1, task), first=True)
+                return
+            job.record(gid, {'state': "failed", 'error': "Still rate limited after retrying"})
+        except Exception as e:
+            LOG.exception("Couldn't create a follow-up for task %s", gid)
+            job.record(gid, {'state': "failed", 'error': str(e)})
+        finish()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _forget_finished(self):
+        cutoff = time.monotonic() - FINISHED_JOB_SECONDS
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+
+jobs = JobQueue()
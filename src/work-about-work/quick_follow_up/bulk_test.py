@@ -0,0 +1,122 @@
+import threading
+import time
+import pytest
+from quick_follow_up import bulk
+from quick_follow_up.bulk import JobQueue, RateLimited, RateLimiter, parse_task_gids
+from benchmarks.fake_clock import FakeClock
+
+
+class FakeFollowUps:
+    def __init__(self, rate_limit_every=None):
+        self.rate_limit_every = rate_limit_every
+        self.calls = 0
+        self.created = []
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+            if self.rate_limit_every and self.calls % self.rate_limit_every == 0:
+                raise RateLimited(0.01)
+
+    def read_task(self, gid):
+        self._call()
+        if gid == "404":
+            raise KeyError(gid)
+        return {'gid': gid, 'name': f"Task {gid}"}
+
+    def create_follow_up(self, task):
+        self._call()
+        with self._lock:
+            self.created.append(task['gid'])
+        return {'gid': f"follow_up_{task['gid']}"}
+
+
+def _wait(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job.state != bulk.FollowUpJob.DONE and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return job.to_dict()
+
+
+def test_task_urls_are_parsed_and_deduplicated():
+    gids, invalid = parse_task_gids([
+        "https://app.asana.com/0/1199/1201/f",
+        "https://app.asana.com/0/1199/1201",
+        "https://app.asana.com/0/1199/1201/1202/f",
+        "https://app.asana.com/1/1100/project/1199/task/1203?focus=true",
+        "1204",
+        "",
+        "https://example.com/0/1/2",
+        ])
+    assert gids == ["1201", "1202", "1203", "1204"]
+    assert invalid == ["https://example.com/0/1/2"]
+
+
+def test_parsing_stops_past_the_limit():
+    gids, invalid = parse_task_gids(["1", "1", "2", "3", "4"], limit=2)
+    assert gids == ["1", "2", "3"]
+
+
+def test_rate_limiter_spaces_requests_and_pauses_after_a_429():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, clock=clock)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 1.0
+    clock.now = 1.0
+    assert limiter.try_acquire() == 0
+    limiter.pause(10)
+    assert limiter.try_acquire() == 10.0
+    clock.now = 11.0
+    assert limiter.try_acquire() == 0
+
+
+def test_jobs_create_a_follow_up_per_task():
+    follow_ups = FakeFollowUps()
+    job = JobQueue(max_workers=4, requests_per_minute=60000).submit("user", [str(gid) for gid in range(20)], follow_ups)
+    summary = _wait(job)
+    assert summary['state'] == "done"
+    assert summary['created'] == 20
+    assert sorted(follow_ups.created, key=int) == [str(gid) for gid in range(20)]
+
+
+def test_rate_limited_tasks_are_retried():
+    follow_ups = FakeFollowUps(rate_limit_every=3)
+    job = JobQueue(max_workers=2, requests_per_minute=60000).submit("user", ["1", "2", "3", "4"], follow_ups)
+    summary = _wait(job)
+    assert summary['created'] == 4
+    assert summary['rate_limited'] > 0
+
+
+def test_failures_are_reported_per_task():
+    job = JobQueue(max_workers=2, requests_per_minute=60000).submit("user", ["1", "404"], FakeFollowUps())
+    summary = _wait(job)
+    assert summary['created'] == 1
+    assert summary['results']["404"]['state'] == "failed"
+
+
+def test_one_users_backlog_doesnt_hold_up_another():
+    queue = JobQueue(max_workers=1, requests_per_minute=1200)
+    busy = queue.submit("busy", [str(gid) for gid in range(10)], FakeFollowUps())
+    quick = queue.submit("quick", ["1"], FakeFollowUps())
+    assert _wait(quick, timeout=1)['created'] == 1
+    assert busy.state != bulk.FollowUpJob.DONE
+    assert _wait(busy)['created'] == 10
+
+
+def test_follow_ups_against_the_fake_asana_server():
+    asana = pytest.importorskip("asana")
+    from benchmarks.fake_asana import FakeAsanaServer
+    server = FakeAsanaServer(rate_limit_every=5, retry_after_seconds=0).start()
+    base_url = asana.Client.DEFAULT_OPTIONS['base_url']
+    try:
+        server.use_for_asana_clients()
+        client = asana.Client.access_token("token")
+        job = JobQueue(max_workers=4, requests_per_minute=60000).submit("user", ["11", "12", "13", "14"], bulk.AsanaFollowUps(client, project_gid="99"))
+        summary = _wait(job)
+        assert summary['created'] == 4
+        assert server.rate_limited > 0
+        assert sorted(task['name'] for task in server.created_tasks) == [f"Follow up: Task {gid}" for gid in ("11", "12", "13", "14")]
+    finally:
+        asana.Client.DEFAULT_OPTIONS['base_url'] = base_url
+        server.stop()
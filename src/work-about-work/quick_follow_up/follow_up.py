@@ -1,4 +1,5 @@
-from flask import Blueprint,render_template,request
+from flask import Blueprint,render_template,request,jsonify,url_for
+from quick_follow_up import bulk
 
 follow_up = Blueprint('follow_up', __name__, template_folder='templates')
 
@@ -10,3 +11,35 @@ def show():
 def create():
     task_id = request.form["task_url"]
     return render_template("post_follow_up.html", source_task_url = request.form['task_url'])
+
+@follow_up.route("/bulk", methods=['POST'])
+def create_many():
+    # Task URLs as a JSON list, or one per line in a form field.
+    body = request.get_json(silent=True)
+    if body is not None:
+        urls = body.get('task_urls', []) if isinstance(body, dict) else None
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            return jsonify(error="task_urls must be a list of strings"), 400
+    else:
+        urls = request.form.get('task_urls', "").splitlines()
+    gids, invalid = bulk.parse_task_gids(urls, limit=bulk.MAX_TASKS_PER_JOB)
+    if not gids:
+        return jsonify(error="No Asana task URLs given", invalid=invalid), 400
+    if len(gids) > bulk.MAX_TASKS_PER_JOB:
+        return jsonify(error=f"At most {bulk.MAX_TASKS_PER_JOB} tasks at a time"), 413
+    user_id = request.cookies.get('asana_user_id')
+    # Imported here so the blueprint doesn't need the app context at import time.
+    from auth_credentials_store.all_credentials import get_asana_client_for_user
+    client = get_asana_client_for_user(user_id) if user_id else None
+    if client is None or type(client) == str:
+        return jsonify(error="Authorize the app with Asana first", authorization_url=client), 401
+    job = bulk.jobs.submit(user_id, gids, bulk.AsanaFollowUps(client, user_id=user_id))
+    return jsonify(job=job.id, tasks=gids, invalid=invalid, status_url=url_for('follow_up.job_status', job_id=job.id)), 202
+
+@follow_up.route("/jobs/<job_id>", methods=['GET'])
+def job_status(job_id):
+    job = bulk.jobs.get(job_id)
+    # Other users' jobs aren't there as far as this user can tell.
+    if job is None or job.user_id != request.cookies.get('asana_user_id'):
+        return jsonify(error=f"No job {job_id}"), 404
+    return jsonify(job.to_dict())
@@ -0,0 +1,32 @@
+from storage_service.cache import TTLCache
+from benchmarks.fake_clock import FakeClock
+
+
+def test_entries_expire_after_their_ttl():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=4, default_ttl=10, clock=clock)
+    cache.set("short", 1, ttl=1)
+    cache.set("long", 2)
+    clock.now = 5
+    assert cache.get("short") is None
+    assert cache.get("long") == 2
+    clock.now = 11
+    assert "long" not in cache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_invalidate_drops_entry():
+    cache = TTLCache()
+    cache.set("a", 1)
+    cache.invalidate("a")
+    assert cache.get("a", "missing") == "missing"
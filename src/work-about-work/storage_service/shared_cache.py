@@ -0,0 +1,167 @@
+"""
+The shared tier of the entity cache: a cache every instance of the app reads and writes, so an entity is read
+from the datastore about once per shared TTL however many instances there are, and a token refreshed on one
+instance is seen by the others straight away.
+
+Entries are versioned. Each (kind, key) has a version counter, and its value is stored under a key that includes
+the version. A write bumps the counter and stores the new value under the new version, so nobody reads the old
+value once the write has landed. A reader that missed and went to the datastore fills the cache only under the
+version it saw before reading, and only if nothing's there yet. A fill that raced with a write therefore lands
+under an old version that nobody reads any more.
+
+The tier itself is anything with the four operations below. RedisTier speaks to Redis (or anything that speaks
+its protocol); InMemoryTier is a stand-in for tests and benchmarks. A Memcache tier would implement the same
+four operations with get_multi / add / incr.
+"""
+
+import datetime
+import json
+import threading
+import time
+
+KEY_PREFIX = "credentials_cache"
+
+
+class RedisTier:
+    """
+    A shared tier on a Redis-protocol server. The redis package is only imported when one is made.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5))
+
+    def get_many(self, keys):
+        """
+        Values for keys, in order, with None for anything missing.
+        """
+        return self._client.mget(keys) if keys else []
+
+    def add(self, key, value, ttl):
+        """
+        Store value under key for ttl seconds, unless the key already has a value.
+        """
+        self._client.set(key, value, ex=ttl, nx=True)
+
+    def set(self, key, value, ttl):
+        self._client.set(key, value, ex=ttl)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+
+class InMemoryTier:
+    """
+    The shared tier's operations over a dict in this process, standing in for a server in tests and benchmarks.
+    Counts round trips the way a real server would see them.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (expires_at or None, value)
+        self._values = {}
+        self.round_trips = 0
+
+    def _live(self, key):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self._clock():
+            del self._values[key]
+            return None
+        return value
+
+    def get_many(self, keys):
+        with self._lock:
+            self.round_trips += 1
+            return [self._live(key) for key in keys]
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            self.round_trips += 1
+            if self._live(key) is None:
+                self._values[key] = (self._clock() + ttl, value)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self.round_trips += 1
+            self._values[key] = (self._clock() + ttl, value)
+
+    def incr(self, key):
+        with self._lock:
+            self.round_trips += 1
+            value = int(self._live(key) or 0) + 1
+            self._values[key] = (None, str(value).encode('ascii'))
+            return value
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Can't put a {type(value).__name__} in the shared cache")
+
+
+def _decode_object(obj):
+    if '__datetime__' in obj and len(obj) == 1:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+def encode(properties, exclude_from_indexes=()):
+    # JSON rather than pickle: whatever's in the shared tier is never trusted to run code in this process.
+    return json.dumps({'properties': properties, 'exclude_from_indexes': sorted(exclude_from_indexes)}, default=_encode_value).encode('utf-8')
+
+
+def decode(payload):
+    """
+    (properties, exclude_from_indexes) from encode()'s output.
+    """
+    document = json.loads(payload, object_hook=_decode_object)
+    return document['properties'], tuple(document['exclude_from_indexes'])
+
+
+class VersionedCache:
+    """
+    Versioned entries for (kind, key) pairs on a shared tier. Values are encoded property dicts.
+    """
+
+    def __init__(self, tier, prefix=KEY_PREFIX):
+        self.tier = tier
+        self.prefix = prefix
+
+    def _version_key(self, kind, key):
+        return f"{self.prefix}:version:{kind}:{key}"
+
+    def _value_key(self, kind, key, version):
+        return f"{self.prefix}:value:{kind}:{key}:{version}"
+
+    def get_many(self, kind_key_pairs):
+        """
+        {(kind, key): (version, payload or None)} for every pair, in two round trips: one for the versions and
+        one for the values at those versions. The version goes back to fill() if the payload's missing.
+        """
+        if not kind_key_pairs:
+            return {}
+        versions = [int(version or 0) for version in self.tier.get_many([self._version_key(*pair) for pair in kind_key_pairs])]
+        payloads = self.tier.get_many([self._value_key(*pair, version) for pair, version in zip(kind_key_pairs, versions)])
+        return dict((pair, (version, payload)) for pair, version, payload in zip(kind_key_pairs, versions, payloads))
+
+    def fill(self, kind, key, version, payload, ttl):
+        """
+        Cache what was read from the datastore, under the version seen before the read, unless it's already there.
+        """
+        self.tier.add(self._value_key(kind, key, version), payload, ttl)
+
+    def write(self, kind, key, payload, ttl):
+        """
+        Cache a value that was just written to the datastore, as the newest version.
+        """
+        version = self.tier.incr(self._version_key(kind, key))
+        self.tier.set(self._value_key(kind, key, version), payload, ttl)
+        return version
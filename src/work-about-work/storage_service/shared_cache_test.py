@@ -0,0 +1,57 @@
+import datetime
+from storage_service.shared_cache import InMemoryTier, VersionedCache, encode, decode
+from benchmarks.fake_clock import FakeClock
+
+PAIR = ("OauthCredentials", "user_credentials_1")
+
+
+def test_entities_round_trip_through_encoding():
+    expire_time = datetime.datetime(2020, 5, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    properties, exclude_from_indexes = decode(encode({'access_token': "a", 'expire_time': expire_time, 'redirect_urls': ["x"]}, ["access_token"]))
+    assert properties == {'access_token': "a", 'expire_time': expire_time, 'redirect_urls': ["x"]}
+    assert exclude_from_indexes == ("access_token",)
+
+
+def test_a_miss_reports_the_version_to_fill_at():
+    cache = VersionedCache(InMemoryTier())
+    assert cache.get_many([PAIR]) == {PAIR: (0, None)}
+    cache.fill(*PAIR, 0, b"from datastore", ttl=60)
+    assert cache.get_many([PAIR]) == {PAIR: (0, b"from datastore")}
+
+
+def test_writes_are_seen_straight_away():
+    cache = VersionedCache(InMemoryTier())
+    cache.fill(*PAIR, 0, b"old", ttl=60)
+    assert cache.write(*PAIR, b"new", ttl=60) == 1
+    assert cache.get_many([PAIR])[PAIR] == (1, b"new")
+
+
+def test_a_fill_that_raced_with_a_write_is_never_read():
+    cache = VersionedCache(InMemoryTier())
+    version, _ = cache.get_many([PAIR])[PAIR]
+    # Another instance writes between this one's datastore read and its fill.
+    cache.write(*PAIR, b"new", ttl=60)
+    cache.fill(*PAIR, version, b"stale", ttl=60)
+    assert cache.get_many([PAIR])[PAIR] == (1, b"new")
+
+
+def test_fills_do_not_replace_what_is_there():
+    cache = VersionedCache(InMemoryTier())
+    cache.fill(*PAIR, 0, b"first", ttl=60)
+    cache.fill(*PAIR, 0, b"second", ttl=60)
+    assert cache.get_many([PAIR])[PAIR] == (0, b"first")
+
+
+def test_entries_expire_but_versions_do_not():
+    clock = FakeClock()
+    cache = VersionedCache(InMemoryTier(clock=clock))
+    cache.write(*PAIR, b"new", ttl=60)
+    clock.now = 61
+    assert cache.get_many([PAIR])[PAIR] == (1, None)
+
+
+def test_lookups_take_two_round_trips_however_many_keys():
+    tier = InMemoryTier()
+    cache = VersionedCache(tier)
+    cache.get_many([("OauthCredentials", f"user_credentials_{i}") for i in range(50)])
+    assert tier.round_trips == 2
@@ -1,15 +1,87 @@
 import logging
-from google.cloud import datastore
-import google.cloud.exceptions
+import threading
 from environment_service.environment import Environment,get_environment
+from storage_service.cache import TTLCache
+from storage_service import shared_cache
+from metrics_service import metrics
 import os
 
 # This is a safe number to expose;
 # it's the entrypoint for all successive loads from the datastore.
 APP_ID=1163630087121140
 
+# How long, in seconds, an entity of each kind may be served from the in-process cache
+# before it's read from the datastore again. Kinds not listed here are never cached.
+ENTITY_CACHE_TTLS = {
+        "OauthCredentials": 60,
+        "BasicAuthCredentials": 300,
+        }
+ENTITY_CACHE_SIZE = 512
+
+# With a shared cache (REDIS_URL, or set_shared_cache()) in front of the datastore, how long each kind lives there.
+# Writes through this module replace shared entries straight away, so these only bound how stale an entity
+# changed some other way (e.g. in the console) can get.
+SHARED_CACHE_TTLS = {
+        "OauthCredentials": 3600,
+        "BasicAuthCredentials": 3600,
+        }
+# With a shared cache, entities are kept in-process only briefly, so a token refreshed on another instance
+# is seen here within this many seconds.
+LOCAL_CACHE_TTL_WITH_SHARED_CACHE = 5
+
+# One client per process, shared by every request and thread.
+_client = None
+_client_lock = threading.Lock()
+_entity_cache = TTLCache(maxsize=ENTITY_CACHE_SIZE)
+# A shared_cache.VersionedCache, False until it's been looked for, None if there isn't one.
+_shared_cache = False
+# Callables taking (kind, key), told whenever this process writes an entity.
+_write_listeners = []
+
+def set_datastore_client(client):
+    """
+    Replace the process's datastore client, e.g. with one pointed at an emulator or a benchmark stand-in.
+    Cached entities came from the old client, so they're dropped.
+    """
+    global _client
+    with _client_lock:
+        _client = client
+    clear_entity_cache()
+
+def set_shared_cache(cache):
+    """
+    Use a shared_cache.VersionedCache as the tier between the in-process cache and the datastore, or None for none.
+    """
+    global _shared_cache
+    _shared_cache = cache
+    clear_entity_cache()
+
+def _shared():
+    global _shared_cache
+    if _shared_cache is False:
+        url = os.environ.get('REDIS_URL')
+        _shared_cache = shared_cache.VersionedCache(shared_cache.RedisTier.from_url(url)) if url else None
+    return _shared_cache
+
+def _datastore():
+    # The client library takes a good while to import, so it's left until something needs it rather than
+    # being paid for on every cold start, even by requests that never touch the datastore.
+    from google.cloud import datastore
+    return datastore
+
 def _datastore_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _build_datastore_client()
+    return _client
 
+def _build_datastore_client():
+    datastore = _datastore()
+    if 'DATASTORE_EMULATOR_HOST' in os.environ:
+        # The client library points itself at the emulator; no service account needed.
+        return datastore.Client(namespace="credentials")
     environment = get_environment()
     if environment == Environment.DEVELOPMENT:
         return datastore.Client.from_service_account_json("/Users/mattbramlage/sandbox/google_cloud_apps/credentials_not_tracked/work_about_work_creds.json", namespace="credentials")
@@ -23,50 +95,198 @@ def _app_credentials_key():
 def _user_credentials_key_for_id(user_id):
     return f"user_credentials_{user_id}"
 
+def _copy_entity(entity):
+    # The cache hands out copies so a caller updating an entity before a put can't change what other requests see.
+    copy = _datastore().Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    copy.update(entity)
+    return copy
+
+def _cache_entity(data_kind, key, entity):
+    ttl = ENTITY_CACHE_TTLS.get(data_kind)
+    if ttl:
+        if _shared() is not None:
+            ttl = min(ttl, LOCAL_CACHE_TTL_WITH_SHARED_CACHE)
+        _entity_cache.set((data_kind, key), _copy_entity(entity), ttl)
+
+def _entity_from_shared(data_kind, key, payload):
+    properties, exclude_from_indexes = shared_cache.decode(payload)
+    entity = _datastore().Entity(key=_datastore_client().key(data_kind, key), exclude_from_indexes=exclude_from_indexes)
+    entity.update(properties)
+    return entity
+
+def _get_from_shared(kind_key_pairs):
+    """
+    ({(kind, key): entity} for what the shared cache has, {(kind, key): version} to fill the rest at).
+    The shared cache is only ever an optimization: if it's unreachable, everything's read from the datastore.
+    """
+    cache = _shared()
+    pairs = [pair for pair in kind_key_pairs if pair[0] in SHARED_CACHE_TTLS]
+    if cache is None or not pairs:
+        return {}, {}
+    try:
+        with metrics.span("shared_cache.get"):
+            cached = cache.get_many(pairs)
+    except Exception:
+        logging.getLogger('root').warning("Couldn't read from the shared cache", exc_info=True)
+        return {}, {}
+    found, versions = {}, {}
+    for (data_kind, key), (version, payload) in cached.items():
+        if payload is None:
+            versions[(data_kind, key)] = version
+        else:
+            found[(data_kind, key)] = _entity_from_shared(data_kind, key, payload)
+    return found, versions
+
+def _fill_shared(entity, version):
+    data_kind = entity.key.kind
+    try:
+        _shared().fill(data_kind, entity.key.id_or_name, version,
+                shared_cache.encode(dict(entity), entity.exclude_from_indexes), SHARED_CACHE_TTLS[data_kind])
+    except Exception:
+        logging.getLogger('root').warning("Couldn't fill the shared cache for %s %s", data_kind, entity.key.id_or_name, exc_info=True)
+
+def _write_through_shared(entity):
+    cache = _shared()
+    data_kind = entity.key.kind
+    if cache is None or data_kind not in SHARED_CACHE_TTLS:
+        return
+    try:
+        with metrics.span("shared_cache.write"):
+            cache.write(data_kind, entity.key.id_or_name,
+                    shared_cache.encode(dict(entity), entity.exclude_from_indexes), SHARED_CACHE_TTLS[data_kind])
+    except Exception:
+        # Other instances may go on reading the old entity until it expires from the shared cache.
+        logging.getLogger('root').error("Couldn't write %s %s through to the shared cache", data_kind, entity.key.id_or_name, exc_info=True)
+
+def invalidate_cached_entity(data_kind, key):
+    _entity_cache.invalidate((data_kind, key))
+
+def clear_entity_cache():
+    _entity_cache.clear()
+
+def add_write_listener(listener):
+    """
+    Register a callable to be told (kind, key) whenever this process writes an entity,
+    so anything derived from that entity can be thrown away.
+    """
+    _write_listeners.append(listener)
+
+def _put(entity):
+    with metrics.span("datastore.put"):
+        _datastore_client().put(entity)
+    invalidate_cached_entity(entity.key.kind, entity.key.id_or_name)
+    _write_through_shared(entity)
+    for listener in _write_listeners:
+        listener(entity.key.kind, entity.key.id_or_name)
+
+@metrics.timed("store.get_entity_by_key")
 def get_entity_by_key(data_kind, key):
+    return get_entities_by_keys([(data_kind, key)])[0]
+
+def get_entities_by_keys(kind_key_pairs):
+    """
+    Look up many entities by (kind, key) in at most one round trip to the datastore, trying the in-process
+    cache and then the shared cache (if there is one) first. Results come back in the order the pairs were given, with None for anything that doesn't exist.
+    """
+    results = [None] * len(kind_key_pairs)
+    # (kind, key) -> every position in the results that wants it, so duplicates cost nothing extra.
+    missing = {}
+    for position, (data_kind, key) in enumerate(kind_key_pairs):
+        cached = _entity_cache.get((data_kind, key))
+        if cached is not None:
+            results[position] = _copy_entity(cached)
+        else:
+            missing.setdefault((data_kind, key), []).append(position)
+    if not missing:
+        return results
+    from_shared, versions = _get_from_shared(list(missing))
+    for kind_and_key, entity in from_shared.items():
+        _cache_entity(*kind_and_key, entity)
+        for position in missing.pop(kind_and_key):
+            results[position] = _copy_entity(entity)
+    if not missing:
+        return results
     client = _datastore_client()
-    query = client.query(kind=data_kind)
-    app_key = client.key(data_kind, key)
-    query.key_filter(app_key, '=')
-    matches = list(query.fetch())
-    assert len(matches) <= 1, "Expected to fetch at most a single value by key"
-    if len(matches) == 0:
-        logging.getLogger('root').warn(f"Fetch witk kind {data_kind} and key {key} returned no results")
-        return None
-    return matches[0]
+    datastore_keys = [client.key(data_kind, key) for (data_kind, key) in missing]
+    with metrics.span("datastore.get"):
+        if len(datastore_keys) == 1:
+            found = [client.get(datastore_keys[0])]
+        else:
+            found = client.get_multi(datastore_keys)
+    for entity in found:
+        if entity is None:
+            continue
+        kind_and_key = (entity.key.kind, entity.key.id_or_name)
+        _cache_entity(*kind_and_key, entity)
+        if kind_and_key in versions:
+            _fill_shared(entity, versions[kind_and_key])
+        for position in missing.pop(kind_and_key, []):
+            results[position] = _copy_entity(entity)
+    for (data_kind, key) in missing:
+        logging.getLogger('root').warn("Fetch witk kind %s and key %s returned no results", data_kind, key)
+    return results
+
+def _app_credentials_from_entity(entity):
+    assert entity != None, "You need to bootstrap the app credentials in the datastore: https://console.cloud.google.com/datastore/entities"
+    return {'client_id': APP_ID, 'client_secret': entity['client_secret'], 'redirect_urls': entity['redirect_urls']}
 
+def _new_user_credentials(user):
+    return _datastore().Entity(key=_datastore_client().key('OauthCredentials', _user_credentials_key_for_id(user)))
+
+def warm_up():
+    """
+    Build the datastore client and cache the app credentials now, e.g. from a warmup request, so the first
+    real request doesn't wait on either.
+    """
+    _datastore_client()
+    return get_app_credentials()
 
 def get_app_credentials():
     entity = get_entity_by_key("OauthCredentials", _app_credentials_key())
-    assert entity != None, "You need to bootstrap the app credentials in the datastore: https://console.cloud.google.com/datastore/entities"
-    return {'client_id': APP_ID, 'client_secret': entity['client_secret'], 'redirect_urls': entity['redirect_urls']}
+    return _app_credentials_from_entity(entity)
+
+def get_app_and_user_credentials(user):
+    """
+    The app and user credentials needed to build an authorized client for a user, fetched together.
+    As with get_or_construct_user_credentials, the user entity is constructed (unsaved) if it doesn't exist.
+    """
+    app_entity, user_entity = get_entities_by_keys([
+        ("OauthCredentials", _app_credentials_key()),
+        ("OauthCredentials", _user_credentials_key_for_id(user)),
+        ])
+    if not user_entity:
+        user_entity = _new_user_credentials(user)
+    return _app_credentials_from_entity(app_entity), user_entity
 
 def get_or_construct_user_credentials(user):
     entity = get_entity_by_key("OauthCredentials", _user_credentials_key_for_id(user))
     if not entity:
-        entity = datastore.Entity(key=_datastore_client().key('OauthCredentials', _user_credentials_key_for_id(user)))
+        entity = _new_user_credentials(user)
     return entity
 
 def store_user_refresh_token(user, refresh_token):
-    client = _datastore_client()
     user_credentials_entity = get_or_construct_user_credentials(user)
     user_credentials_entity.update({'refresh_token': refresh_token})
-    client.put(user_credentials_entity)
+    _put(user_credentials_entity)
     return user_credentials_entity
 
 def get_user_access_token(user):
-    client = _datastore_client()
     user_credentials_entity = get_entity_by_key("OauthCredentials", _user_credentials_key_for_id(user))
     return user_credentials_entity
 
 def store_user_access_token(user, access_token, expire_epoch_time):
-    client = _datastore_client()
     user_credentials_entity = get_or_construct_user_credentials(user)
     user_credentials_entity.update({'access_token': access_token, 'expire_time': expire_epoch_time})
-    client.put(user_credentials_entity)
+    _put(user_credentials_entity)
     return user_credentials_entity
 
 def get_basic_auth_hash(username):
-    logging.getLogger('root').info(f"Getting auth credentials for {username} from store")
+    logging.getLogger('root').info("Getting auth credentials for %s from store", username)
     entity = get_entity_by_key("BasicAuthCredentials", username)
     return entity['salted_hash']
+
+def set_basic_auth_hash(username, salted_hash):
+    entity = _datastore().Entity(key=_datastore_client().key("BasicAuthCredentials", username))
+    entity.update({'salted_hash': salted_hash})
+    _put(entity)
+    return entity
@@ -1,13 +1,88 @@
 import datetime
-from flask import Flask, render_template
+import os
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
 
+import assets
+import ingestion
+import ledger
+import live
+import logging_pipeline
+import metrics
 import models
+import results
+
+# Logs go through a queue to a background exporter so requests never wait on log output; on App Engine
+# they're written as JSON lines for structured Cloud Logging. LOG_LEVEL=TRACE turns on the models' trace logs.
+logging_pipeline.install(level=os.environ.get('LOG_LEVEL', 'INFO'), structured='GAE_INSTANCE' in os.environ)
 
 app = Flask(__name__)
+# Request latency histograms, and /metrics to read them from.
+metrics.install(app)
+# Static files fingerprinted and precompressed, served with immutable caching; templates use asset_url().
+assets.install(app)
+# Who has voted in each election, with a Bloom filter in front so first-time voters cost no read.
+voter_ledgers = ledger.VoterLedgers()
+vote_buffer = ingestion.install_shutdown_drain(ingestion.VoteBuffer(on_settled=voter_ledgers.settle))
+# One results listener per election however many browsers are watching it.
+live_results = live.LiveResults()
 
 @app.route('/')
 def serve_app():
-    return render_template('index.html' , utc_dt=datetime.datetime.utcnow())
+    # Results for the election being shown are rendered into the page so the app doesn't have to fetch them.
+    election_id = request.args.get('election')
+    initial_results = results.cached_results(election_id) if models.valid_document_id(election_id) else None
+    return render_template('index.html' , utc_dt=datetime.datetime.utcnow(), initial_results=initial_results)
+
+@app.route('/elections/<election_id>/results')
+def election_results(election_id):
+    if not models.valid_document_id(election_id):
+        return jsonify(error="Not a valid election"), 400
+    return jsonify(results.cached_results(election_id))
+
+@app.route('/elections/<election_id>/stream')
+def stream_election_results(election_id):
+    if not models.valid_document_id(election_id):
+        return jsonify(error="Not a valid election"), 400
+    return Response(stream_with_context(live_results.stream(election_id)), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/elections/<election_id>/votes', methods=['POST'])
+def submit_vote(election_id):
+    if not models.valid_document_id(election_id):
+        return jsonify(error="Not a valid election"), 400
+    vote = request.get_json(silent=True) or request.form
+    candidate_id = vote.get('candidate')
+    voter_id = vote.get('voter')
+    if not candidate_id:
+        return jsonify(error="A vote needs a candidate"), 400
+    if not models.valid_document_id(candidate_id):
+        return jsonify(error="Not a valid candidate"), 400
+    if not voter_id:
+        return jsonify(error="A vote needs a voter"), 400
+    if not models.valid_document_id(voter_id):
+        return jsonify(error="Not a valid voter"), 400
+    election = vote_buffer.election(election_id)
+    if election is None:
+        return jsonify(error=f"No election {election_id}"), 404
+    if election.state != models.Election.STATE_OPEN:
+        return jsonify(error=f"Election {election_id} is not open"), 409
+    if candidate_id not in election.candidate_ids:
+        return jsonify(error=f"{candidate_id} is not a candidate in {election_id}"), 400
+    voter_ledger = voter_ledgers.ledger(election)
+    admitted = voter_ledger.admit(voter_id, candidate_id)
+    if admitted == ledger.VoterLedger.ALREADY_VOTED:
+        return jsonify(error=f"Voter {voter_id} has already voted in {election_id}"), 409
+    try:
+        # A first-time voter is entered in the ledger when the vote is written; a claimed one already has been.
+        vote_buffer.submit(election_id, candidate_id, voter_id if admitted == ledger.VoterLedger.FIRST_VOTE else None)
+    except ingestion.BufferFull:
+        # Otherwise the retry would be turned away as a second vote.
+        if admitted == ledger.VoterLedger.CLAIMED:
+            election.release_voter(voter_id)
+        else:
+            voter_ledger.settle([voter_id])
+        return jsonify(error="Too many votes right now, try again shortly"), 503, {'Retry-After': '1'}
+    return jsonify(accepted=True), 202
 
 @app.route('/hello')
 def hello_world():
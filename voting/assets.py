@@ -0,0 +1,285 @@
+"""
+Fingerprinted, precompressed static assets.
+
+build() copies every file under the static directory to a build directory under a name carrying a hash of its
+contents (js/main.js -> js/main.3f2a9c1b7e04.js), next to gzip and, if the brotli package is installed, brotli
+variants. Files are only compressed when that makes them smaller. A build is reused as long as the sources
+haven't changed, so it can run at deploy time:
+
+    python -m assets build [--build-dir DIR]
+
+or on the first request, into STATIC_BUILD_DIR (by default a directory under the system temp dir, since the
+app's own directory may be read-only).
+
+Because a name only ever has one content, assets are served with strong ETags and a year-long immutable
+Cache-Control. Each response picks the smallest variant the client accepts (Accept-Encoding) and streams it
+from a memory-mapped file. Templates use asset_url('js/main.js') to get the fingerprinted URL.
+"""
+
+import argparse
+import gzip
+import hashlib
+import logging
+import mimetypes
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+LOG=logging.getLogger("assets")
+
+HASH_LENGTH = 12
+CHUNK_SIZE = 64 * 1024
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Most compact first; the first one the client accepts is served.
+ENCODINGS = ("br", "gzip")
+# Types not worth compressing: they're compressed already.
+_PRECOMPRESSED_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp", "font/woff", "font/woff2")
+
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def _write_atomically(path, data):
+    '''
+    Write data to a temporary file of its own next to path and rename it into place, so neither a concurrent
+    reader nor another process building the same file ever sees half of it.
+    '''
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False) as f:
+        try:
+            f.write(data)
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    # Temporary files are private to their owner; built assets are read like any other file.
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+
+def _compress(encoding, data):
+    if encoding == "gzip":
+        # mtime=0 so the same input always builds the same bytes.
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return _brotli().compress(data, quality=11)
+
+
+def _available_encodings():
+    return tuple(encoding for encoding in ENCODINGS if encoding != "br" or _brotli() is not None)
+
+
+def fingerprinted_name(filename, digest):
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{digest[:HASH_LENGTH]}{extension}"
+
+
+def parse_accept_encoding(header):
+    '''
+    {encoding: quality} from an Accept-Encoding header.
+    '''
+    accepted = {}
+    for part in (header or "").split(","):
+        fields = part.strip().split(";")
+        encoding = fields[0].strip().lower()
+        if not encoding:
+            continue
+        quality = 1.0
+        for parameter in fields[1:]:
+            name, _, value = parameter.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[encoding] = quality
+    return accepted
+
+
+def negotiate(header, available):
+    '''
+    The encoding to serve from those available (most compact first), or None for the uncompressed file.
+    '''
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    for encoding in available:
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+class Variant():
+    '''
+    One encoding of an asset on disk, memory-mapped once it's first served.
+    '''
+
+    def __init__(self, path, encoding, digest):
+        self.path = path
+        self.encoding = encoding
+        self.size = os.path.getsize(path)
+        self.etag = f'"{digest[:HASH_LENGTH]}-{encoding}"' if encoding else f'"{digest[:HASH_LENGTH]}"'
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _mapped(self):
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    with open(self.path, "rb") as f:
+                        # The mapping outlives the file object; the pages are shared with the OS's file cache.
+                        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def chunks(self):
+        if self.size == 0:
+            return
+        view = memoryview(self._mapped())
+        for start in range(0, self.size, CHUNK_SIZE):
+            yield bytes(view[start:start + CHUNK_SIZE])
+
+
+class Asset():
+
+    def __init__(self, filename, url_name, content_type, variants):
+        self.filename = filename
+        self.url_name = url_name
+        self.content_type = content_type
+        # encoding (None for uncompressed) -> Variant
+        self.variants = variants
+
+    def encodings(self):
+        return tuple(encoding for encoding in ENCODINGS if encoding in self.variants)
+
+
+class AssetPipeline():
+
+    def __init__(self, static_dir, build_dir=None):
+        self.static_dir = os.path.abspath(static_dir)
+        self.build_dir = build_dir or os.environ.get('STATIC_BUILD_DIR') or os.path.join(tempfile.gettempdir(), "voting-static")
+        # Source filename (e.g. js/main.js) -> Asset, and fingerprinted name -> Asset.
+        self._by_filename = None
+        self._by_url_name = None
+        self._build_lock = threading.Lock()
+
+    def _source_files(self):
+        for root, _, files in os.walk(self.static_dir):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, self.static_dir).replace(os.sep, "/"), path
+
+    def _build_asset(self, filename, path, encodings):
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        url_name = fingerprinted_name(filename, digest)
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        target = os.path.join(self.build_dir, url_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not os.path.exists(target):
+            _write_atomically(target, data)
+        variants = {None: Variant(target, None, digest)}
+        if content_type not in _PRECOMPRESSED_TYPES:
+            for encoding in encodings:
+                compressed_path = f"{target}.{encoding}"
+                if not os.path.exists(compressed_path):
+                    compressed = _compress(encoding, data)
+                    if len(compressed) >= len(data):
+                        continue
+                    _write_atomically(compressed_path, compressed)
+                variants[encoding] = Variant(compressed_path, encoding, digest)
+        return Asset(filename, url_name, content_type, variants)
+
+    def build(self):
+        '''
+        Fingerprint and compress every static file, reusing anything already built from the same contents.
+        '''
+        encodings = _available_encodings()
+        by_filename = {}
+        for filename, path in self._source_files():
+            by_filename[filename] = self._build_asset(filename, path, encodings)
+        self._by_url_name = dict((asset.url_name, asset) for asset in by_filename.values())
+        self._by_filename = by_filename
+        LOG.info("Built %d static assets into %s with encodings %s", len(by_filename), self.build_dir, ", ".join(encodings))
+        return by_filename
+
+    def _assets(self):
+        if self._by_filename is None:
+            with self._build_lock:
+                if self._by_filename is None:
+                    self.build()
+        return self._by_filename
+
+    def url_name(self, filename):
+        '''
+        The fingerprinted name for a static file, e.g. js/main.3f2a9c1b7e04.js.
+        '''
+        return self._assets()[filename].url_name
+
+    def find(self, url_name):
+        self._assets()
+        return self._by_url_name.get(url_name)
+
+    def respond(self, url_name, accept_encoding=None, if_none_match=None):
+        '''
+        (status, headers, body chunks) for a request for a fingerprinted name; None if there's no such asset.
+        '''
+        asset = self.find(url_name)
+        if asset is None:
+            return None
+        variant = asset.variants[negotiate(accept_encoding, asset.encodings())]
+        headers = {
+                'Content-Type': asset.content_type,
+                'Cache-Control': CACHE_CONTROL,
+                'ETag': variant.etag,
+                'Vary': 'Accept-Encoding',
+                }
+        if variant.encoding:
+            headers['Content-Encoding'] = variant.encoding
+        if if_none_match and (if_none_match.strip() == "*" or variant.etag in re.split(r"\s*,\s*", if_none_match.strip())):
+            return 304, headers, iter(())
+        headers['Content-Length'] = str(variant.size)
+        return 200, headers, variant.chunks()
+
+
+def install(app, static_dir=None, url_prefix="/assets"):
+    '''
+    Serve an app's static directory fingerprinted and precompressed under url_prefix, and give its templates
+    asset_url(filename).
+    '''
+    from flask import Response, abort, request, url_for
+    pipeline = AssetPipeline(static_dir or app.static_folder)
+
+    @app.route(f"{url_prefix}/<path:url_name>", endpoint="asset")
+    def serve_asset(url_name):
+        response = pipeline.respond(url_name, request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+        if response is None:
+            abort(404)
+        status, headers, body = response
+        return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+    @app.context_processor
+    def asset_url_helper():
+        return {'asset_url': lambda filename: url_for("asset", url_name=pipeline.url_name(filename))}
+
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress the voting app's static files")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--static-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+    parser.add_argument("--build-dir", help="Defaults to STATIC_BUILD_DIR, or a directory under the temp dir")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for filename, asset in sorted(AssetPipeline(args.static_dir, args.build_dir).build().items()):
+        sizes = ", ".join(f"{encoding or 'identity'} {variant.size}" for encoding, variant in asset.variants.items())
+        print(f"{filename} -> {asset.url_name} ({sizes})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Memory and speed of the voter filter in front of the voter ledger: bytes per million voters at a few error
+rates, the false positive rate actually measured (each false positive costs one ledger check in Firestore),
+and add / lookup throughput. Beside it, the same voters held in a Python set, for scale.
+
+No database is needed. Run from the voting directory:
+
+    python -m benchmarks.bench_ledger [--voters N] [--error-rates 0.01,0.001,0.0001] [--output results.jsonl]
+
+Results are printed as JSON and, with --output, appended as one line to the given file.
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from ledger import BloomFilter
+from benchmarks import report
+
+
+def _voter_ids(count, prefix="voter"):
+    return (f"{prefix}_{i:012d}" for i in range(count))
+
+
+def filter_benchmark(voters, error_rate, probes):
+    bloom = BloomFilter(capacity=voters, error_rate=error_rate)
+    started = time.perf_counter()
+    for voter_id in _voter_ids(voters):
+        bloom.add(voter_id)
+    add_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    false_positives = sum(1 for voter_id in _voter_ids(probes, prefix="stranger") if voter_id in bloom)
+    lookup_seconds = time.perf_counter() - started
+    return {
+            'name': f"bloom.error_rate_{error_rate}",
+            'voters': voters,
+            'error_rate': error_rate,
+            'hashes': bloom.num_hashes,
+            'bytes': bloom.size_bytes,
+            'bytes_per_million_voters': bloom.size_bytes * 1000000 / voters,
+            'serialized_bytes': len(bloom.to_bytes()),
+            'measured_false_positive_rate': false_positives / probes,
+            'adds_per_second': voters / add_seconds,
+            'lookups_per_second': probes / lookup_seconds,
+            }
+
+
+def set_benchmark(voters):
+    gc.collect()
+    tracemalloc.start()
+    voter_set = set(_voter_ids(voters))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del voter_set
+    return {'name': "python_set", 'voters': voters, 'bytes': size, 'bytes_per_million_voters': size * 1000000 / voters}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--voters", type=int, default=1000000)
+    parser.add_argument("--probes", type=int, default=100000, help="Lookups of voters who never voted, to measure false positives")
+    parser.add_argument("--error-rates", default="0.01,0.001,0.0001")
+    parser.add_argument("--output", help="Append the report to this file as a JSON line")
+    args = parser.parse_args()
+
+    results = [filter_benchmark(args.voters, float(error_rate), args.probes) for error_rate in args.error_rates.split(",")]
+    results.append(set_benchmark(args.voters))
+    report.report("voter_ledger", results, output=args.output, voters=args.voters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Memory and serialization cost of holding lots of candidates in memory: the declarative, slotted Candidate
+against the same model written the old way, with an instance __dict__, hand-written to_dict / from_dict, the
+whole snapshot kept on the model and a deep copy of the document on every read.
+
+No database is needed; models are read from in-memory snapshots shaped like Firestore's. Run from the voting
+directory:
+
+    python -m benchmarks.bench_models [--candidates N] [--rounds N]
+
+Results are printed as JSON.
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import time
+import tracemalloc
+import models
+
+
+class BenchmarkSnapshot():
+    '''
+    Carries what a DocumentSnapshot carries: the data plus the reference and read / create / update times.
+    '''
+
+    def __init__(self, collection_name, document_id, data):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.id = document_id
+        self.reference = f"{collection_name}/{document_id}"
+        self.exists = True
+        self.read_time = now
+        self.create_time = now
+        self.update_time = now
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class DictBackedCandidate(models.ModelBase):
+    '''
+    Candidate as it was before Fields: dict-backed, and holding on to its snapshot.
+    '''
+    @classmethod
+    def collection_name(cls):
+        return "candidates"
+
+    def __init__(self, name, *args, **kwargs):
+        super().__init__(name, *args, **kwargs)
+        self.name = name
+        self.num_votes = 0
+        self._snapshot = None
+
+    def _load(self, snapshot):
+        self._snapshot = snapshot
+        return super()._load(snapshot)
+
+    def to_dict(self, d):
+        d.update({
+            "test": "Not really a very useful piece of data, also unmapped to show that's possible",
+            "num_votes": self.num_votes
+                 })
+        return d
+
+    def from_dict(self, d):
+        self.num_votes = d.pop("num_votes", self.num_votes)
+
+    def after_deserialize(self, d):
+        d = super().after_deserialize(d)
+        self._additional_attributes = d.copy()
+        return d
+
+
+def _snapshots(count):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [BenchmarkSnapshot("candidates", f"candidate_{i}", {
+        "num_votes": i,
+        "test": "Not really a very useful piece of data, also unmapped to show that's possible",
+        "t_cr": now,
+        "t_md": now,
+        }) for i in range(count)]
+
+
+def _measure(model_class, snapshots, rounds):
+    gc.collect()
+    tracemalloc.start()
+    loaded = [model_class.from_snapshot(snapshot) for snapshot in snapshots]
+    # The snapshots themselves are only counted if the models keep them alive.
+    del snapshots[:]
+    gc.collect()
+    memory_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for model in loaded:
+            model.serialize()
+    serialize_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for model in loaded:
+            model.deserialize()
+    deserialize_seconds = time.perf_counter() - started
+
+    operations = len(loaded) * rounds
+    return {
+            "model": model_class.__name__,
+            "candidates": len(loaded),
+            "bytes_per_model": round(memory_bytes / len(loaded), 1),
+            "serialize_us": round(serialize_seconds / operations * 1e6, 3),
+            "deserialize_us": round(deserialize_seconds / operations * 1e6, 3),
+            }
+
+
+def run(candidates, rounds):
+    results = [_measure(model_class, _snapshots(candidates), rounds) for model_class in (DictBackedCandidate, models.Candidate)]
+    before, after = results
+    return {
+            "results": results,
+            "memory_ratio": round(after["bytes_per_model"] / before["bytes_per_model"], 3),
+            "serialize_ratio": round(after["serialize_us"] / before["serialize_us"], 3),
+            "deserialize_ratio": round(after["deserialize_us"] / before["deserialize_us"], 3),
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--candidates', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.candidates, args.rounds), indent=2))
@@ -0,0 +1,110 @@
+"""
+Load test for vote counting against the Firestore emulator.
+
+Start the emulator and point the client at it, then run from the voting directory:
+
+    gcloud emulators firestore start --host-port=localhost:8081
+    FIRESTORE_EMULATOR_HOST=localhost:8081 python -m benchmarks.load_test_votes --mode sharded --shards 20
+
+Several worker threads vote for the same candidate for a fixed duration, which is the worst case for
+contention. --mode single counts on the candidate document itself with a read-modify-write sync(), the way
+num_votes was counted before the sharded counter, for comparison. Results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import models
+
+
+class LoadTestElection(models.Election, models.CollectionDeleteable):
+    @classmethod
+    def collection_name(cls):
+        return "load_test_elections"
+
+
+class LoadTestCandidate(models.Candidate, models.CollectionDeleteable):
+    @classmethod
+    def collection_name(cls):
+        return "load_test_candidates"
+
+
+def vote_sharded(election, candidate):
+    election.record_vote(candidate)
+
+
+def vote_single_document(election, candidate):
+    while True:
+        try:
+            current = LoadTestCandidate(candidate.name).read()
+            current.num_votes += 1
+            current.sync()
+            return
+        except models.ModelBase.SyncTransactionFailed:
+            continue
+
+
+def run(mode, shards, workers, duration):
+    election = LoadTestElection("load_test")
+    election.num_vote_shards = shards
+    candidate = LoadTestCandidate("load_test_candidate")
+    models.ModelBase.sync_many([election, candidate])
+    vote = vote_sharded if mode == "sharded" else vote_single_document
+
+    deadline = time.monotonic() + duration
+    lock = threading.Lock()
+    counts = {'votes': 0, 'errors': 0}
+    def worker():
+        while time.monotonic() < deadline:
+            try:
+                vote(election, candidate)
+                key = 'votes'
+            except Exception:
+                key = 'errors'
+            with lock:
+                counts[key] += 1
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    if mode == "sharded":
+        counted = candidate.roll_up_votes()
+    else:
+        counted = LoadTestCandidate(candidate.name).read().num_votes
+    return {
+            'mode': mode,
+            'shards': shards if mode == "sharded" else 1,
+            'workers': workers,
+            'duration_seconds': elapsed,
+            'votes_accepted': counts['votes'],
+            'errors': counts['errors'],
+            'votes_counted': counted,
+            'votes_per_second': counts['votes'] / elapsed,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["sharded", "single"], default="sharded")
+    parser.add_argument("--shards", type=int, default=models.ShardedCounter.DEFAULT_NUM_SHARDS)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to keep voting")
+    args = parser.parse_args()
+    if 'FIRESTORE_EMULATOR_HOST' not in os.environ:
+        parser.error("Set FIRESTORE_EMULATOR_HOST; this load test isn't meant to run against a real project")
+
+    try:
+        print(json.dumps(run(args.mode, args.shards, args.workers, args.duration), indent=2))
+    finally:
+        LoadTestCandidate.delete_all_documents_in_collection(recursive=True)
+        LoadTestElection.delete_all_documents_in_collection()
+
+
+if __name__ == '__main__':
+    main()
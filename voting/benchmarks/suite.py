@@ -0,0 +1,137 @@
+"""
+The offline benchmark suite for the voting models: creating, reading and syncing models, batched syncs, streaming,
+counting votes and deleting collections, with throughput and p50 / p99 latency for each.
+
+It runs against the Firestore emulator, never a real project. Either start one and point the client at it:
+
+    gcloud emulators firestore start --host-port=localhost:8081
+    FIRESTORE_EMULATOR_HOST=localhost:8081 python -m benchmarks.suite
+
+or let the suite start (and stop) one itself, from the voting directory:
+
+    python -m benchmarks.suite --start-emulator [--iterations N] [--output results.jsonl]
+
+The report is printed as JSON and, with --output, appended as one line to the given file.
+"""
+
+import argparse
+import itertools
+import os
+import signal
+import socket
+import subprocess
+import time
+import models
+from benchmarks import report
+
+
+class BenchmarkCandidate(models.Candidate, models.CollectionDeleteable):
+    @classmethod
+    def collection_name(cls):
+        return "benchmark_candidates"
+
+
+class BenchmarkElection(models.Election, models.CollectionDeleteable):
+    @classmethod
+    def collection_name(cls):
+        return "benchmark_elections"
+
+
+class BenchmarkElectionResults(models.ElectionResults, models.CollectionDeleteable):
+    @classmethod
+    def collection_name(cls):
+        return "benchmark_election_results"
+
+
+class BenchmarkDeletable(models.Candidate, models.CollectionDeleteable):
+    @classmethod
+    def collection_name(cls):
+        return "benchmark_deletables"
+
+
+def model_benchmarks(iterations):
+    names = (f"candidate_{i}" for i in itertools.count())
+    pending = []
+    def new_candidate():
+        pending.append(BenchmarkCandidate(next(names)))
+    created = report.measure("model.sync.create", lambda: pending.pop().sync(), iterations, setup=new_candidate)
+
+    candidate = BenchmarkCandidate("candidate_0").read()
+    def bump():
+        candidate.num_votes += 1
+    updated = report.measure("model.sync.update", candidate.sync, iterations, setup=bump)
+    read = report.measure("model.read", lambda: BenchmarkCandidate("candidate_0").read(), iterations)
+
+    group = [BenchmarkCandidate(f"candidate_{i}").read() for i in range(min(100, iterations))]
+    def bump_group():
+        for model in group:
+            model.num_votes += 1
+    synced_many = report.measure(f"model.sync_many.{len(group)}", lambda: models.ModelBase.sync_many(group), max(1, iterations // 10), setup=bump_group)
+    streamed = report.measure("model.stream.all", lambda: sum(1 for _ in BenchmarkCandidate.stream(page_size=100)), max(1, iterations // 10))
+    return [created, updated, read, synced_many, streamed]
+
+
+def vote_benchmarks(iterations):
+    election = BenchmarkElection("benchmark_election")
+    election.state = models.Election.STATE_OPEN
+    election.sync()
+    counts = dict((f"candidate_{i}", i + 1) for i in range(10))
+    return [report.measure("election.record_votes.10_candidates", lambda: election.record_votes(counts, candidate_class=BenchmarkCandidate, results_class=BenchmarkElectionResults), iterations)]
+
+
+def delete_benchmarks(iterations, documents):
+    def fill():
+        models.ModelBase.sync_many(BenchmarkDeletable(f"deletable_{i}") for i in range(documents))
+    result = report.measure(f"collection.delete.{documents}", BenchmarkDeletable.delete_all_documents_in_collection, iterations, warmup=0, setup=fill)
+    result['documents_per_second'] = documents / (result['mean_ms'] / 1000)
+    return [result]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_emulator(timeout=60):
+    host_port = f"127.0.0.1:{_free_port()}"
+    emulator = subprocess.Popen(["gcloud", "emulators", "firestore", "start", f"--host-port={host_port}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    host, port = host_port.split(":")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, int(port)), timeout=1).close()
+            os.environ['FIRESTORE_EMULATOR_HOST'] = host_port
+            return emulator
+        except OSError:
+            time.sleep(0.5)
+    os.killpg(emulator.pid, signal.SIGTERM)
+    raise RuntimeError(f"The Firestore emulator didn't start listening on {host_port} within {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--delete-documents", type=int, default=1000, help="Documents in each collection deleted")
+    parser.add_argument("--delete-iterations", type=int, default=3)
+    parser.add_argument("--start-emulator", action="store_true", help="Start a Firestore emulator for the run")
+    parser.add_argument("--output", help="Append the report to this file as a JSON line")
+    args = parser.parse_args()
+
+    emulator = start_emulator() if args.start_emulator else None
+    if 'FIRESTORE_EMULATOR_HOST' not in os.environ:
+        parser.error("Set FIRESTORE_EMULATOR_HOST or pass --start-emulator; this suite isn't meant to run against a real project")
+    try:
+        results = model_benchmarks(args.iterations) + vote_benchmarks(args.iterations) + delete_benchmarks(args.delete_iterations, args.delete_documents)
+        report.report("voting", results, output=args.output, firestore=os.environ['FIRESTORE_EMULATOR_HOST'])
+    finally:
+        for model_class in (BenchmarkCandidate, BenchmarkElection, BenchmarkElectionResults, BenchmarkDeletable):
+            model_class.delete_all_documents_in_collection(recursive=True)
+        if emulator is not None:
+            # gcloud runs the emulator as a child process, so the whole group has to go.
+            os.killpg(emulator.pid, signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Vote ingestion with an in-process write-behind buffer.
+
+Accepting a vote only puts it on a bounded in-memory queue. A background flusher drains the queue, adds up
+votes per election and candidate, and writes each election's totals with one Election.record_votes batch
+whenever enough votes have piled up or enough time has passed, whichever comes first. However many votes
+arrive, each election sees a few batched increments per second.
+
+When the queue is full, submit() raises BufferFull rather than letting memory grow; callers should turn that
+into a retry-later response. Votes still buffered at shutdown are flushed by close().
+
+Votes submitted with a voter ID that hasn't been entered in the election's voter ledger yet (see ledger) are
+entered at flush, before they're counted; a vote whose voter turns out to be in the ledger already isn't counted.
+"""
+
+import atexit
+import collections
+import logging
+import queue
+import threading
+import time
+import models
+from google.api_core import exceptions
+
+LOG=logging.getLogger("ingestion")
+
+
+class BufferFull(Exception):
+    pass
+
+
+# Errors that would fail the same way however often the write was retried.
+NOT_RETRYABLE = (ValueError, TypeError, exceptions.InvalidArgument)
+
+
+class VoteBuffer():
+
+    def __init__(self, max_pending=100000, flush_size=10000, flush_interval=1.0, election_cache_seconds=30.0, max_attempts=5, on_settled=None, max_elections=1000):
+        # Votes accepted but not yet taken by the flusher.
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.election_cache_seconds = election_cache_seconds
+        # (election id, candidate id) -> votes taken off the queue but not yet written.
+        self._pending = collections.Counter()
+        # election id -> {voter id: candidate id} for voters to enter in the ledger with those votes.
+        self._pending_voters = collections.defaultdict(dict)
+        self.max_attempts = max_attempts
+        # election id -> flushes in a row that have failed to write its votes.
+        self._failures = collections.Counter()
+        # Called with (election id, voter ids) once voters' votes have been through a flush: entered in the
+        # ledger, or dropped.
+        self.on_settled = on_settled
+        # election id -> (monotonic time read, election or None), least recently used first.
+        self._elections = collections.OrderedDict()
+        self.max_elections = max_elections
+        self._elections_lock = threading.Lock()
+        self._flusher = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.votes_written = 0
+        self.votes_dropped = 0
+        self.flushes = 0
+
+    def election(self, election_id):
+        '''
+        The election, read at most once per election_cache_seconds; None if it doesn't exist. Only the
+        max_elections most recently used are kept.
+        '''
+        now = time.monotonic()
+        with self._elections_lock:
+            cached = self._elections.get(election_id)
+            if cached is not None:
+                self._elections.move_to_end(election_id)
+        if cached is not None and now - cached[0] < self.election_cache_seconds:
+            return cached[1]
+        election = models.Election(election_id).read()
+        with self._elections_lock:
+            self._elections[election_id] = (now, election)
+            self._elections.move_to_end(election_id)
+            while len(self._elections) > self.max_elections:
+                self._elections.popitem(last=False)
+        return election
+
+    def submit(self, election_id, candidate_id, voter_id=None, timeout=0.05):
+        '''
+        Accept a vote for writing later, entering voter_id in the election's voter ledger first if it's given.
+        Raises BufferFull if the buffer stays full for timeout seconds.
+        '''
+        self._ensure_flusher()
+        try:
+            self._queue.put((election_id, candidate_id, voter_id), timeout=timeout)
+        except queue.Full:
+            raise BufferFull(f"{self._queue.maxsize} votes are already waiting to be written")
+
+    def pending(self):
+        return self._queue.qsize() + sum(self._pending.values())
+
+    def _ensure_flusher(self):
+        # Started on first use rather than at import, so a forking server starts it in each worker.
+        if self._flusher is not None:
+            return
+        with self._start_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name="vote-flusher", daemon=True)
+                self._flusher.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._collect(self.flush_size, time.monotonic() + self.flush_interval)
+            self.flush()
+        # Drain whatever arrived before shutdown.
+        self._collect(None, None)
+        self.flush()
+
+    def _collect(self, limit, deadline):
+        '''
+        Move votes from the queue into the pending totals until limit votes have been taken or the deadline passes.
+        With no deadline, take whatever is queued without waiting.
+        '''
+        taken = 0
+        while limit is None or taken < limit:
+            try:
+                if deadline is None:
+                    vote = self._queue.get_nowait()
+                else:
+                    vote = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            election_id, candidate_id, voter_id = vote
+            if voter_id is not None:
+                if voter_id in self._pending_voters[election_id]:
+                    # Twice in one flush: the second one can't be a first vote.
+                    continue
+                self._pending_voters[election_id][voter_id] = candidate_id
+            self._pending[(election_id, candidate_id)] += 1
+            taken += 1
+
+    def flush(self):
+        '''
+        Write the pending totals, one batch per election. Totals that fail to write stay pending for the next flush,
+        up to max_attempts flushes in a row; after that, or after an error that retrying won't fix, they're dropped.
+        '''
+        if not self._pending:
+            return
+        by_election = collections.defaultdict(dict)
+        for (election_id, candidate_id), votes in self._pending.items():
+            by_election[election_id][candidate_id] = votes
+        self._pending = collections.Counter()
+        pending_voters, self._pending_voters = self._pending_voters, collections.defaultdict(dict)
+        for election_id, counts in by_election.items():
+            voters = None
+            try:
+                election = self.election(election_id)
+                if election is None:
+                    LOG.error("Dropping %d votes for missing election %s", sum(counts.values()), election_id)
+                    self._settle(election_id, pending_voters.pop(election_id, {}))
+                    continue
+                voters = pending_voters.pop(election_id, None)
+                if voters:
+                    try:
+                        already_voted = election.claim_voters(voters)
+                    except models.Election.VotersPartlyClaimed as e:
+                        # The voters that got in are entered for good, so a retry of these counts mustn't try to enter
+                        # them again, or it would take them for repeat voters. Only the rest stay with the counts.
+                        counts = self._without_second_votes(election_id, counts, voters, e.already_voted)
+                        for voter_id in e.claimed:
+                            voters.pop(voter_id)
+                        self._settle(election_id, e.claimed + e.already_voted)
+                        raise e.__cause__
+                    self._settle(election_id, voters)
+                    # Entered in the ledger now, so a retry of these counts mustn't enter them again.
+                    counts = self._without_second_votes(election_id, counts, voters, already_voted)
+                    voters = None
+                    if not counts:
+                        continue
+                try:
+                    election.record_votes(counts)
+                except models.Election.VotesPartlyRecorded as e:
+                    # Some commits went through: count those as written and leave only the rest to retry or drop.
+                    self.votes_written += sum(e.recorded.values())
+                    counts = e.remaining
+                    raise e.__cause__
+                self._failures.pop(election_id, None)
+                self.votes_written += sum(counts.values())
+                self.flushes += 1
+            except NOT_RETRYABLE:
+                LOG.exception("Dropping %d votes for election %s that can't be written", sum(counts.values()), election_id)
+                self._drop(election_id, counts, voters)
+            except Exception:
+                self._failures[election_id] += 1
+                if self._failures[election_id] >= self.max_attempts:
+                    LOG.exception("Dropping %d votes for election %s after %d failed writes", sum(counts.values()), election_id, self._failures[election_id])
+                    self._drop(election_id, counts, voters)
+                    continue
+                LOG.exception("Failed to write %d votes for election %s; will retry", sum(counts.values()), election_id)
+                for candidate_id, votes in counts.items():
+                    self._pending[(election_id, candidate_id)] += votes
+                if voters:
+                    self._pending_voters[election_id].update(voters)
+
+    def _without_second_votes(self, election_id, counts, voters, already_voted):
+        '''
+        counts less the votes of voters found in the ledger already, who are taken out of voters.
+        '''
+        counts = dict(counts)
+        for voter_id in already_voted:
+            LOG.info("Not counting a second vote from voter %s in election %s", voter_id, election_id)
+            counts[voters.pop(voter_id)] -= 1
+        return dict((candidate_id, votes) for candidate_id, votes in counts.items() if votes > 0)
+
+    def _drop(self, election_id, counts, voters):
+        self._failures.pop(election_id, None)
+        self.votes_dropped += sum(counts.values())
+        if voters:
+            self._settle(election_id, voters)
+
+    def _settle(self, election_id, voters):
+        if voters and self.on_settled is not None:
+            self.on_settled(election_id, list(voters))
+
+    def close(self, timeout=10.0):
+        '''
+        Stop accepting work from the queue and flush everything buffered.
+        '''
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout)
+        else:
+            self._collect(None, None)
+            self.flush()
+
+
+def install_shutdown_drain(vote_buffer):
+    atexit.register(vote_buffer.close)
+    return vote_buffer
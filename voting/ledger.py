@@ -0,0 +1,253 @@
+"""
+One vote per voter, without a database read for every vote.
+
+Each election's voters are recorded in Firestore (Election.voters(), one document per voter). In front of that
+ledger, each process keeps a Bloom filter of the voters it knows about. The filter is rebuilt from the ledger in
+a background thread the first time the election is used, and then added to as votes arrive; until it's ready,
+every vote is checked against the ledger. A Bloom filter never says no to a voter it holds, so:
+
+* a voter the filter has never seen is a first-time voter as far as this process knows. The vote goes straight
+  to the vote buffer, and the voter is entered in the ledger with the buffer's next flush. Until then the voter
+  is kept as unsettled, so another vote from them is turned away without going to the ledger, which doesn't
+  have them yet;
+* a voter the filter may have seen (a real repeat, or a false positive at error_rate) who isn't unsettled is
+  checked against the ledger with Election.claim_voter, which Firestore checks and writes atomically.
+
+Other instances' voters aren't in this process's filter until it's rebuilt. The ledger entry written at flush
+is a create that fails if the voter is already there, so those duplicates are caught there and not counted.
+
+When an election closes, its filter is saved as a serialized bit array (split over documents, since a filter
+for millions of voters is bigger than a document can hold), and later loads read that instead of the ledger.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import models
+from google.cloud import firestore
+
+LOG=logging.getLogger("ledger")
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.001
+# Firestore documents hold at most 1 MiB; filter chunks stay well under.
+CHUNK_BYTES = 900 * 1024
+
+
+class BloomFilter():
+    '''
+    A fixed-size Bloom filter over strings, sized for capacity items at error_rate false positives.
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, num_bits=None, num_hashes=None, bits=None):
+        if num_bits is None:
+            num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Two 64-bit hashes combined (Kirsch-Mitzenmacher) stand in for num_hashes independent ones.
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        '''
+        Add an item; False if it may have been there already.
+        '''
+        new = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def size_bytes(self):
+        return len(self.bits)
+
+    def to_bytes(self):
+        return self.num_bits.to_bytes(8, 'little') + self.num_hashes.to_bytes(2, 'little') + self.count.to_bytes(8, 'little') + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        num_bits = int.from_bytes(data[:8], 'little')
+        bloom = cls(num_bits=num_bits, num_hashes=int.from_bytes(data[8:10], 'little'), bits=bytearray(data[18:]))
+        bloom.count = int.from_bytes(data[10:18], 'little')
+        return bloom
+
+
+class VoterLedger():
+    '''
+    One election's voter filter in this process.
+    '''
+
+    FIRST_VOTE = "first_vote"
+    ALREADY_VOTED = "already_voted"
+    CLAIMED = "claimed"
+
+    def __init__(self, election, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.election = election
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # None until loaded; meanwhile every vote is checked against the ledger.
+        self.filter = None
+        self._lock = threading.Lock()
+        self._loader = None
+        # Voters claimed in the ledger while the filter was loading, to add to it once it has.
+        self._claimed_while_loading = []
+        # First-time voters whose votes haven't been written yet, so the ledger doesn't have them.
+        self._unsettled = set()
+        self.fast_path = 0
+        self.checked = 0
+        self.duplicates = 0
+
+    def _saved_filter(self):
+        return models.Storage.db().collection("voter_filters").document(self.election._document_id)
+
+    def load(self):
+        '''
+        The saved filter for a closed election, or else one rebuilt from the ledger.
+        '''
+        bloom = None
+        if self.election.state == models.Election.STATE_CLOSED:
+            bloom = self._read_saved()
+        if bloom is None:
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            for voter_id in self.election.voter_ids():
+                bloom.add(voter_id)
+            LOG.info("Rebuilt the voter filter for %s from %d ledger entries", self.election._document_id, bloom.count)
+        with self._lock:
+            for voter_id in self._claimed_while_loading:
+                bloom.add(voter_id)
+            self._claimed_while_loading = []
+            self.filter = bloom
+        return self
+
+    def start_loading(self):
+        '''
+        Load the filter in a background thread, unless it's loaded or loading already.
+        '''
+        with self._lock:
+            if self.filter is not None or (self._loader is not None and self._loader.is_alive()):
+                return
+            self._loader = threading.Thread(target=self._load_in_background, name=f"voter-filter-{self.election._document_id}", daemon=True)
+            self._loader.start()
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            # Votes keep being checked against the ledger; the next vote starts another load.
+            LOG.exception("Failed to load the voter filter for %s", self.election._document_id)
+
+    def _read_saved(self):
+        chunks = sorted(self._saved_filter().collection("chunks").stream(), key=lambda snapshot: int(snapshot.id))
+        if not chunks:
+            return None
+        return BloomFilter.from_bytes(b"".join(snapshot.to_dict()["bits"] for snapshot in chunks))
+
+    def save(self):
+        '''
+        Write the filter to Firestore as a serialized bit array, in chunks that each fit in a document.
+        '''
+        data = self.filter.to_bytes()
+        batch = models.Storage.db().batch()
+        for index, start in enumerate(range(0, len(data), CHUNK_BYTES)):
+            batch.set(self._saved_filter().collection("chunks").document(str(index)), {"bits": data[start:start + CHUNK_BYTES]})
+        batch.set(self._saved_filter(), {"voters": self.filter.count, "size_bytes": self.filter.size_bytes, "t_md": firestore.SERVER_TIMESTAMP})
+        batch.commit()
+        LOG.info("Saved the voter filter for %s: %d voters in %d bytes", self.election._document_id, self.filter.count, len(data))
+
+    def admit(self, voter_id, candidate_id):
+        '''
+        FIRST_VOTE if the voter is new to this process: the vote can go straight to the buffer, which enters the
+        voter in the ledger, and the voter is unsettled until settle() says it has. CLAIMED if the filter may have
+        seen the voter (or isn't loaded yet) but the ledger hadn't, and the voter has now been entered in it.
+        ALREADY_VOTED if the voter is unsettled or the ledger already had them.
+        '''
+        with self._lock:
+            loading = self.filter is None
+            if not loading:
+                if self.filter.add(voter_id):
+                    self._unsettled.add(voter_id)
+                    self.fast_path += 1
+                    return VoterLedger.FIRST_VOTE
+                if voter_id in self._unsettled:
+                    self.duplicates += 1
+                    return VoterLedger.ALREADY_VOTED
+            self.checked += 1
+        if self.election.claim_voter(voter_id, candidate_id):
+            if loading:
+                with self._lock:
+                    if self.filter is None:
+                        self._claimed_while_loading.append(voter_id)
+                    else:
+                        self.filter.add(voter_id)
+            return VoterLedger.CLAIMED
+        with self._lock:
+            self.duplicates += 1
+        return VoterLedger.ALREADY_VOTED
+
+    def settle(self, voter_ids):
+        '''
+        Stop treating first-time voters as unsettled: their votes have been through a flush, which entered them in
+        the ledger, or never will be, e.g. because the buffer was full or the votes were dropped.
+        '''
+        with self._lock:
+            self._unsettled.difference_update(voter_ids)
+
+
+class VoterLedgers():
+    '''
+    The process's voter ledgers, started loading the first time each election is voted in.
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._ledgers = {}
+        self._lock = threading.Lock()
+
+    def ledger(self, election):
+        '''
+        The election's ledger, straight away: its filter loads in the background.
+        '''
+        ledger = self._ledgers.get(election._document_id)
+        if ledger is None:
+            with self._lock:
+                ledger = self._ledgers.setdefault(election._document_id, VoterLedger(election, self.capacity, self.error_rate))
+        if ledger.filter is None:
+            ledger.start_loading()
+        return ledger
+
+    def settle(self, election_id, voter_ids):
+        '''
+        VoteBuffer's on_settled: the voters' buffered votes have been through a flush.
+        '''
+        ledger = self._ledgers.get(election_id)
+        if ledger is not None:
+            ledger.settle(voter_ids)
+
+    def close_election(self, election):
+        '''
+        Close an election to votes and save its voter filter.
+        '''
+        election.state = models.Election.STATE_CLOSED
+        election.sync_fields(["state"])
+        ledger = self.ledger(election)
+        if ledger.filter is None:
+            ledger.load()
+        ledger.save()
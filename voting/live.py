@@ -0,0 +1,278 @@
+"""
+Live election results pushed to browsers as Server-Sent Events.
+
+Each process keeps at most one Firestore listener per election, on the election's ElectionResults document,
+however many browsers are watching it. Changes from the listener are coalesced for coalesce_seconds and then fanned
+out as deltas (just the tallies that changed) to every subscriber's own bounded queue. The Firestore reads for an
+election therefore grow with the number of changes to its results, not with the number of viewers.
+
+A subscriber whose queue fills up is too slow to keep up. It's dropped, and its stream ends, rather than holding
+more and more undelivered events in memory. The browser's EventSource reconnects on its own and starts again
+from a fresh snapshot. When an election's last subscriber leaves, its listener is stopped.
+
+Events on the stream:
+
+    event: snapshot    data: {"election", "total_votes", "ranking": [{"candidate", "votes"}]}
+    event: delta       data: {"election", "total_votes", "tallies": {candidate: votes}}   (changed tallies only)
+
+A candidate that's no longer in the results, e.g. after results.recompute(), appears in a delta with null votes.
+
+with a comment line every heartbeat_seconds so idle connections aren't closed by proxies.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+import models
+import results
+
+LOG=logging.getLogger("live")
+
+# Marks the end of a subscriber's stream on its queue.
+_CLOSED = object()
+
+
+def _watch_results(election_id, callback):
+    '''
+    Start a Firestore listener on an election's results view. Returns the watch; unsubscribe() stops it.
+    '''
+    return models.ElectionResults(election_id).doc_ref().on_snapshot(callback)
+
+
+def _format_event(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscriber():
+
+    def __init__(self, election_id, max_queued):
+        self.election_id = election_id
+        self._queue = queue.Queue(maxsize=max_queued)
+        # Whether this subscriber has had a full snapshot; until then deltas would mean nothing to it.
+        self.has_snapshot = False
+        self.closed = False
+        self.dropped = False
+
+    def offer(self, event):
+        '''
+        Queue an event without waiting. False if the queue is full.
+        '''
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        self.closed = True
+        # Throw away whatever's undelivered so the end of the stream is the next thing read.
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self.offer(_CLOSED)
+
+    def events(self, heartbeat_seconds=15.0):
+        '''
+        The stream's text, event by event, until the subscriber is closed.
+        '''
+        while True:
+            try:
+                event = self._queue.get(timeout=heartbeat_seconds)
+            except queue.Empty:
+                if self.closed:
+                    return
+                yield ": keepalive\n\n"
+                continue
+            if event is _CLOSED:
+                return
+            yield event
+
+
+class ElectionFeed():
+    '''
+    One election's listener and its subscribers.
+    '''
+
+    def __init__(self, election_id, watch, coalesce_seconds, on_idle):
+        self.election_id = election_id
+        self._watch_results = watch
+        self.coalesce_seconds = coalesce_seconds
+        self._on_idle = on_idle
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        # The document as the listener last saw it, and as it was last published to subscribers.
+        self._latest = None
+        self._published = None
+        self._sequence = 0
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._watch = None
+        self._publisher = None
+        self.snapshots_received = 0
+        self.events_published = 0
+        self.subscribers_dropped = 0
+
+    def start(self):
+        self._publisher = threading.Thread(target=self._run, name=f"live-results-{self.election_id}", daemon=True)
+        self._publisher.start()
+        self._watch = self._watch_results(self.election_id, self._on_snapshot)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._changed.set()
+        if self._watch is not None:
+            self._watch.unsubscribe()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, set()
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        # Called on the listener's thread: note the change and leave the work to the publisher.
+        snapshot = snapshots[-1] if snapshots else None
+        data = snapshot.to_dict() if snapshot is not None and snapshot.exists else {}
+        with self._lock:
+            self._latest = {'tallies': dict(data.get('tallies') or {}), 'total_votes': data.get('total_votes', 0)}
+            self.snapshots_received += 1
+        self._changed.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._changed.wait()
+            if self._stop.is_set():
+                return
+            # Let changes that arrive close together go out as one event.
+            time.sleep(self.coalesce_seconds)
+            self._changed.clear()
+            try:
+                self.publish()
+            except Exception:
+                LOG.exception("Couldn't publish live results for %s", self.election_id)
+
+    def _snapshot_event(self):
+        election_results = models.ElectionResults(self.election_id)
+        election_results.tallies = self._published['tallies']
+        election_results.total_votes = self._published['total_votes']
+        return _format_event("snapshot", results._to_json(self.election_id, election_results), self._sequence)
+
+    def publish(self):
+        '''
+        Send what's changed since the last publish to every subscriber, and a snapshot to any that haven't had one.
+        '''
+        with self._lock:
+            latest = self._latest
+            if latest is None:
+                return
+            previous = self._published or {'tallies': {}, 'total_votes': 0}
+            changed = dict((candidate_id, votes) for candidate_id, votes in latest['tallies'].items() if previous['tallies'].get(candidate_id) != votes)
+            changed.update((candidate_id, None) for candidate_id in previous['tallies'] if candidate_id not in latest['tallies'])
+            changed_any = bool(changed) or latest['total_votes'] != previous['total_votes']
+            if changed_any or self._published is None:
+                self._sequence += 1
+            self._published = latest
+            delta = None
+            if changed_any:
+                delta = _format_event("delta", {"election": self.election_id, "total_votes": latest['total_votes'], "tallies": changed}, self._sequence)
+            snapshot = None
+            slow = []
+            for subscriber in list(self._subscribers):
+                if not subscriber.has_snapshot:
+                    snapshot = snapshot or self._snapshot_event()
+                    subscriber.has_snapshot = subscriber.offer(snapshot)
+                    delivered = subscriber.has_snapshot
+                elif delta is not None:
+                    delivered = subscriber.offer(delta)
+                else:
+                    continue
+                if not delivered:
+                    slow.append(subscriber)
+                    self._subscribers.discard(subscriber)
+            if delta is not None or snapshot is not None:
+                self.events_published += 1
+        for subscriber in slow:
+            subscriber.dropped = True
+            subscriber.close()
+            self.subscribers_dropped += 1
+            LOG.info("Dropped a subscriber to %s that couldn't keep up", self.election_id)
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._published is not None:
+                subscriber.has_snapshot = subscriber.offer(self._snapshot_event())
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            idle = not self._subscribers
+        if idle:
+            self._on_idle(self)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+class LiveResults():
+    '''
+    The process's election feeds: subscribe() to an election's results, and the feed is started on the first
+    subscriber and stopped after the last.
+    '''
+
+    def __init__(self, max_queued=64, coalesce_seconds=0.25, heartbeat_seconds=15.0, watch=_watch_results):
+        self.max_queued = max_queued
+        self.coalesce_seconds = coalesce_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self._watch = watch
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, election_id):
+        subscriber = Subscriber(election_id, self.max_queued)
+        with self._lock:
+            feed = self._feeds.get(election_id)
+            if feed is None:
+                feed = ElectionFeed(election_id, self._watch, self.coalesce_seconds, self._stop_if_idle).start()
+                self._feeds[election_id] = feed
+                LOG.info("Started listening for results of %s", election_id)
+            # Under the hub's lock so the feed can't be stopped between being found and being subscribed to.
+            feed.subscribe(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            feed = self._feeds.get(subscriber.election_id)
+        if feed is not None:
+            feed.unsubscribe(subscriber)
+
+    def _stop_if_idle(self, feed):
+        with self._lock:
+            if feed.subscriber_count() or self._feeds.get(feed.election_id) is not feed:
+                return
+            del self._feeds[feed.election_id]
+        feed.stop()
+        LOG.info("Stopped listening for results of %s", feed.election_id)
+
+    def stream(self, election_id):
+        '''
+        A subscription's Server-Sent Events text, ending the subscription when the stream is closed or dropped.
+        '''
+        subscriber = self.subscribe(election_id)
+        try:
+            yield "retry: 2000\n\n"
+            yield from subscriber.events(self.heartbeat_seconds)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def feed(self, election_id):
+        with self._lock:
+            return self._feeds.get(election_id)
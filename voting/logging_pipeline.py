@@ -0,0 +1,207 @@
+"""
+Non-blocking logging for the voting app. The same pipeline as work-about-work's logging_service.pipeline; each
+app is deployed on its own, so each carries its own copy.
+
+Request threads never write logs themselves. The root logger's only handler puts records on a bounded
+in-memory queue and returns; a single exporter thread takes them off in batches and writes each batch with
+one write and one flush. If the queue is ever full, records are dropped and counted rather than making a
+request wait.
+
+In production records are written to stdout as JSON lines, which App Engine's logging agent turns into
+structured Cloud Logging entries (severity, source location, any extra fields) without a Cloud Logging
+client in the process. In development they're written as plain text.
+
+Log calls should pass their arguments rather than formatting them up front, so nothing is built unless the
+level is enabled; for an argument that's expensive to compute, wrap the computation in lazy():
+
+    LOG.debug("Syncing %s", lazy(lambda: model.doc_ref().path))
+"""
+
+import atexit
+import copy
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+PLAIN_FORMAT = '[%(asctime)s] %(levelname)s %(filename)s:%(lineno)d|| %(message)s'
+MAX_QUEUED_RECORDS = 10000
+MAX_BATCH_SIZE = 500
+
+_listener = None
+_install_lock = threading.Lock()
+
+
+class Lazy:
+    """
+    A log argument that's only computed if the record is actually formatted, and then only once.
+    """
+
+    __slots__ = ('_function', '_value', '_computed')
+
+    def __init__(self, function):
+        self._function = function
+        self._computed = False
+
+    def _get(self):
+        if not self._computed:
+            self._value = self._function()
+            self._computed = True
+        return self._value
+
+    def __str__(self):
+        return str(self._get())
+
+    def __repr__(self):
+        return repr(self._get())
+
+
+def lazy(function):
+    return Lazy(function)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, in the shape Cloud Logging reads structured entries from stdout.
+    Anything passed as extra={'fields': {...}} is added to the entry as is.
+    """
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        if record.stack_info:
+            message = f"{message}\n{record.stack_info}"
+        entry = {
+                # Cloud Logging has no level below DEBUG.
+                'severity': record.levelname if record.levelno >= logging.DEBUG else 'DEBUG',
+                'message': message,
+                'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+                'logger': record.name,
+                'thread': record.threadName,
+                'logging.googleapis.com/sourceLocation': {'file': record.pathname, 'line': record.lineno, 'function': record.funcName},
+                }
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that drops records, and counts them, rather than waiting when the queue is full.
+    """
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Whatever depends on the caller's state (the arguments, the exception's traceback) is resolved here,
+        # in the caller's thread; laying the record out is left to the exporter.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Not locked: an occasional lost count is better than a lock on every log call.
+            self.dropped += 1
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """
+    A StreamHandler that can write a whole batch of records with one write and one flush.
+    """
+
+    def emit_batch(self, records):
+        try:
+            self.stream.write(''.join(self.format(record) + self.terminator for record in records))
+            self.flush()
+        except Exception:
+            self.handleError(records[0])
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    A QueueListener that hands its handlers everything waiting on the queue, up to batch_size records, at once.
+    Under light load every batch is a single record, so nothing waits to be written; under heavy load batches
+    grow and the cost of writing is spread over them.
+    """
+
+    def __init__(self, record_queue, *handlers, batch_size=MAX_BATCH_SIZE):
+        super().__init__(record_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        record_queue = self.queue
+        has_task_done = hasattr(record_queue, 'task_done')
+        stopping = False
+        while not stopping:
+            batch = []
+            record = record_queue.get()
+            while True:
+                if has_task_done:
+                    record_queue.task_done()
+                if record is self._sentinel:
+                    stopping = True
+                    break
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = record_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self.handle_batch(batch)
+
+    def handle_batch(self, records):
+        for handler in self.handlers:
+            accepted = [record for record in records if record.levelno >= handler.level]
+            if not accepted:
+                continue
+            if hasattr(handler, 'emit_batch'):
+                handler.emit_batch(accepted)
+            else:
+                for record in accepted:
+                    handler.handle(record)
+
+
+def install(level=logging.DEBUG, structured=False, stream=None, max_queued_records=MAX_QUEUED_RECORDS, batch_size=MAX_BATCH_SIZE):
+    """
+    Route all logging through the queue and start the exporter. Replaces any handlers already on the root logger.
+    Only the first call does anything; the exporter is flushed and stopped when the process exits.
+    """
+    global _listener
+    with _install_lock:
+        if _listener is not None:
+            return _listener
+        record_queue = queue.Queue(maxsize=max_queued_records)
+        output = BatchStreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter() if structured else logging.Formatter(PLAIN_FORMAT))
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(NonBlockingQueueHandler(record_queue))
+        root.setLevel(level)
+        _listener = BatchingQueueListener(record_queue, output, batch_size=batch_size)
+        _listener.start()
+        atexit.register(_listener.stop)
+        return _listener
+
+
+def dropped_records():
+    """
+    How many records have been dropped because the queue was full.
+    """
+    return sum(getattr(handler, 'dropped', 0) for handler in logging.getLogger().handlers)
@@ -1,12 +1,40 @@
+import asyncio
+import collections
+import concurrent.futures
+import copy
 import datetime
+import itertools
 import json
 import logging
+import os
+import random
+import threading
+import time
+import weakref
 import python_logging_base
+from logging_pipeline import lazy
+import metrics
+from metrics import Histogram
+from google.api_core import exceptions
 from google.cloud import firestore
 from google.oauth2.service_account import Credentials
 
+# The level comes from the app's logging setup (see logging_pipeline); trace calls cost next to nothing when it's off.
 LOG=logging.getLogger("models")
-LOG.setLevel(logging.TRACE)
+
+# Firestore's limit on the size of a document ID, in bytes.
+MAX_DOCUMENT_ID_BYTES = 1500
+
+def valid_document_id(document_id):
+    '''
+    Whether document_id can name a Firestore document: a non-empty string without a "/", not "." or "..",
+    not of the reserved form __name__, and no longer than MAX_DOCUMENT_ID_BYTES.
+    '''
+    if not isinstance(document_id, str) or not document_id or "/" in document_id or document_id in (".", ".."):
+        return False
+    if document_id.startswith("__") and document_id.endswith("__"):
+        return False
+    return len(document_id.encode('utf-8')) <= MAX_DOCUMENT_ID_BYTES
 
 class Storage():
     @classmethod
@@ -22,15 +50,347 @@ class Storage():
     @classmethod
     def db(cls):
         if not hasattr(cls, '_db'):
-            cls._db = firestore.Client(credentials=cls.load_credentials())
+            if 'FIRESTORE_EMULATOR_HOST' in os.environ:
+                # The client library points itself at the emulator; it only needs a project name.
+                cls._db = firestore.Client(project=os.environ.get('GOOGLE_CLOUD_PROJECT', 'google-cloud-apps-local'))
+            else:
+                cls._db = firestore.Client(credentials=cls.load_credentials())
         return cls._db
 
     @classmethod
-    def transaction(cls):
-        return cls.db().transaction()
+    def transaction(cls, **kwargs):
+        return cls.db().transaction(**kwargs)
+
+
+class AsyncStorage():
+    '''
+    The asyncio counterpart of Storage, for code running on an event loop.
+    An async client's channel belongs to the loop it was created on, so there's one client per running loop.
+    '''
+    _clients = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def db(cls):
+        loop = asyncio.get_running_loop()
+        client = cls._clients.get(loop)
+        if client is None:
+            if 'FIRESTORE_EMULATOR_HOST' in os.environ:
+                client = firestore.AsyncClient(project=os.environ.get('GOOGLE_CLOUD_PROJECT', 'google-cloud-apps-local'))
+            else:
+                if not hasattr(cls, '_credentials'):
+                    cls._credentials = Storage.load_credentials()
+                client = firestore.AsyncClient(credentials=cls._credentials)
+            cls._clients[loop] = client
+        return client
+
+    @classmethod
+    def transaction(cls, **kwargs):
+        return cls.db().transaction(**kwargs)
+
+
+class TransactionPolicy():
+    '''
+    How hard a sync tries before giving up.
+
+    max_attempts applies twice over: to Firestore's own retries of a transaction that lost a contention race,
+    and to our retries of a sync whose models turned out to be stale. Before retrying a stale sync the models
+    are re-read and merged with what's in the db (see ModelBase.rebase()), after a jittered exponential
+    backoff: a random delay of up to base_delay * 2 ** (attempt - 1), capped at max_delay.
+    With merge_on_conflict=False a stale model fails the sync straight away, as it always used to.
+    '''
+
+    def __init__(self, max_attempts=5, base_delay=0.05, max_delay=2.0, merge_on_conflict=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.merge_on_conflict = merge_on_conflict
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class TransactionMetrics():
+    '''
+    The hook syncs report to. Set ModelBase.transaction_metrics to an instance of a subclass to send these
+    somewhere; the base class drops everything. Calls come from whichever thread synced, so implementations
+    must be thread safe.
+    '''
+
+    def transaction_finished(self, collection, seconds, retries, succeeded):
+        '''
+        A sync touching collection finished after seconds, having retried retries times, counting both
+        Firestore's contention retries and our retries of stale models.
+        '''
+        pass
+
+    def conflict(self, collection, document_path):
+        '''
+        A model was found to be stale when syncing, i.e. someone else wrote the document since we read it.
+        '''
+        pass
+
+
+class InMemoryTransactionMetrics(TransactionMetrics):
+    '''
+    Keeps per-collection latency, retry and conflict histograms in memory, along with conflict counts per
+    document so the hottest documents can be found. Conflict counts are kept for at most max_documents
+    documents: when twice that many have conflicted, all but the max_documents hottest are forgotten.
+    '''
+
+    def __init__(self, max_documents=1000):
+        self._lock = threading.Lock()
+        self.max_documents = max_documents
+        self.latency = {}
+        self.retries = {}
+        self.failures = collections.Counter()
+        self.conflicts = collections.Counter()
+        self.conflicts_by_document = collections.Counter()
+
+    def transaction_finished(self, collection, seconds, retries, succeeded):
+        with self._lock:
+            self.latency.setdefault(collection, Histogram(metrics.LATENCY_BUCKETS)).observe(seconds)
+            self.retries.setdefault(collection, Histogram(metrics.COUNT_BUCKETS)).observe(retries)
+            if not succeeded:
+                self.failures[collection] += 1
+
+    def conflict(self, collection, document_path):
+        with self._lock:
+            self.conflicts[collection] += 1
+            self.conflicts_by_document[document_path] += 1
+            if len(self.conflicts_by_document) > 2 * self.max_documents:
+                self.conflicts_by_document = collections.Counter(dict(self.conflicts_by_document.most_common(self.max_documents)))
+
+    def hot_documents(self, n=10):
+        with self._lock:
+            return self.conflicts_by_document.most_common(n)
+
+    def to_dict(self):
+        with self._lock:
+            return dict((collection, {
+                "latency_seconds": self.latency[collection].to_dict(),
+                "retries": self.retries[collection].to_dict(),
+                "conflicts": self.conflicts[collection],
+                "failures": self.failures[collection],
+                }) for collection in self.latency)
+
 
+class TransactionRunner():
+    '''
+    Runs one sync of a group of models under a TransactionPolicy, reporting to a TransactionMetrics.
+
+    attempt() does the writing; it calls invoked() at the start of every run of a Firestore transaction
+    function, so Firestore's own retries are counted, and raises ModelBase.StaleModels when the group can't
+    be written because some of its models are stale. Those models are then re-read with reread(models),
+    which returns their snapshots, rebased onto them, and attempt() is tried again after a backoff.
+    '''
+
+    def __init__(self, models, policy, metrics):
+        self._models = models
+        self.policy = policy
+        self.metrics = metrics
+        self.invocations = 0
+        self.attempts = 0
+
+    def invoked(self):
+        self.invocations += 1
+
+    def _collections(self):
+        return set(model.collection_name() for model in self._models)
+
+    def _finished(self, started, succeeded):
+        # Every run of a transaction function beyond the first of each attempt was a Firestore retry.
+        retries = (self.attempts - 1) + max(0, self.invocations - self.attempts)
+        for collection in self._collections():
+            self.metrics.transaction_finished(collection, time.monotonic() - started, retries, succeeded)
+
+    def _stale(self, error):
+        '''
+        Record a stale group; returns whether it's worth re-reading and trying again.
+        '''
+        for model in error.models:
+            self.metrics.conflict(model.collection_name(), model.document_path())
+        return self.policy.merge_on_conflict and self.attempts < self.policy.max_attempts
+
+    def run(self, attempt, reread):
+        started = time.monotonic()
+        while True:
+            self.attempts += 1
+            try:
+                result = attempt()
+            except ModelBase.StaleModels as error:
+                if not self._stale(error):
+                    self._finished(started, False)
+                    raise
+                try:
+                    ModelBase.rebase(error.models, reread(error.models))
+                except Exception:
+                    self._finished(started, False)
+                    raise
+                time.sleep(self.policy.delay(self.attempts))
+                continue
+            except Exception:
+                self._finished(started, False)
+                raise
+            self._finished(started, True)
+            return result
+
+    async def run_async(self, attempt, reread):
+        '''
+        run() with an async attempt() and reread().
+        '''
+        started = time.monotonic()
+        while True:
+            self.attempts += 1
+            try:
+                result = await attempt()
+            except ModelBase.StaleModels as error:
+                if not self._stale(error):
+                    self._finished(started, False)
+                    raise
+                try:
+                    ModelBase.rebase(error.models, await reread(error.models))
+                except Exception:
+                    self._finished(started, False)
+                    raise
+                await asyncio.sleep(self.policy.delay(self.attempts))
+                continue
+            except Exception:
+                self._finished(started, False)
+                raise
+            self._finished(started, True)
+            return result
+
+
+class Field():
+    '''
+    A field of a model, declared on the class:
+
+        class Candidate(ModelBase):
+            num_votes = Field(int, default=0)
+
+    Declared fields are stored in __slots__ rather than an instance __dict__, and each model class gets
+    a to_dict / from_dict generated for exactly its fields (see ModelMeta), so models that only declare
+    fields don't need to write either. A class that declares fields is slotted, so any other attributes its
+    instances have need to be listed in its __slots__ too; if every class up to ModelBase is slotted the
+    instances have no __dict__ at all.
+
+    type is what the stored value is coerced to on read if it comes back as something else (e.g. a float
+    for an int field); a None value is left alone. Values of mutable types (dict, list, set) are copied
+    shallowly on read so changes to the model don't also change what dirty tracking diffs against.
+    Use factory rather than default for mutable defaults. key is the name in the document, if it differs.
+    '''
 
-class ModelBase:
+    MUTABLE_TYPES = (dict, list, set)
+
+    def __init__(self, type=None, default=None, factory=None, key=None):
+        self.type = type
+        self.default = default
+        self.factory = factory
+        self.key = key
+        # Filled in by ModelMeta.
+        self.name = None
+
+    @property
+    def mutable(self):
+        return self.type is not None and issubclass(self.type, Field.MUTABLE_TYPES)
+
+    def __repr__(self):
+        return f"Field: {self.name} ({self.type.__name__ if self.type else 'any'}) <-> {self.key!r}"
+
+
+def _replaced_by_fields(method):
+    '''
+    Marks a to_dict / from_dict that a subclass's generated one can replace, i.e. one nobody wrote by hand.
+    '''
+    method._replaced_by_fields = True
+    return method
+
+
+class ModelMeta(type):
+    '''
+    Collects a model class's Fields (its own and its bases') into _fields, turns them into slots, and
+    generates the class's _init_fields, to_dict and from_dict. A class that writes its own to_dict or
+    from_dict, or inherits one that was written by hand, keeps it; the generated ones are still there as
+    _fields_to_dict / _fields_from_dict to call from it.
+
+    The generated methods are plain straight-line code, one statement per field, compiled once per class,
+    so serializing a model doesn't loop over field metadata.
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        own_fields = []
+        for attribute, value in list(namespace.items()):
+            if isinstance(value, Field):
+                value.name = attribute
+                value.key = value.key or attribute
+                own_fields.append(value)
+                # The slot's member descriptor takes the field's place on the class.
+                del namespace[attribute]
+        if own_fields or '__slots__' in namespace:
+            slots = namespace.get('__slots__', ())
+            namespace['__slots__'] = tuple([slots] if isinstance(slots, str) else slots) + tuple(field.name for field in own_fields)
+        inherited_fields = []
+        for base in bases:
+            for field in getattr(base, '_fields', ()):
+                if field.name not in [f.name for f in inherited_fields + own_fields]:
+                    inherited_fields.append(field)
+        fields = tuple(inherited_fields + own_fields)
+        namespace['_fields'] = fields
+        generated = mcs._generate(name, fields)
+        namespace['_init_fields'] = generated['_init_fields']
+        namespace['_fields_to_dict'] = generated['_fields_to_dict']
+        namespace['_fields_from_dict'] = generated['_fields_from_dict']
+        cls = super().__new__(mcs, name, bases, namespace)
+        if fields:
+            for method_name in ('to_dict', 'from_dict'):
+                if getattr(getattr(cls, method_name, None), '_replaced_by_fields', False):
+                    setattr(cls, method_name, generated[f'_fields_{method_name}'])
+        # deserialize() can skip deep copying the document when from_dict is one that copies what it keeps.
+        cls._copies_on_read = bool(fields) and cls.from_dict is generated['_fields_from_dict']
+        return cls
+
+    @staticmethod
+    def _generate(class_name, fields):
+        env = {}
+        init_lines = []
+        to_dict_lines = []
+        from_dict_lines = []
+        for i, field in enumerate(fields):
+            env[f'_type_{i}'] = field.type
+            env[f'_default_{i}'] = field.default
+            env[f'_factory_{i}'] = field.factory
+            default = f'_factory_{i}()' if field.factory is not None else f'_default_{i}'
+            init_lines.append(f'    self.{field.name} = {default}')
+            to_dict_lines.append(f'    d[{field.key!r}] = self.{field.name}')
+            from_dict_lines.append(f'    value = pop({field.key!r}, _missing)')
+            from_dict_lines.append(f'    if value is _missing:')
+            from_dict_lines.append(f'        value = {default}')
+            if field.type is not None:
+                from_dict_lines.append(f'    elif value is not None and not isinstance(value, _type_{i}):')
+                from_dict_lines.append(f'        value = _type_{i}(value)')
+            if field.mutable:
+                from_dict_lines.append(f'    elif value is not None:')
+                from_dict_lines.append(f'        value = value.copy()')
+            from_dict_lines.append(f'    self.{field.name} = value')
+        env['_missing'] = object()
+        source = '\n'.join([
+            'def _init_fields(self):',
+            *(init_lines or ['    pass']),
+            'def _fields_to_dict(self, d):',
+            *to_dict_lines,
+            '    return d',
+            'def _fields_from_dict(self, d):',
+            '    pop = d.pop',
+            *from_dict_lines,
+            '    return d',
+            ])
+        exec(compile(source, f'<fields of {class_name}>', 'exec'), env)
+        for function_name in ('_init_fields', '_fields_to_dict', '_fields_from_dict'):
+            env[function_name].__qualname__ = f'{class_name}.{function_name}'
+        return dict((function_name, _replaced_by_fields(env[function_name])) for function_name in ('_init_fields', '_fields_to_dict', '_fields_from_dict'))
+
+
+class ModelBase(metaclass=ModelMeta):
     '''
     Base class for models saved in Firestore. This class handles the serialization / deserialization lifecycle
     for a model to and from a Firebase model-as-dictionary.
@@ -45,6 +405,28 @@ class ModelBase:
     class SubclassRequirementsTypeError(TypeError):
         pass
 
+    class PartialModelCannotBeSynced(Exception):
+        pass
+
+    class NothingToDeserialize(AttributeError):
+        pass
+
+    class StaleModels(SyncTransactionFailed):
+        '''
+        Some models in a sync were stale: their documents have been written since they were read.
+        '''
+        def __init__(self, message, models):
+            super().__init__(message)
+            self.models = models
+
+    # How syncs retry, and where they report retries, conflicts and latency. Either can be set per subclass.
+    transaction_policy = TransactionPolicy()
+    transaction_metrics = InMemoryTransactionMetrics()
+
+    # Subclasses that only declare Fields get no instance __dict__ at all; see Field.
+    __slots__ = ('_document_id', '_synced_dict', '_exists', '_projection', '_additional_attributes', '_doc_ref',
+            'creation_timestamp', 'modification_timestamp')
+
     @classmethod
     def collection_name(cls):
         '''
@@ -58,7 +440,10 @@ class ModelBase:
         '''
         Return the Firebase collection for this model.
         '''
-        return Storage.db().collection(cls.collection_name())
+        # Built once per class; checked in the class's own __dict__ so subclasses don't share a parent's.
+        if '_collection_ref' not in cls.__dict__:
+            cls._collection_ref = Storage.db().collection(cls.collection_name())
+        return cls._collection_ref
 
     def __init__(self, document_id, *args, **kwargs):
         '''
@@ -70,16 +455,37 @@ class ModelBase:
         '''
         # The ID of the document for fetching from / saving to Firestore
         self._document_id = document_id
-        # The snapshot of the document as we last fetched it in the db
-        self._snapshot = None
+        # The document's data as we last fetched it from the db, as a plain dict. Dirty tracking diffs against this.
+        # Only the field values are kept, not the snapshot they came in, which carries a lot more with it.
+        self._synced_dict = None
+        # Whether the document existed when we last fetched it; None if it's never been fetched.
+        self._exists = None
+        # The fields this model was read with, if it was read with a projection (see stream()); None if it has them all.
+        self._projection = None
         # Any attributes that aren't mapped to class properties by subclasses are collected here.
         self._additional_attributes = {}
+        self._doc_ref = None
+        self._init_fields()
+
+    def document_path(self):
+        '''
+        The document's path relative to the database, e.g. "candidates/some_id". Same for sync and async references.
+        '''
+        return f"{self.collection_name()}/{self._document_id}"
 
     def doc_ref(self):
-        return self.__class__.collection().document(self._document_id)
+        if self._doc_ref is None:
+            self._doc_ref = self.__class__.collection().document(self._document_id)
+        return self._doc_ref
+
+    def is_new(self):
+        '''
+        Whether the document isn't in the db as far as we know, i.e. a sync would create it.
+        '''
+        return not self._exists
 
     ## Writing / persistence methods
-    def before_serialize(self, d = {}):
+    def before_serialize(self, d = None):
         '''
         Serialization methods handle the translation of model attributes to the dictionary for firebase.
         The distinction between serialization and to_dict is mostly semantic: the serialization path
@@ -90,9 +496,11 @@ class ModelBase:
         don't have to always remember to do bookkeeping tasks.
         '''
 
+        if d is None:
+            d = {}
         # Here's an example of a bookkeeping concern: creation and modification dates are stored on
         # all objects.
-        if self._snapshot == None:
+        if self.is_new():
             # This is a new document, we think.
             # See #save() for how we handle if we're not actually new and this is a conflict.
             # Update the creation time. This should only happen on actual-create such that we don't
@@ -113,7 +521,7 @@ class ModelBase:
         The template method pattern for serialize, including before and after callbacks.
         '''
         LOG.trace("Serializing...")
-        d = self.before_serialize()
+        d = self.before_serialize({})
         # Delegated method to subclass implementers
         d = self.to_dict(d)
         if not isinstance(d, dict):
@@ -122,125 +530,311 @@ class ModelBase:
         LOG.trace("...serialization complete")
         return d
 
+    @_replaced_by_fields
     def to_dict(self, d):
         '''
-        This is the method subclasses should implement in order to convert their properties to a dictionary.
+        This is the method subclasses should implement in order to convert their properties to a dictionary,
+        unless they declare Fields, in which case it's generated for them.
         '''
-        raise ModelBase.RequiredMethodNotImplemented("Subclasses should implement")
+        if not self._fields:
+            raise ModelBase.RequiredMethodNotImplemented("Subclasses should implement")
+        return self._fields_to_dict(d)
+
+    def changed_fields(self):
+        '''
+        The fields that differ between the model in memory and the document as it was last read, i.e. what
+        a sync needs to write. For a model that's never been read this is the whole serialized document.
+
+        Fields that were read but aren't serialized any more map to DELETE_FIELD, the same as a full put
+        would have deleted them. If anything changed, the modified timestamp is bumped along with it.
+        '''
+        if self._projection is not None:
+            # Anything outside the projection would look like it had changed (or been deleted) and get overwritten.
+            raise ModelBase.PartialModelCannotBeSynced(f"{self._document_id} was read with only the fields {sorted(self._projection)}")
+        in_mem_dictionary = self.serialize()
+        if self.is_new():
+            return in_mem_dictionary
+        changes = {}
+        for field, value in in_mem_dictionary.items():
+            if field == 't_md':
+                continue
+            if field not in self._synced_dict or self._synced_dict[field] != value:
+                changes[field] = value
+        for field in self._synced_dict:
+            if field not in in_mem_dictionary and field not in ('t_cr', 't_md'):
+                changes[field] = firestore.DELETE_FIELD
+        if changes:
+            changes['t_md'] = in_mem_dictionary['t_md']
+        return changes
+
+    def is_dirty(self):
+        return len(self.changed_fields()) > 0
 
-    def sync(self):
+    def sync(self, policy=None):
         '''
         Perform a full sync of the doc, reads and writes.
-        This fails if *anything* has changed on the doc, so this is in effect
-        an update-if-not-changed operation.
-        For more granular control see sync_field()
+        If *anything* has changed on the doc since it was read, the model is re-read and our changes are
+        merged onto it (see rebase()) before trying again; if the same fields were changed both here and in
+        the db this fails, so this is in effect an update-if-not-changed operation.
+        Only the fields that changed since the last read are sent (see changed_fields()); if nothing
+        changed, nothing is written and the model is just re-read.
+        For more granular control see sync_fields()
         '''
         LOG.trace("Performing full model sync")
-        in_mem_dictionary = self.serialize()
-        t = Storage.transaction()
-        # The case where a document is created "behind" this model.
-        if self._snapshot == None:
-            LOG.trace(f"Saving brand new model {self.doc_ref()}")
-            @firestore.transactional
-            def create(transaction):
-                # Should be a new document.
-                # Should new the document. Fails in Firestore if it exists. Easy-peasy.
-                transaction.create(self.doc_ref(), in_mem_dictionary)
-            create(t)
-        else:
-            LOG.trace(f"Updating existing model {self.doc_ref()}")
-            @firestore.transactional
-            def put(transaction):
-                firestore_document = self.doc_ref().get(transaction=transaction)
-                # Check expected state - here that means modified date fields are the same.
-                # This is so we have a fairly reliable value if *any* of the fields on the model are stale
-                # and can check in O(1) instead of O(n) where n is every piece of data that's comparable on the model.
-                # Blanket and very blunt case for "if anything has changed don't sync" - other methods can do better.
-                if self._snapshot.get('t_md') != firestore_document.get('t_md'):
-                    LOG.warn(f"Update failed; database model has changed since in-memory instance was created.")
-                    raise SyncTransactionFailed(f"Tried updating doc {self._document_id} but our modified timestamp is out of date.")
-                # This is a straight-up put! That means it will delete anything not in memory!
-                t.put(self.doc_ref(), in_mem_dictionary)
-            put(t)
+        ModelBase.sync_many([self], policy=policy)
+
+    # Firestore refuses commits with more writes than this.
+    MAX_WRITES_PER_COMMIT = 500
+
+    @staticmethod
+    @metrics.timed("ModelBase.sync_many")
+    def sync_many(models, policy=None):
+        '''
+        Sync many models (of any model classes) with as few round trips as possible.
+
+        Models are committed in groups of up to MAX_WRITES_PER_COMMIT. A group of brand new models is
+        a single batched write of creates; a group with any changed existing models is one transaction that
+        reads all of them at once, applies the modified-timestamp check to each and updates only their changed
+        fields. Existing models with nothing changed aren't written at all. If any model in a
+        group is stale, nothing in the group is written; the stale models are re-read, rebased and the group
+        is tried again, as set by policy (by default the first model's class's transaction_policy). If they
+        can't be rebased or the attempts run out, the group fails with SyncTransactionFailed (groups before
+        it have already been committed).
+
+        Afterwards everything is re-read with one get_all to pick up server-set fields.
+        '''
+        models = list(models)
+        if not models:
+            return
+        paths = set(model.document_path() for model in models)
+        if len(paths) != len(models):
+            raise ValueError("Each document can only be synced once per sync_many call")
+        for start in range(0, len(models), ModelBase.MAX_WRITES_PER_COMMIT):
+            group = models[start:start + ModelBase.MAX_WRITES_PER_COMMIT]
+            runner = ModelBase._runner(group, policy)
+            runner.run(lambda: ModelBase._commit_group(group, runner), lambda stale: Storage.db().get_all([model.doc_ref() for model in stale]))
 
         # Unfortunately need immediate re-read for server-set fields like dates.
-        # There is a race condition here if another write lands immediately after our transaction
-        # or the transaction is delayed, but hopefully the catch on update / raise if modification
+        # There is a race condition here if another write lands immediately after our commit
+        # or the commit is delayed, but hopefully the catch on update / raise if modification
         # timestamp is out of date will catch this. It's a bit annoying that Firebase won't
         # let us read in a transaction, but replication has to happen etc...
-        self._snapshot = self.doc_ref().get()
-        self.deserialize()
+        ModelBase._reread(models)
 
-    def sync_fields(self, fieldnames = []):
+    @staticmethod
+    def _plan_group(models):
+        '''
+        Split a group of models into (creates, updates): new models with their whole serialized document, and
+        existing models that changed with just their changes. Models with nothing to write are left out.
+        '''
+        creates = []
+        updates = []
+        for model in models:
+            changes = model.changed_fields()
+            if model.is_new():
+                creates.append((model, changes))
+            elif changes:
+                updates.append((model, dict((firestore.Client.field_path(field), value) for field, value in changes.items())))
+        return creates, updates
+
+    @staticmethod
+    def _check_not_stale(updates, snapshots):
+        firestore_documents = dict((snapshot.reference.path, snapshot) for snapshot in snapshots)
+        # Check expected state - here that means modified date fields are the same.
+        # This is so we have a fairly reliable value if *any* of the fields on the model are stale
+        # and can check in O(1) instead of O(n) where n is every piece of data that's comparable on the model.
+        # Blanket and very blunt case for "if anything has changed don't sync" - other methods can do better.
+        stale = []
+        for model, _ in updates:
+            firestore_document = firestore_documents.get(model.document_path())
+            if firestore_document is None or not firestore_document.exists or model._synced_dict.get('t_md') != firestore_document.get('t_md'):
+                stale.append(model)
+        if stale:
+            LOG.warn("Update failed; database model has changed since in-memory instance was created.")
+            raise ModelBase.StaleModels(f"Tried updating docs {[model._document_id for model in stale]} but our modified timestamp is out of date.", stale)
+
+    @staticmethod
+    def _runner(models, policy):
+        return TransactionRunner(models, policy or models[0].transaction_policy, models[0].transaction_metrics)
 
-        LOG.trace(f"Syncing select fields: {fieldnames}")
+    @staticmethod
+    def _commit_group(models, runner):
+        # Planned afresh on every attempt: after a rebase the changes are relative to the re-read documents.
+        creates, updates = ModelBase._plan_group(models)
+        # The case where a document is created "behind" a model is caught by create(), which fails in
+        # Firestore if the document exists. Easy-peasy.
+        if not updates:
+            if not creates:
+                return
+            LOG.trace("Creating %d new models in one batch", len(creates))
+            batch = Storage.db().batch()
+            for model, in_mem_dictionary in creates:
+                batch.create(model.doc_ref(), in_mem_dictionary)
+            batch.commit()
+            return
+
+        LOG.trace("Syncing %d new and %d changed models in one transaction", len(creates), len(updates))
+        @firestore.transactional
+        def write(transaction):
+            runner.invoked()
+            # All reads have to happen before any writes in a transaction, so fetch every changed doc up front.
+            ModelBase._check_not_stale(updates, transaction.get_all([model.doc_ref() for model, _ in updates]))
+            for model, in_mem_dictionary in creates:
+                transaction.create(model.doc_ref(), in_mem_dictionary)
+            for model, changes in updates:
+                # Only what changed goes over the wire, along with the bumped modified timestamp.
+                transaction.update(model.doc_ref(), changes)
+        write(Storage.transaction(max_attempts=runner.policy.max_attempts))
+
+    @staticmethod
+    def _reread(models):
+        ModelBase._deserialize_snapshots(models, Storage.db().get_all(list(map(lambda model: model.doc_ref(), models))))
+
+    @staticmethod
+    def _deserialize_snapshots(models, snapshots):
+        models_by_path = dict((model.document_path(), model) for model in models)
+        for snapshot in snapshots:
+            models_by_path[snapshot.reference.path]._load(snapshot)
+
+    @staticmethod
+    def rebase(models, snapshots):
+        '''
+        Bring stale models up to date with freshly read snapshots of their documents, keeping their local changes:
+        each model ends up as the document in the db with our changes on top, ready to sync again.
+
+        A field we changed that was also changed in the db to something else is a conflict, as is a document
+        that's been deleted. Those raise SyncTransactionFailed and leave the models as they were.
+        '''
+        models_by_path = dict((model.document_path(), model) for model in models)
+        rebased = []
+        for snapshot in snapshots:
+            model = models_by_path[snapshot.reference.path]
+            if not snapshot.exists:
+                raise ModelBase.SyncTransactionFailed(f"{model._document_id} has been deleted since it was read")
+            fresh = snapshot.to_dict()
+            changes = model.changed_fields()
+            missing = object()
+            merged = dict(fresh)
+            conflicts = []
+            for field, value in changes.items():
+                if field in ('t_cr', 't_md'):
+                    continue
+                ours = missing if value is firestore.DELETE_FIELD else value
+                theirs = fresh.get(field, missing)
+                if theirs != model._synced_dict.get(field, missing) and theirs != ours:
+                    conflicts.append(field)
+                elif ours is missing:
+                    merged.pop(field, None)
+                else:
+                    merged[field] = ours
+            if conflicts:
+                raise ModelBase.SyncTransactionFailed(f"{model._document_id} has conflicting changes to {conflicts} in the db")
+            rebased.append((model, fresh, merged))
+        # Only once everything has merged cleanly, so a conflict leaves every model untouched.
+        for model, fresh, merged in rebased:
+            LOG.debug("Rebased %s onto the db's latest version", lazy(model.document_path))
+            model._synced_dict = fresh
+            model._deserialize_from(merged)
+
+    @metrics.timed("ModelBase.sync_fields")
+    def sync_fields(self, fieldnames = (), policy=None):
+        '''
+        Write just the named fields (and the bumped modified timestamp), as long as none of them has been
+        changed in the db since this model was read, whatever's happened to the rest of the document.
+        A field changed in the db to the same value we're writing doesn't count.
+        Afterwards the whole document is re-read, so this can update model state on other fields too.
+        '''
+        LOG.trace("Syncing select fields: %s", fieldnames)
+        if self.is_new():
+            raise ModelBase.SyncTransactionFailed(f"{self._document_id} has to be created with sync() first")
         in_mem_dictionary = self.serialize()
-        t = Storage.transaction()
-        error_fields = []
-        
+        updating_fields = dict((firestore.Client.field_path(field), in_mem_dictionary.get(field, firestore.DELETE_FIELD)) for field in fieldnames)
+        updating_fields['t_md'] = in_mem_dictionary['t_md']
+        runner = ModelBase._runner([self], policy)
+
         # TODO: delete can be handled this way maybe.
         @firestore.transactional
         def update_select_fields(transaction):
-
+            runner.invoked()
             # Freshly get the doc
-            firebase_document = self.doc_ref().get(transaction=transaction)
+            firebase_document = self.doc_ref().get(transaction=transaction).to_dict() or {}
+            error_fields = []
             for field in fieldnames:
-                # Get the fresh value of the one field. (Maybe this can be done with a targeted query for big docs?)
-                current_field_on_db = firebase_document.get(field)
-                # Get the possibly stale model on the old snapshot
-                snapshot_field_on_model = self._snapshot.to_dict().get(field)
-                # If the snapshot field is stale (has changed since this model was read from db)...
-                if current_data_on_db != snapshot_data_on_model:
-                    LOG.warn(f"Database value has changed relative to our snapshot: {field}")
+                # If the field is stale (has changed since this model was read from db) and isn't what we're writing
+                # anyway, something in the DB is different than the data we started with before modifying the
+                # model. This is a merge conflict.
+                if firebase_document.get(field) != self._synced_dict.get(field) and firebase_document.get(field) != in_mem_dictionary.get(field):
+                    LOG.warn("Database value has changed relative to our snapshot: %s", field)
                     error_fields.append(field)
-                    # This means that something in the DB is different than the snapshot data we started with before
-                    # modifying the model. This is a merge conflict.
-                # This is an update of just the one field
-            if len(error_fields) == 0:
-                updating_fields = dict([(k, in_mem_dictionary[k]) for k in fieldnames])
-                t.update(self.doc_ref(), updating_fields)
-        
-        update_select_fields(t)
-        if len(failed_to_update_fields) > 0:
-            raise SyncTransactionFailed(f"Tried updating {failed_to_update_fields} but server data is different than snapshot data")
+            if error_fields:
+                # Not retried: re-reading would just show us the same conflict.
+                raise ModelBase.SyncTransactionFailed(f"Tried updating {error_fields} but server data is different than snapshot data")
+            transaction.update(self.doc_ref(), updating_fields)
+
+        runner.run(lambda: update_select_fields(Storage.transaction(max_attempts=runner.policy.max_attempts)), None)
 
         # Re-read the whole document again to get new server values.
-        # This means that sync_field can update model state on other fields! This is (currently) intentional.
-        self._snapshot = self.doc_ref().get()
-        self.deserialize()
-    
+        # This means that sync_fields can update model state on other fields! This is (currently) intentional.
+        self._load(self.doc_ref().get())
+
     ## Reading methods
 
-    def before_deserialize(self, d = {}):
+    def before_deserialize(self, d = None):
         return d
 
     def after_deserialize(self, d):
         # It should always be true that these timestamps exist, at least for all subclasses
-        # of this class.
-        self.creation_timestamp = d.pop('t_cr')
-        self.modification_timestamp = d.pop('t_md')
+        # of this class. The exception is a model read with a projection that didn't ask for them.
+        self.creation_timestamp = d.pop('t_cr', None)
+        self.modification_timestamp = d.pop('t_md', None)
         # By this point nothing has handled anything remaining in d; this is the last step
-        # out of deserialization.
-        self._additional_attributes = d.copy()
+        # out of deserialization. d is already deserialize()'s own copy, so it's kept as is.
+        self._additional_attributes = d
         return d
 
+    def _load(self, snapshot):
+        '''
+        Take the field values from a freshly fetched snapshot and deserialize them, if the document exists.
+        '''
+        self._exists = snapshot.exists
+        self._synced_dict = snapshot.to_dict()
+        if self._exists:
+            self.deserialize()
+        return self
+
     def deserialize(self):
         '''
-        Deserialize from the snapshot, including before and after callbacks.
+        Deserialize from the document as last read, including before and after callbacks.
         '''
-        d = self._snapshot.to_dict()
+        if self._synced_dict is None:
+            raise ModelBase.NothingToDeserialize(f"{self._document_id} hasn't been read from the db")
+        return self._deserialize_from(self._synced_dict)
+
+    def _deserialize_from(self, document):
+        if self._copies_on_read:
+            # The generated from_dict copies the mutable values it keeps, so the hooks only need a dict of their own.
+            d = dict(document)
+        else:
+            # The hooks pop fields out of d and may hold on to mutable values from it, so they get their own copy;
+            # otherwise an in-place change to the model would also change what we diff against.
+            d = copy.deepcopy(document)
         self.before_deserialize(d)
         # Delegated method to subclass implementers
         self.from_dict(d)
         self.after_deserialize(d)
         return self
 
+    @_replaced_by_fields
     def from_dict(self, d):
         '''
-        This is the method subclasses should implement in order to convert their properties from a dictionary.
+        This is the method subclasses should implement in order to convert their properties from a dictionary,
+        unless they declare Fields, in which case it's generated for them.
         '''
-        raise RequiredMethodNotImplemented("Subclasses should implement")
+        if not self._fields:
+            raise ModelBase.RequiredMethodNotImplemented("Subclasses should implement")
+        return self._fields_from_dict(d)
 
+    @metrics.timed("ModelBase.read")
     def read(self):
         '''
         Read data for this instance from the DB.
@@ -250,10 +844,427 @@ class ModelBase:
         snapshot = doc_ref.get()
         if not snapshot.exists:
             return None
-        self._snapshot = snapshot
-        self.deserialize()
+        return self._load(snapshot)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, projection=None):
+        '''
+        Construct a model from a snapshot that's already been fetched, e.g. by a query.
+        '''
+        model = cls(snapshot.id)
+        if projection is not None:
+            model._projection = frozenset(projection)
+        return model._load(snapshot)
+
+    _INEQUALITY_OPERATORS = ('<', '<=', '>', '>=', '!=', 'not-in')
+
+    @staticmethod
+    def _query(collection, where, order_by, select):
+        '''
+        Build the query for stream() on a (sync or async) collection. Returns the query and the fields it selects.
+        '''
+        query = collection
+        for field, operator, value in (where or []):
+            query = query.where(filter=firestore.FieldFilter(field, operator, value))
+        orderings = [order_by] if isinstance(order_by, str) else list(order_by or [])
+        for ordering in orderings:
+            if ordering.startswith('-'):
+                query = query.order_by(ordering[1:], direction=firestore.Query.DESCENDING)
+            else:
+                query = query.order_by(ordering)
+        if select is not None:
+            # The cursor for the next page is built from the last snapshot's values for the fields the query is
+            # ordered by, so those have to be fetched even if they weren't asked for. That includes inequality
+            # filter fields, which Firestore orders by implicitly when no ordering names them.
+            cursor_fields = [ordering.lstrip('-') for ordering in orderings]
+            cursor_fields += [field for field, operator, value in (where or []) if operator in ModelBase._INEQUALITY_OPERATORS]
+            select = list(select)
+            select += [field for field in dict.fromkeys(cursor_fields) if field not in select]
+            # Firestore reads an empty projection as "every field"; just the document names is '__name__'.
+            query = query.select(select or ['__name__'])
+        return query, select
+
+    @classmethod
+    def stream(cls, where=None, order_by=None, select=None, page_size=100):
+        '''
+        Generator over the models in this collection, fetched page_size documents at a time with query cursors,
+        so memory use doesn't grow with the size of the collection.
+
+        where is a list of (field, operator, value) filters, e.g. [("num_votes", ">", 0)].
+        order_by is a field name or list of field names; prefix a name with "-" to sort descending.
+        select is a list of field names to fetch instead of the whole document. Models built from a projection
+        only have those fields filled in, and can't be synced.
+
+            for candidate in Candidate.stream(order_by="-num_votes", select=["num_votes"]):
+                ...
+        '''
+        query, select = cls._query(cls.collection(), where, order_by, select)
+        last_snapshot = None
+        while True:
+            page = query.limit(page_size)
+            if last_snapshot is not None:
+                page = page.start_after(last_snapshot)
+            snapshots = list(page.stream())
+            for snapshot in snapshots:
+                yield cls.from_snapshot(snapshot, projection=select)
+            if len(snapshots) < page_size:
+                return
+            last_snapshot = snapshots[-1]
+
+    ## Async (asyncio) counterparts. These run over AsyncStorage and share the serialize / deserialize
+    ## lifecycle, dirty tracking and staleness checks with the blocking methods above.
+
+    @classmethod
+    def async_collection(cls):
+        # Not cached like collection(): the reference is tied to the running loop's client.
+        return AsyncStorage.db().collection(cls.collection_name())
+
+    def async_doc_ref(self):
+        return self.__class__.async_collection().document(self._document_id)
+
+    async def read_async(self):
+        '''
+        read(), without blocking the event loop.
+        '''
+        snapshot = await self.async_doc_ref().get()
+        if not snapshot.exists:
+            return None
+        return self._load(snapshot)
+
+    async def sync_async(self, policy=None):
+        '''
+        sync(), without blocking the event loop.
+        '''
+        await ModelBase.sync_many_async([self], policy=policy)
+
+    @staticmethod
+    async def sync_many_async(models, policy=None):
+        '''
+        sync_many(), without blocking the event loop.
+        '''
+        models = list(models)
+        if not models:
+            return
+        paths = set(model.document_path() for model in models)
+        if len(paths) != len(models):
+            raise ValueError("Each document can only be synced once per sync_many call")
+        async def reread(stale):
+            return [snapshot async for snapshot in AsyncStorage.db().get_all([model.async_doc_ref() for model in stale])]
+        for start in range(0, len(models), ModelBase.MAX_WRITES_PER_COMMIT):
+            group = models[start:start + ModelBase.MAX_WRITES_PER_COMMIT]
+            runner = ModelBase._runner(group, policy)
+            await runner.run_async(lambda: ModelBase._commit_group_async(group, runner), reread)
+        # See sync_many() for why this re-read is needed.
+        snapshots = [snapshot async for snapshot in AsyncStorage.db().get_all([model.async_doc_ref() for model in models])]
+        ModelBase._deserialize_snapshots(models, snapshots)
+
+    @staticmethod
+    async def _commit_group_async(models, runner):
+        creates, updates = ModelBase._plan_group(models)
+        if not updates:
+            if not creates:
+                return
+            batch = AsyncStorage.db().batch()
+            for model, in_mem_dictionary in creates:
+                batch.create(model.async_doc_ref(), in_mem_dictionary)
+            await batch.commit()
+            return
+
+        @firestore.async_transactional
+        async def write(transaction):
+            runner.invoked()
+            snapshots = [snapshot async for snapshot in await transaction.get_all([model.async_doc_ref() for model, _ in updates])]
+            ModelBase._check_not_stale(updates, snapshots)
+            for model, in_mem_dictionary in creates:
+                transaction.create(model.async_doc_ref(), in_mem_dictionary)
+            for model, changes in updates:
+                transaction.update(model.async_doc_ref(), changes)
+        await write(AsyncStorage.transaction(max_attempts=runner.policy.max_attempts))
+
+    @classmethod
+    async def stream_async(cls, where=None, order_by=None, select=None, page_size=100):
+        '''
+        stream() as an async generator:
+
+            async for candidate in Candidate.stream_async(order_by="-num_votes"):
+                ...
+        '''
+        query, select = cls._query(cls.async_collection(), where, order_by, select)
+        last_snapshot = None
+        while True:
+            page = query.limit(page_size)
+            if last_snapshot is not None:
+                page = page.start_after(last_snapshot)
+            snapshots = [snapshot async for snapshot in page.stream()]
+            for snapshot in snapshots:
+                yield cls.from_snapshot(snapshot, projection=select)
+            if len(snapshots) < page_size:
+                return
+            last_snapshot = snapshots[-1]
+
+class Session():
+    '''
+    An identity map for models: within a session each document is represented by exactly one model
+    instance, however many times and from however many places it's referenced.
+
+    References to other documents are handed out as LazyModel proxies. Nothing is read until one of them
+    is used, and then every reference in the session that hasn't been read yet is read along with it in a
+    single get_all, so rendering something with N references costs one read rather than N.
+
+        with Session():
+            template = ElectionTemplate("t").read()
+            for candidate in template.candidates:
+                print(candidate.num_votes)  # the first access reads all the candidates
+
+    The active session is per thread. Sessions aren't thread safe, so don't share one between threads.
+    '''
+
+    _local = threading.local()
+
+    def __init__(self):
+        # (model class, document id) -> the one model instance for that document
+        self._models = {}
+        # Keys of models that have been referenced but not read yet.
+        self._pending = set()
+        self._previous = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'session', None)
+
+    @classmethod
+    def current_or_new(cls):
+        '''
+        The active session, or a new (inactive) one so that references created together can still be loaded together.
+        '''
+        return cls.current() or cls()
+
+    def __enter__(self):
+        self._previous = Session.current()
+        Session._local.session = self
         return self
 
+    def __exit__(self, *exc_info):
+        Session._local.session = self._previous
+        self._previous = None
+
+    def model(self, model_class, document_id):
+        '''
+        The instance for a document, constructed (unread) if the session hasn't seen it before.
+        '''
+        key = (model_class, document_id)
+        model = self._models.get(key)
+        if model is None:
+            model = model_class(document_id)
+            self._models[key] = model
+        return model
+
+    def add(self, model):
+        '''
+        Make an existing instance the session's instance for its document, e.g. one that was just read or created.
+        '''
+        key = (model.__class__, model._document_id)
+        self._models[key] = model
+        self._pending.discard(key)
+        return model
+
+    def reference(self, model_class, document_id):
+        key = (model_class, document_id)
+        model = self.model(model_class, document_id)
+        if model._exists is None:
+            self._pending.add(key)
+        return LazyModel(self, model_class, document_id)
+
+    def get(self, model_class, document_id):
+        '''
+        The read instance for a document, or None if it doesn't exist. Reads it (and anything else pending) if needed.
+        '''
+        key = (model_class, document_id)
+        model = self.model(model_class, document_id)
+        if model._exists is None:
+            self._pending.add(key)
+            self.load_pending()
+        return model if model._exists else None
+
+    def is_pending(self, model_class, document_id):
+        return (model_class, document_id) in self._pending
+
+    def load_pending(self):
+        '''
+        Read every referenced-but-unread model in one round trip.
+        '''
+        if not self._pending:
+            return
+        models_by_path = dict((model.doc_ref().path, model) for model in (self._models[key] for key in self._pending))
+        LOG.trace("Loading %d referenced models in one batch", len(models_by_path))
+        self._pending.clear()
+        for snapshot in Storage.db().get_all([model.doc_ref() for model in models_by_path.values()]):
+            models_by_path[snapshot.reference.path]._load(snapshot)
+
+
+class LazyModel():
+    '''
+    Stands in for a referenced model until it's used. Attribute access and assignment go through to the
+    session's instance for the document, reading it (and its unread siblings) first if need be.
+    Getting the reference itself, doc_ref(), doesn't need a read.
+    '''
+
+    def __init__(self, session, model_class, document_id):
+        object.__setattr__(self, '_session', session)
+        object.__setattr__(self, '_model_class', model_class)
+        object.__setattr__(self, '_document_id', document_id)
+
+    def doc_ref(self):
+        return self._session.model(self._model_class, self._document_id).doc_ref()
+
+    def resolve(self):
+        '''
+        The model instance behind the reference, read from the db.
+        '''
+        if self._session.is_pending(self._model_class, self._document_id):
+            self._session.load_pending()
+        return self._session.model(self._model_class, self._document_id)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyModel):
+            return (self._model_class, self._document_id) == (other._model_class, other._document_id)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self._model_class, self._document_id))
+
+    def __repr__(self):
+        return f"LazyModel: {self._model_class.__name__}({self._document_id})"
+
+
+class DeletionStats():
+    '''
+    Progress of a collection deletion, handed to the progress callback after every committed batch.
+    '''
+
+    def __init__(self):
+        self.documents_deleted = 0
+        self.batches_committed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed_seconds(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def documents_per_second(self):
+        elapsed = self.elapsed_seconds
+        return self.documents_deleted / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return f"Deleted {self.documents_deleted} docs in {self.batches_committed} batches, {self.elapsed_seconds:.2f}s ({self.documents_per_second:.1f} docs/s)"
+
+
+# Firestore refuses commits with more writes than this.
+DELETE_BATCH_SIZE = 500
+DELETE_WORKERS = 8
+
+def delete_collection(collection_ref, recursive=False, max_workers=DELETE_WORKERS, progress=None, stats=None):
+    '''
+    Delete every document in a collection, DELETE_BATCH_SIZE documents per write batch, with up to
+    max_workers batches in flight at once. Listing carries on while earlier pages are being deleted, but
+    only a couple of pages per worker are ever held in memory.
+
+    With recursive=True, subcollections of each document (e.g. counter shards) are deleted first, including
+    those under documents that have no fields of their own. progress, if given, is called with the running
+    DeletionStats after every batch. Returns the final DeletionStats.
+    '''
+    stats = stats or DeletionStats()
+    lock = threading.Lock()
+    def delete_page(doc_refs):
+        if recursive:
+            for doc_ref in doc_refs:
+                for subcollection in doc_ref.collections():
+                    # Already on a worker; recursing into the same pool could deadlock waiting on itself.
+                    delete_collection(subcollection, recursive=True, max_workers=1, progress=progress, stats=stats)
+        batch = Storage.db().batch()
+        for doc_ref in doc_refs:
+            batch.delete(doc_ref)
+        batch.commit()
+        with lock:
+            stats.documents_deleted += len(doc_refs)
+            stats.batches_committed += 1
+        if progress is not None:
+            progress(stats)
+
+    # list_documents includes documents that only exist as parents of subcollections, unlike stream().
+    doc_refs = collection_ref.list_documents(page_size=DELETE_BATCH_SIZE)
+    pages = iter(lambda: list(itertools.islice(doc_refs, DELETE_BATCH_SIZE)), [])
+    if max_workers <= 1:
+        for page in pages:
+            delete_page(page)
+    else:
+        in_flight = threading.BoundedSemaphore(max_workers * 2)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for page in pages:
+                in_flight.acquire()
+                future = executor.submit(delete_page, page)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+            # Surface the first failure, if any.
+            for future in futures:
+                future.result()
+    stats.finished = time.monotonic()
+    LOG.debug("%s: %s", collection_ref.id, stats)
+    return stats
+
+
+async def delete_collection_async(collection_ref, recursive=False, concurrency=DELETE_WORKERS, progress=None, stats=None):
+    '''
+    delete_collection() for an async collection reference, with up to concurrency batches committing at once.
+    '''
+    stats = stats or DeletionStats()
+    limit = asyncio.Semaphore(concurrency)
+    async def delete_page(doc_refs):
+        async with limit:
+            if recursive:
+                for doc_ref in doc_refs:
+                    async for subcollection in doc_ref.collections():
+                        await delete_collection_async(subcollection, recursive=True, concurrency=1, progress=progress, stats=stats)
+            batch = AsyncStorage.db().batch()
+            for doc_ref in doc_refs:
+                batch.delete(doc_ref)
+            await batch.commit()
+        stats.documents_deleted += len(doc_refs)
+        stats.batches_committed += 1
+        if progress is not None:
+            progress(stats)
+
+    tasks = set()
+    page = []
+    async for doc_ref in collection_ref.list_documents(page_size=DELETE_BATCH_SIZE):
+        page.append(doc_ref)
+        if len(page) == DELETE_BATCH_SIZE:
+            tasks.add(asyncio.ensure_future(delete_page(page)))
+            page = []
+            # Don't run further ahead of the deletes than the sync version does.
+            if len(tasks) >= concurrency * 2:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+    if page:
+        tasks.add(asyncio.ensure_future(delete_page(page)))
+    if tasks:
+        for task in (await asyncio.wait(tasks))[0]:
+            task.result()
+    stats.finished = time.monotonic()
+    LOG.debug("%s: %s", collection_ref.id, stats)
+    return stats
+
+
 class CollectionDeleteable():
     """
     To delete an entire collection or subcollection in Cloud Firestore, retrieve (read) all the documents within the collection or subcollection and delete them.
@@ -264,19 +1275,70 @@ class CollectionDeleteable():
     """
 
     @classmethod
-    def delete_all_documents_in_collection(cls):
+    def delete_all_documents_in_collection(cls, recursive=False, max_workers=DELETE_WORKERS, progress=None):
         """
         Making the name somewhat awkward on purpose to be really clear what is going to happen.
+        See delete_collection() for the arguments.
         """
-        psize = 100
-        # On the documentation page https://firebase.google.com/docs/firestore/manage-data/delete-data#collections
-        # they do this recursively . It's not clear to me why; I think the generator will keep supplying documents
-        # though the whole collection even if it's larger than page_size even if multiple fetches happen on the backend.
-        # So we should just be able to stream through the whole thing.
-        docs = cls.collection().list_documents(page_size=psize)
-        for doc in docs:
-            LOG.trace(f"Deleting doc {doc.id}")
-            doc.delete()
+        return delete_collection(cls.collection(), recursive=recursive, max_workers=max_workers, progress=progress)
+
+    @classmethod
+    async def delete_all_documents_in_collection_async(cls, recursive=False, concurrency=DELETE_WORKERS, progress=None):
+        return await delete_collection_async(cls.async_collection(), recursive=recursive, concurrency=concurrency, progress=progress)
+
+class ShardedCounter():
+    '''
+    A counter spread over shard documents in a subcollection of its parent document.
+
+    Firestore sustains about one write per second to a single document, so a counter that lots of people
+    bump at once can't live in one field. Each increment goes to a random shard as an atomic Increment
+    (no transaction, no read), and the value of the counter is the sum of the shards.
+    https://firebase.google.com/docs/firestore/solutions/counters
+    '''
+
+    DEFAULT_NUM_SHARDS = 10
+
+    def __init__(self, parent_ref, name, num_shards=DEFAULT_NUM_SHARDS):
+        self._parent_ref = parent_ref
+        self.name = name
+        # Only affects where new increments go; reads always sum every shard that exists,
+        # so the shard count can be changed without losing anything.
+        self.num_shards = num_shards
+        self._total = None
+
+    def shards(self):
+        return self._parent_ref.collection(f"{self.name}_shards")
+
+    def shard_ref(self, index=None):
+        if index is None:
+            index = random.randrange(self.num_shards)
+        return self.shards().document(str(index))
+
+    def increment(self, amount=1, batch=None):
+        '''
+        Add to the counter. Pass a batch (or transaction) to have the increment committed along with other writes.
+        '''
+        shard_ref = self.shard_ref()
+        data = {'count': firestore.Increment(amount)}
+        if batch is not None:
+            batch.set(shard_ref, data, merge=True)
+        else:
+            shard_ref.set(data, merge=True)
+
+    def total(self):
+        '''
+        Read every shard and sum them. The result is kept as cached_total.
+        '''
+        self._total = sum(snapshot.to_dict().get('count', 0) for snapshot in self.shards().select(['count']).stream())
+        return self._total
+
+    @property
+    def cached_total(self):
+        '''
+        The total as of the last call to total(), or None if it's never been read.
+        '''
+        return self._total
+
 
 class Candidate(ModelBase):
     '''
@@ -286,25 +1348,72 @@ class Candidate(ModelBase):
     def collection_name(cls):
         return "candidates"
 
+    __slots__ = ('name',)
+
+    num_votes = Field(int, default=0)
+
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
         self.name = name
-        self.num_votes = 0
 
-    def to_dict(self, d = {}):
-        d.update({
-            "test": "Not really a very useful piece of data, also unmapped to show that's possible",
-            "num_votes": self.num_votes
-                 })
+    def to_dict(self, d):
+        d = super().to_dict(d)
+        d["test"] = "Not really a very useful piece of data, also unmapped to show that's possible"
         return d
 
-    def from_dict(self, d):
-        # Pull out self attributes and return the remaining attrs
-        self.num_votes = d.pop("num_votes")
+    def vote_counter(self, num_shards=ShardedCounter.DEFAULT_NUM_SHARDS):
+        '''
+        Votes are counted on shards under the candidate's document. num_votes is the rolled-up total
+        as of the last roll_up_votes(), so reading it stays a single document read.
+        '''
+        return ShardedCounter(self.doc_ref(), "num_votes", num_shards)
+
+    def add_vote(self, amount=1, num_shards=ShardedCounter.DEFAULT_NUM_SHARDS, batch=None):
+        self.vote_counter(num_shards).increment(amount, batch=batch)
+
+    def roll_up_votes(self):
+        '''
+        Sum the vote shards into num_votes and sync it.
+        '''
+        self.num_votes = self.vote_counter().total()
+        self.sync()
+        return self.num_votes
 
     def __repr__(self):
         return f"Candidate: {self.name}, num_votes: {self.num_votes} || add_at: {self._additional_attributes}"
 
+class ElectionResults(ModelBase):
+    '''
+    A materialized view of an election's results: one document, with the same ID as the election, holding
+    every candidate's tally. Election.record_votes keeps it up to date with atomic increments as votes are
+    counted, so showing results is one document read however many candidates and voters there are.
+    results.recompute() rebuilds it from the vote counters if it ever drifts.
+    '''
+    @classmethod
+    def collection_name(cls):
+        return "election_results"
+
+    tallies = Field(dict, factory=dict)
+    total_votes = Field(int, default=0)
+
+    def ranked(self):
+        '''
+        [(candidate_id, votes)], most votes first; ties in candidate order.
+        '''
+        return sorted(self.tallies.items(), key=lambda tally: (-tally[1], tally[0]))
+
+    @classmethod
+    def apply_votes(cls, election_id, counts, batch):
+        '''
+        Add {candidate_id: votes} to an election's tallies as part of a batch, creating the document if need be.
+        '''
+        batch.set(cls.collection().document(election_id), {
+            "tallies": dict((candidate_id, firestore.Increment(amount)) for candidate_id, amount in counts.items()),
+            "total_votes": firestore.Increment(sum(counts.values())),
+            "t_md": firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+
+
 class Election(ModelBase):
     '''
     * An Election is a concrete instance 
@@ -317,15 +1426,177 @@ class Election(ModelBase):
     STATE_OPEN="Open"
     STATE_CLOSED="Closed"
 
+    # Candidates counted per commit by record_votes: two writes each, plus one for the results view.
+    VOTES_PER_COMMIT = (ModelBase.MAX_WRITES_PER_COMMIT - 1) // 2
+
     @classmethod
     def from_template(cls):
         return ElectionTemplate.create_election()
 
+    __slots__ = ('name',)
+
+    state = Field(str, default=STATE_CREATED)
+    # How many shards each candidate's vote counter is spread over for this election. Raise it for
+    # elections expecting more than a few votes per second for one candidate.
+    num_vote_shards = Field(int, default=ShardedCounter.DEFAULT_NUM_SHARDS)
+    # The document IDs of the candidates that can be voted for.
+    candidate_ids = Field(list, factory=list)
+
+    class VotesPartlyRecorded(Exception):
+        '''
+        record_votes committed some of its commits before one failed (the exception's __cause__). recorded and
+        remaining are {candidate_id: votes} for the votes that were counted and the ones that weren't.
+        '''
+        def __init__(self, message, recorded, remaining):
+            super().__init__(message)
+            self.recorded = recorded
+            self.remaining = remaining
+
+    class VotersPartlyClaimed(Exception):
+        '''
+        claim_voters entered some voters before a write failed (the exception's __cause__). claimed are the voters
+        it entered and already_voted the ones it found in the ledger already; the rest weren't looked at.
+        '''
+        def __init__(self, message, claimed, already_voted):
+            super().__init__(message)
+            self.claimed = claimed
+            self.already_voted = already_voted
+
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
         self.name = name
-        self.state = Election.STATE_CREATED
 
+    def vote_counter(self, candidate_id):
+        '''
+        The count of votes for a candidate in this election, sharded under the election's document.
+        '''
+        return ShardedCounter(self.doc_ref().collection("vote_counts").document(candidate_id), "num_votes", self.num_vote_shards)
+
+    def record_vote(self, candidate, batch=None, candidate_class=None):
+        '''
+        Count one vote onto the candidate's counters, but not into the results view: that's a single document,
+        and one write to it per vote would make it the hot spot the sharded counters are there to avoid. Votes
+        counted this way reach the view when results.recompute() is run.
+        '''
+        self.record_votes({candidate: 1}, batch=batch, candidate_class=candidate_class, results_class=None)
+
+    def record_votes(self, counts, batch=None, candidate_class=None, results_class=ElectionResults):
+        '''
+        Count votes, given as {candidate (model or document id): number of votes}: onto each candidate's counters
+        for this election and overall, and into the election's results view (results_class; None to leave it out).
+        Candidates given by document id are counted on candidate_class, Candidate unless said otherwise; those
+        given as models are counted on their own class.
+
+        The results view is a single document, so it only sustains about one write per second. Under load,
+        aggregate votes and record them with one call per flush rather than one call per vote.
+
+        Each candidate takes two writes, so without a batch of the caller's the votes are committed
+        VOTES_PER_COMMIT candidates at a time, each commit with its share of the results view. A commit that
+        fails leaves the ones before it counted: if there were any, VotesPartlyRecorded says which, so that only
+        the rest are tried again.
+        '''
+        candidate_class = candidate_class or Candidate
+        counts_by_class = {}
+        for candidate, amount in counts.items():
+            if isinstance(candidate, str):
+                model_class, candidate_id = candidate_class, candidate
+            else:
+                model_class, candidate_id = type(candidate), candidate._document_id
+            key = (model_class, candidate_id)
+            counts_by_class[key] = counts_by_class.get(key, 0) + amount
+        items = list(counts_by_class.items())
+        if batch is not None:
+            self._add_votes(items, batch, results_class)
+            return
+        for start in range(0, len(items), Election.VOTES_PER_COMMIT):
+            batch = Storage.db().batch()
+            self._add_votes(items[start:start + Election.VOTES_PER_COMMIT], batch, results_class)
+            try:
+                batch.commit()
+            except Exception as e:
+                if start == 0:
+                    raise
+                recorded, remaining = Election._counts_by_id(items[:start]), Election._counts_by_id(items[start:])
+                raise Election.VotesPartlyRecorded(f"Counted {sum(recorded.values())} votes for {self._document_id} before a commit failed", recorded, remaining) from e
+
+    @staticmethod
+    def _counts_by_id(items):
+        counts = {}
+        for (model_class, candidate_id), amount in items:
+            counts[candidate_id] = counts.get(candidate_id, 0) + amount
+        return counts
+
+    def _add_votes(self, items, batch, results_class):
+        counts_by_id = {}
+        for (model_class, candidate_id), amount in items:
+            self.vote_counter(candidate_id).increment(amount, batch=batch)
+            model_class(candidate_id).add_vote(amount, num_shards=self.num_vote_shards, batch=batch)
+            counts_by_id[candidate_id] = counts_by_id.get(candidate_id, 0) + amount
+        if results_class is not None:
+            results_class.apply_votes(self._document_id, counts_by_id, batch=batch)
+
+    def counted_candidate_ids(self):
+        '''
+        Every candidate that has a vote counter in this election.
+        '''
+        return [doc_ref.id for doc_ref in self.doc_ref().collection("vote_counts").list_documents()]
+
+    def voters(self):
+        '''
+        The ledger of who has voted: one document per voter, named by voter ID, under the election's document.
+        '''
+        return self.doc_ref().collection("voters")
+
+    def voter_ids(self, page_size=DELETE_BATCH_SIZE):
+        '''
+        Every voter in the ledger, read a page of references at a time without reading the documents.
+        '''
+        return (doc_ref.id for doc_ref in self.voters().list_documents(page_size=page_size))
+
+    def claim_voter(self, voter_id, candidate_id=None):
+        '''
+        Enter a voter in the ledger unless they're already there; False if they are. Firestore checks and
+        writes atomically, so of any number of concurrent claims for one voter exactly one succeeds.
+        '''
+        try:
+            self.voters().document(voter_id).create({"candidate": candidate_id, "t_cr": firestore.SERVER_TIMESTAMP})
+            return True
+        except exceptions.Conflict:
+            return False
+
+    def release_voter(self, voter_id):
+        '''
+        Take a voter out of the ledger, e.g. when their claimed vote couldn't be accepted after all.
+        '''
+        self.voters().document(voter_id).delete()
+
+    def claim_voters(self, votes):
+        '''
+        Enter {voter_id: candidate_id} in the ledger, MAX_WRITES_PER_COMMIT to a commit. Returns the voter IDs
+        that were already there. A commit with one of those in it fails as a whole, so its voters are then
+        claimed one at a time to find out which. If a write fails after others have gone through,
+        VotersPartlyClaimed says which voters were entered and which were found already there.
+        '''
+        claimed, already_voted = [], []
+        items = list(votes.items())
+        for start in range(0, len(items), ModelBase.MAX_WRITES_PER_COMMIT):
+            chunk = items[start:start + ModelBase.MAX_WRITES_PER_COMMIT]
+            batch = Storage.db().batch()
+            for voter_id, candidate_id in chunk:
+                batch.create(self.voters().document(voter_id), {"candidate": candidate_id, "t_cr": firestore.SERVER_TIMESTAMP})
+            try:
+                try:
+                    batch.commit()
+                    claimed.extend(voter_id for voter_id, candidate_id in chunk)
+                except exceptions.Conflict:
+                    LOG.info("A ledger batch for %s had voters in it already; claiming them one by one", self._document_id)
+                    for voter_id, candidate_id in chunk:
+                        (claimed if self.claim_voter(voter_id, candidate_id) else already_voted).append(voter_id)
+            except Exception as e:
+                if not claimed and not already_voted:
+                    raise
+                raise Election.VotersPartlyClaimed(f"Entered {len(claimed)} voters for {self._document_id} before a write failed", claimed, already_voted) from e
+        return already_voted
 
 
 class ElectionTemplate(ModelBase):
@@ -334,12 +1605,27 @@ class ElectionTemplate(ModelBase):
     def collection_name(cls):
         return "election_templates"
 
+    __slots__ = ('_candidates',)
+
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
         self._candidates = set()
 
-    def to_dict(self, d = {}):
-        candidates = set(map(lambda model: model.doc_ref(), self._candidates))
+    @property
+    def candidates(self):
+        return self._candidates
+
+    def add_candidate(self, candidate):
+        if isinstance(candidate, LazyModel):
+            self._candidates.add(candidate)
+            return
+        session = Session.current_or_new()
+        session.add(candidate)
+        self._candidates.add(session.reference(candidate.__class__, candidate._document_id))
+
+    def to_dict(self, d):
+        # Firestore stores arrays, not sets; sorted so the same candidates always serialize the same way.
+        candidates = sorted(map(lambda model: model.doc_ref(), self._candidates), key=lambda doc_ref: doc_ref.path)
         d.update({
             "candidates": candidates
                  })
@@ -347,6 +1633,8 @@ class ElectionTemplate(ModelBase):
 
     def from_dict(self, d):
         # Pull out self attributes and return the remaining attrs
-        self._candidates = set(map(lambda doc_ref: Candidate(doc_ref.id), d["candidates"]))
+        # Candidates are lazy references: nothing is read until one is used, and then they're all read together.
+        session = Session.current_or_new()
+        self._candidates = set(map(lambda doc_ref: session.reference(Candidate, doc_ref.id), d.pop("candidates", [])))
 
 
@@ -0,0 +1,79 @@
+"""
+Election results for display, served from the ElectionResults view with a short-lived in-process cache in front
+of it so a busy results page costs a document read every couple of seconds, not one per request.
+"""
+
+import collections
+import logging
+import threading
+import time
+import models
+
+LOG=logging.getLogger("results")
+
+# How long a results snapshot is served from memory before it's read again.
+RESULTS_CACHE_SECONDS = 2.0
+# Elections whose results are kept in memory; the least recently read are forgotten first.
+MAX_CACHED_ELECTIONS = 1000
+
+# election id -> (monotonic time read, results), least recently read first.
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _to_json(election_id, election_results):
+    return {
+            "election": election_id,
+            "total_votes": election_results.total_votes if election_results else 0,
+            "ranking": [{"candidate": candidate_id, "votes": votes} for candidate_id, votes in (election_results.ranked() if election_results else [])],
+            }
+
+
+def read_results(election_id):
+    '''
+    Results straight from the view: one document read. Empty results if nothing has been counted yet.
+    '''
+    return _to_json(election_id, models.ElectionResults(election_id).read())
+
+
+def cached_results(election_id, max_age=RESULTS_CACHE_SECONDS):
+    '''
+    read_results(), served from memory if it was read within max_age seconds. At most MAX_CACHED_ELECTIONS
+    elections are kept.
+    '''
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(election_id)
+        if cached is not None:
+            _cache.move_to_end(election_id)
+    if cached is not None and now - cached[0] < max_age:
+        return cached[1]
+    results = read_results(election_id)
+    with _cache_lock:
+        _cache[election_id] = (now, results)
+        _cache.move_to_end(election_id)
+        while len(_cache) > MAX_CACHED_ELECTIONS:
+            _cache.popitem(last=False)
+    return results
+
+
+def invalidate(election_id):
+    with _cache_lock:
+        _cache.pop(election_id, None)
+
+
+def recompute(election, results_class=models.ElectionResults):
+    '''
+    Rebuild an election's results view from its sharded vote counters, e.g. to repair drift or to take in
+    votes counted with Election.record_vote.
+    This overwrites the view, so votes counted while it runs can be lost from it; run it when voting is quiet.
+    '''
+    tallies = dict((candidate_id, election.vote_counter(candidate_id).total()) for candidate_id in election.counted_candidate_ids())
+    election_results = results_class(election._document_id)
+    election_results.tallies = tallies
+    election_results.total_votes = sum(tallies.values())
+    # A plain set rather than sync(): the view is being replaced wholesale, whatever its current state.
+    election_results.doc_ref().set(election_results.serialize())
+    LOG.info("Recomputed results for %s: %d votes over %d candidates", election._document_id, election_results.total_votes, len(tallies))
+    invalidate(election._document_id)
+    return election_results.read()
@@ -0,0 +1,88 @@
+import gzip
+import threading
+import pytest
+import assets
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    static_dir = tmp_path / "static"
+    (static_dir / "js").mkdir(parents=True)
+    (static_dir / "js" / "main.js").write_text("console.log('vote');\n" * 200)
+    (static_dir / "tiny.txt").write_text("x")
+    yield assets.AssetPipeline(str(static_dir), str(tmp_path / "build"))
+
+
+def _body(response):
+    return b"".join(response[2])
+
+
+class TestAssetPipeline:
+
+    def test_names_carry_a_hash_of_the_contents(self, pipeline):
+        name = pipeline.url_name("js/main.js")
+        assert name.startswith("js/main.") and name.endswith(".js")
+        assert name != "js/main.js"
+
+    def test_serves_gzip_to_clients_that_accept_it(self, pipeline):
+        status, headers, body = pipeline.respond(pipeline.url_name("js/main.js"), "gzip, deflate")
+        assert status == 200
+        assert headers['Content-Encoding'] == "gzip"
+        assert headers['Cache-Control'] == assets.CACHE_CONTROL
+        assert headers['Vary'] == "Accept-Encoding"
+        assert gzip.decompress(b"".join(body)) == b"console.log('vote');\n" * 200
+
+    def test_serves_the_file_as_is_without_accept_encoding(self, pipeline):
+        status, headers, body = pipeline.respond(pipeline.url_name("js/main.js"), None)
+        assert 'Content-Encoding' not in headers
+        assert b"".join(body) == b"console.log('vote');\n" * 200
+        assert headers['Content-Length'] == str(len(b"console.log('vote');\n" * 200))
+
+    def test_refused_encodings_are_not_served(self, pipeline):
+        _, headers, _ = pipeline.respond(pipeline.url_name("js/main.js"), "gzip;q=0, br;q=0")
+        assert 'Content-Encoding' not in headers
+
+    def test_files_that_do_not_shrink_are_not_compressed(self, pipeline):
+        _, headers, _ = pipeline.respond(pipeline.url_name("tiny.txt"), "gzip")
+        assert 'Content-Encoding' not in headers
+
+    def test_matching_etag_is_not_modified(self, pipeline):
+        name = pipeline.url_name("js/main.js")
+        _, headers, _ = pipeline.respond(name, "gzip")
+        status, _, body = pipeline.respond(name, "gzip", headers['ETag'])
+        assert status == 304
+        assert list(body) == []
+
+    def test_each_encoding_has_its_own_etag(self, pipeline):
+        name = pipeline.url_name("js/main.js")
+        assert pipeline.respond(name, "gzip")[1]['ETag'] != pipeline.respond(name, None)[1]['ETag']
+
+    def test_unknown_and_unhashed_names_are_not_found(self, pipeline):
+        assert pipeline.respond("js/main.js") is None
+        assert pipeline.respond("js/main.000000000000.js") is None
+
+    def test_rebuilds_reuse_what_is_built(self, pipeline):
+        name = pipeline.url_name("js/main.js")
+        rebuilt = assets.AssetPipeline(pipeline.static_dir, pipeline.build_dir)
+        assert rebuilt.url_name("js/main.js") == name
+        assert _body(rebuilt.respond(name, "gzip")) == _body(pipeline.respond(name, "gzip"))
+
+    def test_builds_of_the_same_directory_dont_share_temporary_files(self, pipeline, tmp_path):
+        others = [assets.AssetPipeline(pipeline.static_dir, pipeline.build_dir) for _ in range(4)]
+        threads = [threading.Thread(target=other.build) for other in others]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        built = [path.name for path in (tmp_path / "build").rglob("*")]
+        assert not [name for name in built if name.endswith(".tmp")]
+        assert _body(others[0].respond(others[0].url_name("js/main.js"), None)) == b"console.log('vote');\n" * 200
+
+
+class TestNegotiation:
+
+    def test_most_compact_accepted_encoding_wins(self):
+        assert assets.negotiate("gzip, br", ("br", "gzip")) == "br"
+        assert assets.negotiate("gzip", ("br", "gzip")) == "gzip"
+        assert assets.negotiate("*", ("gzip",)) == "gzip"
+        assert assets.negotiate("identity", ("br", "gzip")) is None
@@ -1,5 +1,8 @@
+import asyncio
+import os
 import pytest
 import models
+from models import Field
 
 class TestModelWhichDidntOverrideCollectionName(models.ModelBase):
     pass
@@ -14,7 +17,7 @@ def test_model_which_didnt_override_dict_methods():
     model = TestModelWhichDidntOverrideDictMethods("test_model_which_should_fail")
     yield model
     # This probably should never fail, but we're including it as a teardown just in case.
-    TestModelWhichDidntOverrideDictMethods.delete_all_documents_in_collection()
+    TestModelWhichDidntOverrideDictMethods.delete_all_documents_in_collection(recursive=True)
 
 class TestModel(models.ModelBase, models.CollectionDeleteable):
     @classmethod
@@ -28,6 +31,7 @@ class TestModel(models.ModelBase, models.CollectionDeleteable):
         self.before_serialize_called = False
         self.after_serialize_called = False
         self._some_key = "Initialized data"
+        self.other_key = None
 
     @property 
     def some_key(self):
@@ -48,6 +52,7 @@ class TestModel(models.ModelBase, models.CollectionDeleteable):
     def to_dict(self, d):
         self.to_dict_called = True
         d["some_key"] = self._some_key
+        d["other_key"] = self.other_key
         return d
 
     def before_deserialize(self, d={}):
@@ -61,13 +66,14 @@ class TestModel(models.ModelBase, models.CollectionDeleteable):
     def from_dict(self, d):
         self.from_dict_called = True
         self._some_key = d.get("some_key", None)
+        self.other_key = d.get("other_key", None)
 
 @pytest.fixture
 def test_model_unsaved():
     model = TestModel("test_model_unsaved")
     yield model
     # This probably should never be needed, but we're including it as a teardown just in case.
-    TestModel.delete_all_documents_in_collection()
+    TestModel.delete_all_documents_in_collection(recursive=True)
 
 @pytest.fixture
 def test_model_saved():
@@ -75,12 +81,13 @@ def test_model_saved():
     model.sync()
     yield model
     # This probably should never be needed, but we're including it as a teardown just in case.
-    TestModel.delete_all_documents_in_collection()
+    TestModel.delete_all_documents_in_collection(recursive=True)
 
 #------
 
 class TestBasicModelRequirements:
 
+    @pytest.mark.skipif('FIRESTORE_EMULATOR_HOST' in os.environ, reason="The emulator doesn't need credentials")
     def test_load_creds(self):
         creds = models.Storage.load_credentials()
         assert creds is not None
@@ -94,6 +101,11 @@ class TestBasicModelRequirements:
         with pytest.raises(models.ModelBase.RequiredMethodNotImplemented):
             test_model_which_didnt_override_dict_methods.serialize()
 
+    def test_document_ids_are_checked(self):
+        assert models.valid_document_id("candidate_1")
+        for document_id in ["", ".", "..", "a/b", "__id__", "x" * 1501, 7, None, ["a"]]:
+            assert not models.valid_document_id(document_id)
+
 class TestModelSerialization:
 
     def test_classes_have_serialize_lifecycle_methods_called(self, test_model_unsaved):
@@ -111,7 +123,7 @@ class TestModelDeserialization:
         # This is also used for "dirty tracking", i.e. if the snapshot differs from the db (which we
         # must unfortunately track with a read operation from the DB) then we're locally dirty / not
         # up to date with the db.
-        with pytest.raises(AttributeError): #NoneType for the snapshot fails when the Firebase-expected "to_dict" method is called.
+        with pytest.raises(models.ModelBase.NothingToDeserialize):
             d = test_model_unsaved.deserialize()
 
     def test_classes_have_deserialize_lifecycle_methods_called(self, test_model_saved):
@@ -119,3 +131,209 @@ class TestModelDeserialization:
         assert test_model_saved.from_dict_called == True
         assert test_model_saved.before_deserialize_called == True
         assert test_model_saved.after_deserialize_called == True
+
+class TestFieldModel(models.ModelBase):
+    @classmethod
+    def collection_name(cls):
+        return "test_field_collection"
+
+    count = Field(int, default=0)
+    tags = Field(list, factory=list)
+    label = Field(str, key="l")
+
+class TestModelFields:
+
+    def test_fields_are_slots_and_have_defaults(self):
+        model = TestFieldModel("test_field_model")
+        assert not hasattr(model, "__dict__")
+        assert (model.count, model.tags, model.label) == (0, [], None)
+        assert model.tags is not TestFieldModel("another_field_model").tags
+
+    def test_generated_to_dict_uses_keys(self):
+        model = TestFieldModel("test_field_model")
+        model.label = "A label"
+        d = model.serialize()
+        assert d["l"] == "A label"
+        assert d["count"] == 0 and d["tags"] == []
+
+    def test_generated_from_dict_coerces_and_copies(self):
+        model = TestFieldModel("test_field_model")
+        model._exists = True
+        model._synced_dict = {"count": 3.0, "tags": ["a"], "l": "A label", "extra": 1, "t_cr": None, "t_md": None}
+        model.deserialize()
+        assert model.count == 3 and isinstance(model.count, int)
+        assert model._additional_attributes == {"extra": 1}
+        model.tags.append("b")
+        assert model._synced_dict["tags"] == ["a"]
+        assert set(model.changed_fields().keys()) == {"tags", "extra", "t_md"}
+
+class TestModelSyncMany:
+
+    def test_sync_many_creates_and_reads_back_server_fields(self, test_model_unsaved):
+        others = [TestModel(f"test_model_many_{i}") for i in range(3)]
+        models.ModelBase.sync_many([test_model_unsaved] + others)
+        for model in [test_model_unsaved] + others:
+            assert model.modification_timestamp is not None
+            assert model.creation_timestamp is not None
+
+    def test_sync_many_updates_existing_models(self, test_model_saved):
+        new_model = TestModel("test_model_many_new")
+        test_model_saved.some_key = "Updated data"
+        models.ModelBase.sync_many([test_model_saved, new_model])
+        assert TestModel("test_model_saved").read().some_key == "Updated data"
+        assert TestModel("test_model_many_new").read() is not None
+
+    def test_sync_many_fails_whole_group_if_any_model_is_stale(self, test_model_saved):
+        stale_copy = TestModel("test_model_saved").read()
+        test_model_saved.some_key = "Changed by someone else"
+        test_model_saved.sync()
+        stale_copy.some_key = "Changed by us"
+        new_model = TestModel("test_model_many_not_created")
+        with pytest.raises(models.ModelBase.SyncTransactionFailed):
+            models.ModelBase.sync_many([stale_copy, new_model])
+        assert TestModel("test_model_many_not_created").read() is None
+
+class TestModelTransactions:
+
+    def test_stale_model_is_rebased_when_changes_dont_conflict(self, test_model_saved):
+        stale_copy = TestModel("test_model_saved").read()
+        test_model_saved.some_key = "Changed by someone else"
+        test_model_saved.sync()
+        stale_copy.other_key = "Added by us"
+        metrics = models.InMemoryTransactionMetrics()
+        stale_copy.transaction_metrics = metrics
+        stale_copy.sync(policy=models.TransactionPolicy(base_delay=0))
+        assert stale_copy.some_key == "Changed by someone else"
+        assert metrics.hot_documents() == [("test_collection/test_model_saved", 1)]
+        assert metrics.retries["test_collection"].total == 1
+
+    def test_stale_model_fails_without_merge(self, test_model_saved):
+        stale_copy = TestModel("test_model_saved").read()
+        test_model_saved.some_key = "Changed by someone else"
+        test_model_saved.sync()
+        stale_copy.some_key = "Changed by us"
+        with pytest.raises(models.ModelBase.StaleModels):
+            stale_copy.sync(policy=models.TransactionPolicy(merge_on_conflict=False))
+
+    def test_sync_fields_ignores_changes_to_other_fields(self, test_model_saved):
+        stale_copy = TestModel("test_model_saved").read()
+        test_model_saved.other_key = "Changed by someone else"
+        test_model_saved.sync()
+        stale_copy.some_key = "Changed by us"
+        stale_copy.sync_fields(["some_key"])
+        assert (stale_copy.some_key, stale_copy.other_key) == ("Changed by us", "Changed by someone else")
+
+    def test_sync_fields_fails_on_conflicting_field(self, test_model_saved):
+        stale_copy = TestModel("test_model_saved").read()
+        test_model_saved.some_key = "Changed by someone else"
+        test_model_saved.sync()
+        stale_copy.some_key = "Changed by us"
+        with pytest.raises(models.ModelBase.SyncTransactionFailed):
+            stale_copy.sync_fields(["some_key"])
+
+    def test_conflict_counts_keep_the_hottest_documents(self):
+        metrics = models.InMemoryTransactionMetrics(max_documents=2)
+        for _ in range(3):
+            metrics.conflict("test_collection", "test_collection/hot")
+        for i in range(10):
+            metrics.conflict("test_collection", f"test_collection/cold_{i}")
+        assert len(metrics.conflicts_by_document) <= 4
+        assert metrics.hot_documents(1) == [("test_collection/hot", 3)]
+        assert metrics.conflicts["test_collection"] == 13
+
+class TestModelDirtyTracking:
+
+    def test_unsaved_model_changes_are_the_whole_document(self, test_model_unsaved):
+        changes = test_model_unsaved.changed_fields()
+        assert changes["some_key"] == "Initialized data"
+        assert "t_cr" in changes
+
+    def test_freshly_read_model_is_clean(self, test_model_saved):
+        assert test_model_saved.changed_fields() == {}
+        assert not test_model_saved.is_dirty()
+
+    def test_only_changed_fields_are_dirty(self, test_model_saved):
+        test_model_saved.some_key = "Updated data"
+        assert set(test_model_saved.changed_fields().keys()) == {"some_key", "t_md"}
+
+    def test_sync_without_changes_does_not_write(self, test_model_saved):
+        modified = test_model_saved.modification_timestamp
+        test_model_saved.sync()
+        assert test_model_saved.modification_timestamp == modified
+
+class TestSessions:
+
+    def test_session_has_one_instance_per_document(self, test_model_saved):
+        with models.Session() as session:
+            first = session.reference(TestModel, "test_model_saved")
+            second = session.reference(TestModel, "test_model_saved")
+            assert first == second
+            assert first.resolve() is second.resolve()
+            assert session.get(TestModel, "test_model_saved") is first.resolve()
+
+    def test_first_use_of_a_reference_reads_all_pending_siblings(self, test_model_saved):
+        other = TestModel("test_model_sibling")
+        other.sync()
+        with models.Session() as session:
+            saved_reference = session.reference(TestModel, "test_model_saved")
+            other_reference = session.reference(TestModel, "test_model_sibling")
+            assert session.is_pending(TestModel, "test_model_sibling")
+            assert saved_reference.some_key == "Initialized data"
+            assert not session.is_pending(TestModel, "test_model_sibling")
+            assert other_reference.resolve()._exists
+
+    def test_doc_ref_does_not_read(self, test_model_saved):
+        with models.Session() as session:
+            reference = session.reference(TestModel, "test_model_saved")
+            assert reference.doc_ref().id == "test_model_saved"
+            assert session.is_pending(TestModel, "test_model_saved")
+
+@pytest.fixture
+def test_models_saved():
+    saved = [TestModel(f"test_model_streamed_{i}") for i in range(5)]
+    for i, model in enumerate(saved):
+        model.some_key = f"value {i}"
+    models.ModelBase.sync_many(saved)
+    yield saved
+    TestModel.delete_all_documents_in_collection(recursive=True)
+
+class TestModelStreaming:
+
+    def test_stream_pages_through_whole_collection(self, test_models_saved):
+        streamed = list(TestModel.stream(order_by="some_key", page_size=2))
+        assert [model.some_key for model in streamed] == [f"value {i}" for i in range(5)]
+
+    def test_stream_filters_and_orders(self, test_models_saved):
+        streamed = list(TestModel.stream(where=[("some_key", ">=", "value 3")], order_by="-some_key"))
+        assert [model.some_key for model in streamed] == ["value 4", "value 3"]
+
+    def test_projected_models_cannot_be_synced(self, test_models_saved):
+        streamed = list(TestModel.stream(select=[], page_size=10))
+        assert len(streamed) == 5
+        assert streamed[0].some_key is None
+        with pytest.raises(models.ModelBase.PartialModelCannotBeSynced):
+            streamed[0].sync()
+
+    def test_projected_stream_pages_with_an_inequality_filter(self, test_models_saved):
+        streamed = list(TestModel.stream(where=[("some_key", ">", "value 0")], select=[], page_size=2))
+        assert len(streamed) == 4
+
+    def test_projection_includes_cursor_fields(self):
+        query, select = models.ModelBase._query(TestModel.collection(), [("some_key", ">", "value 0")], "other_key", [])
+        assert select == ["other_key", "some_key"]
+
+class TestAsyncModelOperations:
+
+    def test_async_sync_and_read_round_trip(self, test_model_unsaved):
+        async def round_trip():
+            test_model_unsaved.some_key = "Written asynchronously"
+            await test_model_unsaved.sync_async()
+            return await TestModel("test_model_unsaved").read_async()
+        read_back = asyncio.run(round_trip())
+        assert read_back.some_key == "Written asynchronously"
+        assert read_back.modification_timestamp is not None
+
+    def test_async_stream(self, test_models_saved):
+        async def stream():
+            return [model async for model in TestModel.stream_async(order_by="some_key", page_size=2)]
+        assert [model.some_key for model in asyncio.run(stream())] == [f"value {i}" for i in range(5)]
@@ -0,0 +1,162 @@
+import pytest
+import ingestion
+import models
+
+
+class RecordingElection:
+    def __init__(self):
+        self.recorded = []
+
+    def record_votes(self, counts):
+        self.recorded.append(dict(counts))
+
+
+@pytest.fixture
+def recording_buffer():
+    election = RecordingElection()
+    vote_buffer = ingestion.VoteBuffer(max_pending=100, flush_interval=60)
+    vote_buffer.election = lambda election_id: election
+    # Flush by hand rather than through the background thread.
+    vote_buffer._ensure_flusher = lambda: None
+    yield vote_buffer, election
+
+
+class TestVoteBuffer:
+
+    def test_only_recent_elections_are_kept(self, monkeypatch):
+        reads = []
+        class FakeElection:
+            def __init__(self, election_id):
+                self.election_id = election_id
+
+            def read(self):
+                reads.append(self.election_id)
+                return None
+        monkeypatch.setattr(ingestion.models, "Election", FakeElection)
+        vote_buffer = ingestion.VoteBuffer(max_elections=2)
+        for election_id in ["a", "b", "a", "c", "a", "b"]:
+            assert vote_buffer.election(election_id) is None
+        assert reads == ["a", "b", "c", "b"]
+        assert list(vote_buffer._elections) == ["a", "b"]
+
+    def test_votes_are_aggregated_per_candidate(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        for candidate_id in ["a", "b", "a", "a"]:
+            vote_buffer.submit("election", candidate_id)
+        vote_buffer.close()
+        assert election.recorded == [{"a": 3, "b": 1}]
+        assert vote_buffer.pending() == 0
+
+    def test_full_buffer_pushes_back(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        for _ in range(100):
+            vote_buffer.submit("election", "a")
+        with pytest.raises(ingestion.BufferFull):
+            vote_buffer.submit("election", "a", timeout=0)
+
+    def test_failed_writes_are_retried_a_few_times(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        def fail(counts):
+            raise RuntimeError("unavailable")
+        election.record_votes = fail
+        vote_buffer.submit("election", "a")
+        vote_buffer._collect(None, None)
+        for _ in range(vote_buffer.max_attempts - 1):
+            vote_buffer.flush()
+            assert vote_buffer.pending() == 1
+        vote_buffer.flush()
+        assert vote_buffer.pending() == 0
+        assert vote_buffer.votes_dropped == 1
+
+    def test_a_write_that_succeeds_resets_the_retries(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        record_votes = election.record_votes
+        failures = [RuntimeError("unavailable")] * (vote_buffer.max_attempts - 1)
+        def flaky(counts):
+            if failures:
+                raise failures.pop()
+            record_votes(counts)
+        election.record_votes = flaky
+        vote_buffer.submit("election", "a")
+        vote_buffer._collect(None, None)
+        for _ in range(vote_buffer.max_attempts):
+            vote_buffer.flush()
+        assert election.recorded == [{"a": 1}]
+        assert vote_buffer.votes_dropped == 0
+
+    def test_votes_committed_before_a_failure_arent_counted_again(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        record_votes = election.record_votes
+        def second_chunk_fails(counts):
+            election.record_votes = record_votes
+            # The first chunk, candidate a's votes, was committed.
+            record_votes({"a": counts["a"]})
+            raise models.Election.VotesPartlyRecorded("b failed", {"a": counts["a"]}, {"b": counts["b"]}) from RuntimeError("unavailable")
+        election.record_votes = second_chunk_fails
+        for candidate_id in ["a", "a", "b"]:
+            vote_buffer.submit("election", candidate_id)
+        vote_buffer._collect(None, None)
+        vote_buffer.flush()
+        assert vote_buffer.pending() == 1
+        vote_buffer.flush()
+        assert election.recorded == [{"a": 2}, {"b": 1}]
+        assert vote_buffer.votes_written == 3
+
+    def test_writes_that_cant_succeed_are_dropped(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        def invalid(counts):
+            raise ValueError("not a document id")
+        election.record_votes = invalid
+        vote_buffer.submit("election", "a")
+        vote_buffer.close()
+        assert vote_buffer.pending() == 0
+        assert vote_buffer.votes_dropped == 1
+
+    def test_voters_already_in_the_ledger_are_not_counted(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        election.claim_voters = lambda votes: [voter_id for voter_id in votes if voter_id == "repeat"]
+        vote_buffer.submit("election", "a", voter_id="new")
+        vote_buffer.submit("election", "a", voter_id="repeat")
+        vote_buffer.submit("election", "b", voter_id="repeat_elsewhere")
+        vote_buffer.close()
+        assert election.recorded == [{"a": 1, "b": 1}]
+
+    def test_voters_are_settled_once_flushed(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        settled = []
+        vote_buffer.on_settled = lambda election_id, voter_ids: settled.append((election_id, sorted(voter_ids)))
+        election.claim_voters = lambda votes: [voter_id for voter_id in votes if voter_id == "repeat"]
+        vote_buffer.submit("election", "a", voter_id="new")
+        vote_buffer.submit("election", "a", voter_id="repeat")
+        vote_buffer.close()
+        assert settled == [("election", ["new", "repeat"])]
+
+    def test_voters_are_settled_when_their_votes_are_dropped(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        settled = []
+        vote_buffer.on_settled = lambda election_id, voter_ids: settled.append((election_id, voter_ids))
+        def invalid(votes):
+            raise ValueError("not a document id")
+        election.claim_voters = invalid
+        vote_buffer.submit("election", "a", voter_id="voter")
+        vote_buffer.close()
+        assert settled == [("election", ["voter"])]
+
+    def test_voters_entered_before_a_failed_claim_are_counted_once(self, recording_buffer):
+        vote_buffer, election = recording_buffer
+        claims = []
+        def claim_voters(votes):
+            claims.append(sorted(votes))
+            if len(claims) == 1:
+                raise models.Election.VotersPartlyClaimed("second chunk failed", ["first"], ["repeat"]) from RuntimeError("unavailable")
+            return []
+        election.claim_voters = claim_voters
+        vote_buffer.submit("election", "a", voter_id="first")
+        vote_buffer.submit("election", "a", voter_id="repeat")
+        vote_buffer.submit("election", "b", voter_id="second")
+        vote_buffer._collect(None, None)
+        vote_buffer.flush()
+        vote_buffer.flush()
+        assert claims == [["first", "repeat", "second"], ["second"]]
+        assert election.recorded == [{"a": 1, "b": 1}]
+
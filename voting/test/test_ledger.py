@@ -0,0 +1,117 @@
+import time
+from ledger import BloomFilter, VoterLedger, VoterLedgers
+
+
+class FakeElection:
+    def __init__(self, voters=()):
+        self._document_id = "election"
+        self.state = "Open"
+        self.ledger = set(voters)
+        self.claims = 0
+
+    def voter_ids(self):
+        return iter(self.ledger)
+
+    def claim_voter(self, voter_id, candidate_id=None):
+        self.claims += 1
+        if voter_id in self.ledger:
+            return False
+        self.ledger.add(voter_id)
+        return True
+
+
+class TestBloomFilter:
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"voter_{i}")
+        assert all(f"voter_{i}" in bloom for i in range(1000))
+
+    def test_false_positives_stay_near_the_error_rate(self):
+        bloom = BloomFilter(capacity=10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(f"voter_{i}")
+        false_positives = sum(1 for i in range(10000) if f"stranger_{i}" in bloom)
+        assert false_positives < 200
+
+    def test_add_says_whether_the_item_is_new(self):
+        bloom = BloomFilter(capacity=100)
+        assert bloom.add("voter")
+        assert not bloom.add("voter")
+        assert bloom.count == 1
+
+    def test_round_trips_through_bytes(self):
+        bloom = BloomFilter(capacity=100)
+        bloom.add("voter")
+        restored = BloomFilter.from_bytes(bloom.to_bytes())
+        assert "voter" in restored
+        assert (restored.num_bits, restored.num_hashes, restored.count) == (bloom.num_bits, bloom.num_hashes, 1)
+
+
+class TestVoterLedger:
+
+    def test_first_time_voters_skip_the_ledger_check(self):
+        election = FakeElection()
+        voter_ledger = VoterLedger(election, capacity=1000).load()
+        assert [voter_ledger.admit(f"voter_{i}", "a") for i in range(100)] == [VoterLedger.FIRST_VOTE] * 100
+        assert election.claims == 0
+
+    def test_repeat_voters_are_checked_against_the_ledger(self):
+        election = FakeElection(voters=["earlier"])
+        voter_ledger = VoterLedger(election, capacity=1000).load()
+        assert voter_ledger.admit("earlier", "a") == VoterLedger.ALREADY_VOTED
+        assert election.claims == 1
+        assert voter_ledger.duplicates == 1
+
+    def test_unsettled_voters_are_turned_away_without_the_ledger(self):
+        election = FakeElection()
+        voter_ledger = VoterLedger(election, capacity=1000).load()
+        assert voter_ledger.admit("voter", "a") == VoterLedger.FIRST_VOTE
+        # The first vote hasn't been written yet, so the ledger doesn't have the voter, but this process knows.
+        assert voter_ledger.admit("voter", "b") == VoterLedger.ALREADY_VOTED
+        assert election.claims == 0
+
+    def test_settled_voters_are_checked_against_the_ledger(self):
+        election = FakeElection()
+        voter_ledger = VoterLedger(election, capacity=1000).load()
+        voter_ledger.admit("written", "a")
+        voter_ledger.admit("dropped", "a")
+        # A flush entered one in the ledger; the other's vote never got there.
+        election.ledger.add("written")
+        voter_ledger.settle(["written", "dropped"])
+        assert voter_ledger.admit("written", "a") == VoterLedger.ALREADY_VOTED
+        assert voter_ledger.admit("dropped", "a") == VoterLedger.CLAIMED
+        assert voter_ledger.admit("dropped", "a") == VoterLedger.ALREADY_VOTED
+
+    def test_votes_while_loading_are_checked_and_kept_for_the_filter(self):
+        election = FakeElection(voters=["earlier"])
+        voter_ledger = VoterLedger(election, capacity=1000)
+        assert voter_ledger.admit("earlier", "a") == VoterLedger.ALREADY_VOTED
+        assert voter_ledger.admit("during", "a") == VoterLedger.CLAIMED
+        voter_ledger.load()
+        assert "during" in voter_ledger.filter
+        assert voter_ledger.admit("after", "a") == VoterLedger.FIRST_VOTE
+
+
+class TestVoterLedgers:
+
+    def test_ledgers_load_in_the_background(self):
+        election = FakeElection(voters=["earlier"])
+        voter_ledgers = VoterLedgers(capacity=1000)
+        voter_ledger = voter_ledgers.ledger(election)
+        deadline = time.monotonic() + 5
+        while voter_ledger.filter is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert "earlier" in voter_ledger.filter
+        assert voter_ledgers.ledger(election) is voter_ledger
+
+    def test_settle_reaches_the_elections_ledger(self):
+        election = FakeElection()
+        voter_ledgers = VoterLedgers(capacity=1000)
+        voter_ledger = voter_ledgers.ledger(election)
+        voter_ledger.load()
+        voter_ledger.admit("voter", "a")
+        voter_ledgers.settle("election", ["voter"])
+        voter_ledgers.settle("unknown", ["voter"])
+        assert voter_ledger.admit("voter", "a") == VoterLedger.CLAIMED
@@ -0,0 +1,120 @@
+import json
+import pytest
+import live
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeWatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.unsubscribed = False
+
+    def send(self, tallies):
+        self.callback([FakeSnapshot({'tallies': tallies, 'total_votes': sum(tallies.values())})], [], None)
+
+    def unsubscribe(self):
+        self.unsubscribed = True
+
+
+@pytest.fixture
+def hub():
+    watches = []
+    def watch(election_id, callback):
+        watches.append(FakeWatch(callback))
+        return watches[-1]
+    # Publish by hand rather than waiting on the coalescing thread.
+    hub = live.LiveResults(max_queued=2, coalesce_seconds=60, watch=watch)
+    yield hub, watches
+    for feed in list(hub._feeds.values()):
+        feed.stop()
+
+
+def _events(subscriber):
+    events = []
+    while not subscriber._queue.empty():
+        event = subscriber._queue.get_nowait()
+        if event is live._CLOSED:
+            break
+        lines = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+class TestLiveResults:
+
+    def test_one_listener_however_many_subscribers(self, hub):
+        hub, watches = hub
+        subscribers = [hub.subscribe("election") for _ in range(100)]
+        assert len(watches) == 1
+        for subscriber in subscribers:
+            hub.unsubscribe(subscriber)
+        assert watches[0].unsubscribed
+        assert hub.feed("election") is None
+
+    def test_snapshot_then_deltas_of_changed_tallies(self, hub):
+        hub, watches = hub
+        subscriber = hub.subscribe("election")
+        watches[0].send({"a": 1, "b": 2})
+        hub.feed("election").publish()
+        watches[0].send({"a": 1, "b": 5})
+        hub.feed("election").publish()
+        assert _events(subscriber) == [
+                ("snapshot", {"election": "election", "total_votes": 3, "ranking": [{"candidate": "b", "votes": 2}, {"candidate": "a", "votes": 1}]}),
+                ("delta", {"election": "election", "total_votes": 6, "tallies": {"b": 5}}),
+                ]
+
+    def test_deltas_say_which_candidates_were_removed(self, hub):
+        hub, watches = hub
+        subscriber = hub.subscribe("election")
+        watches[0].send({"a": 1, "b": 2})
+        hub.feed("election").publish()
+        watches[0].send({"a": 1})
+        hub.feed("election").publish()
+        assert _events(subscriber)[-1] == ("delta", {"election": "election", "total_votes": 1, "tallies": {"b": None}})
+
+    def test_a_change_to_the_total_alone_is_sent(self, hub):
+        hub, watches = hub
+        subscriber = hub.subscribe("election")
+        watches[0].send({"a": 1})
+        hub.feed("election").publish()
+        watches[0].callback([FakeSnapshot({'tallies': {"a": 1}, 'total_votes': 2})], [], None)
+        hub.feed("election").publish()
+        assert _events(subscriber)[-1] == ("delta", {"election": "election", "total_votes": 2, "tallies": {}})
+
+    def test_changes_between_publishes_are_coalesced(self, hub):
+        hub, watches = hub
+        subscriber = hub.subscribe("election")
+        watches[0].send({"a": 1})
+        hub.feed("election").publish()
+        for votes in range(2, 10):
+            watches[0].send({"a": votes})
+        hub.feed("election").publish()
+        assert [event for event, _ in _events(subscriber)] == ["snapshot", "delta"]
+
+    def test_late_subscribers_start_from_a_snapshot(self, hub):
+        hub, watches = hub
+        hub.subscribe("election")
+        watches[0].send({"a": 4})
+        hub.feed("election").publish()
+        late = hub.subscribe("election")
+        assert _events(late) == [("snapshot", {"election": "election", "total_votes": 4, "ranking": [{"candidate": "a", "votes": 4}]})]
+
+    def test_slow_subscribers_are_dropped(self, hub):
+        hub, watches = hub
+        slow = hub.subscribe("election")
+        watches[0].send({"a": 0})
+        hub.feed("election").publish()
+        for votes in range(1, 4):
+            watches[0].send({"a": votes})
+            hub.feed("election").publish()
+        assert slow.dropped
+        assert list(slow.events(heartbeat_seconds=0)) == []
+        assert hub.feed("election").subscriber_count() == 0
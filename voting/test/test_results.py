@@ -0,0 +1,224 @@
+import collections
+import pytest
+import models
+import results
+
+
+class FakeSnapshot:
+    def __init__(self, document_id, data):
+        self.id = document_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDocument:
+    def __init__(self, path):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+        self.data = None
+
+    def collection(self, name):
+        return FakeCollection(f"{self.path}/{name}", self._documents)
+
+    def set(self, data, merge=False):
+        self.data = data
+
+    def get(self):
+        return FakeSnapshot(self.id, self.data)
+
+
+class FakeCollection:
+    def __init__(self, path, documents):
+        self.path = path
+        self._documents = documents
+
+    def document(self, document_id):
+        path = f"{self.path}/{document_id}"
+        if path not in self._documents:
+            self._documents[path] = FakeDocument(path)
+            self._documents[path]._documents = self._documents
+        return self._documents[path]
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.writes = []
+        self._db = db
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append((doc_ref.path, data))
+
+    def commit(self):
+        if self._db.fail_after == len(self._db.commits):
+            self._db.fail_after = None
+            raise RuntimeError("unavailable")
+        self._db.commits.append(self.writes)
+
+
+class FakeDb:
+    def __init__(self):
+        self.documents = {}
+        self.commits = []
+        # Fail the next commit once this many have gone through.
+        self.fail_after = None
+
+    def collection(self, name):
+        return FakeCollection(name, self.documents)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class ResultsTestCandidate(models.Candidate):
+    @classmethod
+    def collection_name(cls):
+        return "results_test_candidates"
+
+
+class ResultsTestElection(models.Election):
+    @classmethod
+    def collection_name(cls):
+        return "results_test_elections"
+
+
+class ResultsTestElectionResults(models.ElectionResults):
+    @classmethod
+    def collection_name(cls):
+        return "results_test_election_results"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(models.Storage, "_db", db, raising=False)
+    for model_class in (ResultsTestCandidate, ResultsTestElection, ResultsTestElectionResults):
+        monkeypatch.setattr(model_class, "_collection_ref", db.collection(model_class.collection_name()), raising=False)
+    yield db
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(results.time, "monotonic", lambda: now[0])
+    yield now
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    counted = []
+    def read_results(election_id):
+        counted.append(election_id)
+        return {"election": election_id, "reads": len(counted)}
+    monkeypatch.setattr(results, "read_results", read_results)
+    monkeypatch.setattr(results, "_cache", collections.OrderedDict())
+    yield counted
+
+
+def _increments(data):
+    return dict((key, value.value) for key, value in data.items())
+
+
+class TestElectionResults:
+
+    def test_ranked_puts_most_votes_first_and_ties_in_candidate_order(self):
+        election_results = models.ElectionResults("election")
+        election_results.tallies = {"c": 2, "a": 5, "b": 2}
+        assert election_results.ranked() == [("a", 5), ("b", 2), ("c", 2)]
+
+    def test_apply_votes_increments_the_tallies(self, db):
+        batch = db.batch()
+        ResultsTestElectionResults.apply_votes("election", {"a": 3, "b": 1}, batch=batch)
+        [(path, data)] = batch.writes
+        assert path == "results_test_election_results/election"
+        assert _increments(data["tallies"]) == {"a": 3, "b": 1}
+        assert data["total_votes"].value == 4
+
+    def test_record_votes_counts_on_the_callers_classes(self, db):
+        election = ResultsTestElection("election")
+        election.record_votes({"a": 2}, candidate_class=ResultsTestCandidate, results_class=ResultsTestElectionResults)
+        [writes] = db.commits
+        paths = [path for path, data in writes]
+        assert any(path.startswith("results_test_candidates/a/") for path in paths)
+        assert "results_test_election_results/election" in paths
+        assert not any(path.startswith(("candidates/", "election_results/")) for path in paths)
+
+    def test_record_vote_leaves_the_view_alone(self, db):
+        election = ResultsTestElection("election")
+        election.record_vote(ResultsTestCandidate("a"))
+        [writes] = db.commits
+        assert not any(path.startswith("election_results/") for path, data in writes)
+        assert len(writes) == 2
+
+    def test_record_votes_stays_under_the_commit_limit(self, db):
+        election = ResultsTestElection("election")
+        counts = dict((f"candidate_{i}", 1) for i in range(600))
+        election.record_votes(counts, candidate_class=ResultsTestCandidate, results_class=ResultsTestElectionResults)
+        assert len(db.commits) == 3
+        assert all(len(writes) <= models.ModelBase.MAX_WRITES_PER_COMMIT for writes in db.commits)
+        views = [data for writes in db.commits for path, data in writes if path == "results_test_election_results/election"]
+        assert sum(data["total_votes"].value for data in views) == 600
+
+
+    def test_a_failed_commit_says_which_votes_were_counted(self, db):
+        db.fail_after = 1
+        election = ResultsTestElection("election")
+        counts = dict((f"candidate_{i}", 1) for i in range(300))
+        with pytest.raises(models.Election.VotesPartlyRecorded) as raised:
+            election.record_votes(counts, candidate_class=ResultsTestCandidate, results_class=ResultsTestElectionResults)
+        assert len(raised.value.recorded) == models.Election.VOTES_PER_COMMIT
+        assert {**raised.value.recorded, **raised.value.remaining} == counts
+        assert isinstance(raised.value.__cause__, RuntimeError)
+
+    def test_a_failed_first_commit_raises_its_own_error(self, db):
+        db.fail_after = 0
+        with pytest.raises(RuntimeError):
+            ResultsTestElection("election").record_votes({"a": 1}, candidate_class=ResultsTestCandidate, results_class=ResultsTestElectionResults)
+
+
+class TestCachedResults:
+
+    def test_reads_are_served_from_memory_within_max_age(self, clock, reads):
+        assert results.cached_results("election", max_age=2.0)["reads"] == 1
+        clock[0] += 1.5
+        assert results.cached_results("election", max_age=2.0)["reads"] == 1
+        clock[0] += 1.0
+        assert results.cached_results("election", max_age=2.0)["reads"] == 2
+
+    def test_invalidate_forces_a_read(self, clock, reads):
+        results.cached_results("election")
+        results.cached_results("other")
+        results.invalidate("election")
+        assert results.cached_results("election")["reads"] == 3
+        assert results.cached_results("other")["reads"] == 2
+
+    def test_only_the_most_recently_read_elections_are_kept(self, clock, reads, monkeypatch):
+        monkeypatch.setattr(results, "MAX_CACHED_ELECTIONS", 2)
+        results.cached_results("a")
+        results.cached_results("b")
+        results.cached_results("a")
+        results.cached_results("c")
+        assert list(results._cache) == ["a", "c"]
+        assert results.cached_results("b")["reads"] == 4
+
+    def test_recompute_replaces_the_view_from_the_counters(self, db, monkeypatch):
+        class FakeCounter:
+            def __init__(self, votes):
+                self.votes = votes
+
+            def total(self):
+                return self.votes
+
+        election = ResultsTestElection("election")
+        counters = {"a": 4, "b": 7}
+        monkeypatch.setattr(election, "counted_candidate_ids", lambda: list(counters))
+        monkeypatch.setattr(election, "vote_counter", lambda candidate_id: FakeCounter(counters[candidate_id]))
+        invalidated = []
+        monkeypatch.setattr(results, "invalidate", invalidated.append)
+        ResultsTestElectionResults("election").doc_ref().set({"tallies": {"a": 1, "stale": 9}, "total_votes": 10})
+        election_results = results.recompute(election, results_class=ResultsTestElectionResults)
+        assert election_results.tallies == {"a": 4, "b": 7}
+        assert election_results.total_votes == 11
+        assert invalidated == ["election"]